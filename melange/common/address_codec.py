@@ -0,0 +1,124 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Conversions between the text, integer and stored forms of IP and MAC
+addresses.
+
+IPv4 dotted quads, IPv6 text and EUI-48 text and integers take fast paths;
+anything else goes through netaddr, so every address is accepted, rejected
+and formatted exactly as netaddr does it.
+
+"""
+
+import re
+import socket
+import struct
+
+import netaddr
+
+
+_IPV4 = re.compile(r"^(0|[1-9][0-9]{0,2})\.(0|[1-9][0-9]{0,2})\."
+                   r"(0|[1-9][0-9]{0,2})\.(0|[1-9][0-9]{0,2})\Z")
+_EUI48 = re.compile(r"^[0-9a-fA-F]{2}([:-])[0-9a-fA-F]{2}"
+                    r"(\1[0-9a-fA-F]{2}){4}\Z")
+_IPV4_MAX = 2 ** 32 - 1
+_IPV6_MAX = 2 ** 128 - 1
+_EUI48_MAX = 2 ** 48 - 1
+
+
+def parse_ip(address):
+    """The version and integer value of an IP address."""
+    if isinstance(address, (int, long)):
+        if 0 <= address <= _IPV4_MAX:
+            return 4, address
+        if _IPV4_MAX < address <= _IPV6_MAX:
+            return 6, address
+    elif isinstance(address, basestring):
+        value = _ipv4_value(address)
+        if value is not None:
+            return 4, value
+        if ":" in address:
+            value = _ipv6_value(address)
+            if value is not None:
+                return 6, value
+    ip = netaddr.IPAddress(address)
+    return ip.version, int(ip)
+
+
+def ip_version(address):
+    return parse_ip(address)[0]
+
+
+def canonical_ip(address):
+    """The form addresses are stored in: dotted quads for IPv4, and all
+    eight groups of four hex digits for IPv6.
+
+    """
+    version, value = parse_ip(address)
+    return format_ip(value, version)
+
+
+def format_ip(value, version):
+    if version == 4:
+        return "%d.%d.%d.%d" % (value >> 24, value >> 16 & 0xff,
+                                value >> 8 & 0xff, value & 0xff)
+    return ":".join("%04x" % (value >> shift & 0xffff)
+                    for shift in range(112, -16, -16))
+
+
+def last_word(address):
+    """The last octet of an IPv4 address or group of an IPv6 address."""
+    version, value = parse_ip(address)
+    return value & (0xff if version == 4 else 0xffff)
+
+
+def mac_value(address):
+    """The integer value of a MAC address."""
+    if isinstance(address, (int, long)) and 0 <= address <= _EUI48_MAX:
+        return address
+    if isinstance(address, basestring) and _EUI48.match(address):
+        return int(re.sub("[:-]", "", address), 16)
+    return int(netaddr.EUI(address))
+
+
+def format_mac(address):
+    """A MAC address as six upper case hex pairs joined by dashes."""
+    value = mac_value(address)
+    if value > _EUI48_MAX:
+        return str(netaddr.EUI(value))
+    return "-".join("%02X" % (value >> shift & 0xff)
+                    for shift in range(40, -8, -8))
+
+
+def _ipv4_value(address):
+    match = _IPV4.match(address)
+    if match is None:
+        return None
+    octets = [int(octet) for octet in match.groups()]
+    if max(octets) > 255:
+        return None
+    return (octets[0] << 24 | octets[1] << 16 | octets[2] << 8
+            | octets[3])
+
+
+def _ipv6_value(address):
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, address)
+    except (socket.error, ValueError, TypeError, UnicodeError):
+        return None
+    high, low = struct.unpack("!QQ", packed)
+    return high << 64 | low
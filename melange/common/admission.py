@@ -0,0 +1,182 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import logging
+import math
+import re
+import time
+import webob.dec
+import webob.exc
+
+from melange.common import utils
+from melange.common import wsgi
+
+
+LOG = logging.getLogger("melange.common.admission")
+
+
+class AdmissionControlMiddleware(wsgi.Middleware):
+    """Turns away allocation requests with 429 instead of queueing them.
+
+    Each tenant gets a token bucket of tenant_rate requests per second,
+    with bursts of up to tenant_burst, and at most tenant_concurrency
+    requests in flight. All tenants together are held to a concurrency
+    limit that grows while requests finish within target_latency seconds
+    and shrinks when they take longer. Buckets are kept for the
+    max_tenants tenants that sent allocations most recently.
+
+    """
+
+    allocation_url = re.compile(".*/(ip_allocations|ip_addresses|interfaces)"
+                                r"(/[^/]+)?(\.\w+)?$")
+    tenant_scoped_url = re.compile(".*/tenants/(?P<tenant_id>[^/]+)/")
+
+    def __init__(self, application, tenant_rate=10, tenant_burst=20,
+                 tenant_concurrency=10, min_concurrency=4,
+                 max_concurrency=100, target_latency=0.5,
+                 max_tenants=10000):
+        self.tenant_rate = float(tenant_rate)
+        self.tenant_burst = float(tenant_burst)
+        self.tenant_concurrency = int(tenant_concurrency)
+        self.limit = AimdLimit(int(min_concurrency), int(max_concurrency),
+                               float(target_latency))
+        self._buckets = utils.LRUCache(int(max_tenants))
+        self._tenant_in_flight = collections.defaultdict(int)
+        self._in_flight = 0
+        super(AdmissionControlMiddleware, self).__init__(application)
+
+    @webob.dec.wsgify(RequestClass=wsgi.Request)
+    def __call__(self, request):
+        # NOTE: lets the batch endpoint admit each of its sub requests
+        request.environ['melange.admission_control'] = self
+        return self.get_response(request, self.application)
+
+    def get_response(self, request, application):
+        """The response of the application to the request, unless it is an
+        allocation turned away.
+
+        """
+        if not self._is_allocation(request):
+            return request.get_response(application)
+
+        tenant_id = self._tenant_id(request)
+        retry_after = self._admit(tenant_id, time.time())
+        if retry_after:
+            LOG.debug("Turned away allocation for tenant %s, retry after "
+                      "%s seconds" % (tenant_id, retry_after))
+            error = webob.exc.HTTPTooManyRequests(
+                _("Too many allocation requests, retry after %s seconds")
+                % retry_after)
+            error.retry_after = retry_after
+            return wsgi.Fault(error)
+
+        start = time.time()
+        try:
+            return request.get_response(application)
+        finally:
+            finish = time.time()
+            self._in_flight -= 1
+            self._tenant_in_flight[tenant_id] -= 1
+            if not self._tenant_in_flight[tenant_id]:
+                del self._tenant_in_flight[tenant_id]
+            self.limit.observe(finish - start, finish)
+
+    def _admit(self, tenant_id, now):
+        """Takes a slot for the request, or returns seconds to retry after."""
+        if self._in_flight >= self.limit.concurrency:
+            return 1
+        if self._tenant_in_flight[tenant_id] >= self.tenant_concurrency:
+            return 1
+        bucket = self._buckets.get(
+            tenant_id,
+            lambda key: TokenBucket(self.tenant_rate,
+                                    self.tenant_burst,
+                                    now))
+        wait = bucket.take(now)
+        if wait:
+            return int(math.ceil(wait))
+        self._in_flight += 1
+        self._tenant_in_flight[tenant_id] += 1
+        return 0
+
+    def _is_allocation(self, request):
+        return (request.method in ("POST", "PUT") and
+                self.allocation_url.match(request.path_info) is not None)
+
+    def _tenant_id(self, request):
+        match = self.tenant_scoped_url.match(request.path_info)
+        if match:
+            return match.group('tenant_id')
+        return request.headers.get('X_TENANT')
+
+    @classmethod
+    def factory(cls, global_config, **local_config):
+        def _factory(app):
+            LOG.debug("Created admission control middleware with config: %s"
+                      % local_config)
+            return cls(app, **local_config)
+        return _factory
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def take(self, now):
+        """Takes a token, or returns seconds until one is available."""
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1.0 - self.tokens) / self.rate
+
+
+class AimdLimit(object):
+    """Concurrency limit adapted with additive increase and multiplicative
+    decrease from the latency of finished requests.
+
+    """
+
+    backoff = 0.9
+
+    def __init__(self, min_concurrency, max_concurrency, target_latency):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.concurrency = float(max_concurrency)
+        self._decreased_at = None
+
+    def observe(self, latency, now):
+        if latency <= self.target_latency:
+            self.concurrency = min(self.max_concurrency,
+                                   self.concurrency + 1.0 / self.concurrency)
+            return
+        # NOTE: requests in flight when the limit drops finish slow too, so
+        # decrease at most once per target_latency
+        if (self._decreased_at is not None and
+                now - self._decreased_at < self.target_latency):
+            return
+        self._decreased_at = now
+        self.concurrency = max(self.min_concurrency,
+                               self.concurrency * self.backoff)
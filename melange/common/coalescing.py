@@ -0,0 +1,175 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import re
+import sys
+import time
+
+from eventlet import event
+import webob.dec
+
+from melange.common import wsgi
+
+
+LOG = logging.getLogger("melange.common.coalescing")
+
+
+class CoalescingMiddleware(wsgi.Middleware):
+    """Runs identical concurrent GET requests once and hands the response
+    to every waiter.
+
+    Requests are identical when they share method, path, query string,
+    tenant, roles and Accept header. With a cache_ttl, successful responses
+    are also kept for that many seconds, until a write to the same network,
+    device or interface invalidates them.
+
+    """
+
+    scoped_url = re.compile("/(?P<kind>networks|instances|interfaces)/"
+                            "(?P<id>[^/.]+)")
+
+    def __init__(self, application, cache_ttl=0, max_cache_entries=1000):
+        self.cache_ttl = float(cache_ttl)
+        self.max_cache_entries = int(max_cache_entries)
+        self._flights = {}
+        self._cache = {}
+        self._generation = 0
+        super(CoalescingMiddleware, self).__init__(application)
+
+    @webob.dec.wsgify
+    def __call__(self, request):
+        if request.method not in ("GET", "HEAD"):
+            try:
+                return request.get_response(self.application)
+            finally:
+                self._invalidate(self._scopes(request.path_info))
+
+        key = self._key(request)
+        cached = self._cached_response(key)
+        if cached is not None:
+            LOG.debug("Serving %s from cache" % request.path_info)
+            return cached.copy()
+
+        flight = self._flights.get(key)
+        if flight is not None and flight.generation == self._generation:
+            LOG.debug("Coalescing %s with request in flight"
+                      % request.path_info)
+            return flight.wait().copy()
+
+        return self._fly(key, request).copy()
+
+    def _fly(self, key, request):
+        flight = _Flight(self._generation)
+        self._flights[key] = flight
+        try:
+            response = request.get_response(self.application)
+            # NOTE: reads all of a streamed body so it can be replayed
+            response.body
+        except Exception:
+            flight.send_exception(*sys.exc_info())
+            raise
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        flight.send(response)
+        if (self.cache_ttl > 0 and response.status_int == 200
+                and flight.generation == self._generation):
+            self._store(key, request, response)
+        return response
+
+    def _key(self, request):
+        return (request.method,
+                request.script_name,
+                request.path_info,
+                request.query_string,
+                request.headers.get('X_TENANT'),
+                request.headers.get('X_ROLE'),
+                request.headers.get('Accept'))
+
+    def _scopes(self, path):
+        return dict((match.group('kind'), match.group('id'))
+                    for match in self.scoped_url.finditer(path))
+
+    def _cached_response(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.time():
+            self._cache.pop(key, None)
+            return None
+        return entry.response
+
+    def _store(self, key, request, response):
+        if len(self._cache) >= self.max_cache_entries:
+            now = time.time()
+            for stale_key in [k for k, entry in self._cache.iteritems()
+                              if entry.expires_at <= now]:
+                del self._cache[stale_key]
+        if len(self._cache) < self.max_cache_entries:
+            self._cache[key] = _CacheEntry(response,
+                                           self._scopes(request.path_info),
+                                           time.time() + self.cache_ttl)
+
+    def _invalidate(self, write_scopes):
+        """Drops cached responses the write could have changed.
+
+        A cached response survives only when it is scoped to a different
+        network, device or interface than one the write is scoped to.
+
+        """
+        self._generation += 1
+        for key, entry in self._cache.items():
+            if not entry.unaffected_by(write_scopes):
+                del self._cache[key]
+
+    @classmethod
+    def factory(cls, global_config, **local_config):
+        def _factory(app):
+            LOG.debug("Created coalescing middleware with config: %s"
+                      % local_config)
+            return cls(app, **local_config)
+        return _factory
+
+
+class _Flight(object):
+
+    def __init__(self, generation):
+        self.generation = generation
+        self._event = event.Event()
+
+    def send(self, response):
+        self._event.send(response)
+
+    def send_exception(self, *exc_info):
+        self._event.send_exception(*exc_info)
+
+    def wait(self):
+        return self._event.wait()
+
+
+class _CacheEntry(object):
+
+    def __init__(self, response, scopes, expires_at):
+        self.response = response
+        self.scopes = scopes
+        self.expires_at = expires_at
+
+    def unaffected_by(self, write_scopes):
+        return any(kind in self.scopes and self.scopes[kind] != scope_id
+                   for kind, scope_id in write_scopes.iteritems())
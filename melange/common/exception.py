@@ -37,6 +37,16 @@ class ParamsMissingError(MelangeError):
     message = _("Data Missing")
 
 
+class BatchTooLargeError(MelangeError):
+
+    message = _("Batch of %(count)s requests exceeds the limit of %(limit)s")
+
+
+class InvalidParamError(MelangeError):
+
+    message = _("Invalid value %(value)s for %(param)s")
+
+
 class MelangeServiceResponseError(MelangeError):
 
     message = _("Error while responding to service call")
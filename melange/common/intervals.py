@@ -0,0 +1,74 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Set arithmetic on sorted (first, last) integer intervals, both ends
+included.
+
+Intervals are taken and yielded lazily in order, so sets of addresses are
+worked with a run at a time, never an address at a time.
+
+"""
+
+import heapq
+
+
+def union(*sorted_intervals):
+    """The union of sorted sequences of intervals, with overlapping and
+    adjacent intervals coalesced.
+
+    """
+    merged = None
+    for first, last in heapq.merge(*sorted_intervals):
+        if merged is not None and first <= merged[1] + 1:
+            merged = (merged[0], max(merged[1], last))
+            continue
+        if merged is not None:
+            yield merged
+        merged = (first, last)
+    if merged is not None:
+        yield merged
+
+
+def complement(coalesced_intervals, first, last):
+    """The intervals between first and last the coalesced intervals leave
+    out.
+
+    """
+    expected = first
+    for start, end in coalesced_intervals:
+        if end < expected:
+            continue
+        if start > last:
+            break
+        if start > expected:
+            yield expected, start - 1
+        expected = end + 1
+        if expected > last:
+            return
+    if expected <= last:
+        yield expected, last
+
+
+def periodic(first, last, period, residue):
+    """The single value intervals of the values from first to last that
+    leave residue when divided by period.
+
+    """
+    value = first + (residue - first) % period
+    while value <= last:
+        yield value, value
+        value += period
@@ -15,15 +15,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import logging
 import socket
 
+from eventlet import corolocal
+
 from melange.common import config
 from melange.common import exception
 from melange.common import messaging
 from melange.common import utils
 
 
+_LOCAL = corolocal.local()
+
+
 class Notifier(object):
 
     def error(self, event_type, payload):
@@ -37,6 +43,10 @@ class Notifier(object):
 
     def _send_message(self, level, event_type, payload):
         msg = self._generate_message(event_type, level, payload)
+        held_back = getattr(_LOCAL, 'deferred', None)
+        if held_back is not None:
+            held_back.messages.append((self, level, msg))
+            return
         self.notify(level, msg)
 
     def _generate_message(self, event_type, priority, payload):
@@ -76,6 +86,36 @@ class QueueNotifier(Notifier):
             queue.put(msg)
 
 
+class DeferredNotifications(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def discard(self):
+        self.messages = []
+
+
+@contextlib.contextmanager
+def deferred(enabled=True):
+    """Holds back the notifications the current green thread sends within
+    the block until it exits, dropping them if it raises or discard() is
+    called on the yielded DeferredNotifications.
+
+    """
+    held_back = getattr(_LOCAL, 'deferred', None)
+    if not enabled or held_back is not None:
+        yield held_back or DeferredNotifications()
+        return
+
+    held_back = _LOCAL.deferred = DeferredNotifications()
+    try:
+        yield held_back
+    finally:
+        _LOCAL.deferred = None
+    for sender, level, msg in held_back.messages:
+        sender.notify(level, msg)
+
+
 def notifier():
 
     STRATEGIES = {
@@ -22,10 +22,15 @@ from xml.dom import minidom
 
 class AtomLink(object):
 
+    tag_name = "link"
+
     def __init__(self, rel, href):
         self.rel = rel
         self.href = href
 
+    def xml_attributes(self):
+        return {'rel': self.rel, 'href': self.href}
+
     def to_xml(self):
         ATOM_NAMESPACE = "http://www.w3.org/2005/Atom"
         doc = minidom.Document()
@@ -38,11 +43,12 @@ class AtomLink(object):
 class PaginatedDataView(object):
 
     def __init__(self, collection_type, collection, current_page_url,
-                 next_page_marker=None):
+                 next_page_marker=None, marker_param="marker"):
         self.collection_type = collection_type
         self.collection = collection
         self.current_page_url = current_page_url
         self.next_page_marker = next_page_marker
+        self.marker_param = marker_param
 
     def data_for_json(self):
         json_dict = {self.collection_type: self.collection}
@@ -58,7 +64,7 @@ class PaginatedDataView(object):
 
     def _create_link(self, marker):
         app_url = AppUrl(self.current_page_url)
-        return str(app_url.change_query_params(marker=marker))
+        return str(app_url.change_query_params(**{self.marker_param: marker}))
 
     def _links(self):
         if not self.next_page_marker:
@@ -68,6 +74,53 @@ class PaginatedDataView(object):
         return [next_link]
 
 
+class StreamedDataView(PaginatedDataView):
+    """Paginated view of a collection that is produced lazily.
+
+    elements yields (id, data) pairs, an element beyond limit only tells
+    that there is a next page. Streamed as json, the collection is never
+    held in memory as a whole.
+
+    """
+
+    def __init__(self, collection_type, elements, current_page_url,
+                 limit=200):
+        super(StreamedDataView, self).__init__(collection_type,
+                                               None,
+                                               current_page_url)
+        self.elements = elements
+        self.limit = int(limit)
+
+    def json_chunks(self, serializer):
+        yield "{%s: [" % serializer.serialize(self.collection_type)
+        for count, element in enumerate(self._page()):
+            separator = ", " if count else ""
+            yield separator + serializer.serialize(element)
+        yield "]"
+        if self._links():
+            links_key = self.collection_type + "_links"
+            yield ", %s: %s" % (serializer.serialize(links_key),
+                                serializer.serialize(self._links()))
+        yield "}"
+
+    def data_for_json(self):
+        self.collection = list(self._page())
+        return super(StreamedDataView, self).data_for_json()
+
+    def data_for_xml(self):
+        self.collection = list(self._page())
+        return super(StreamedDataView, self).data_for_xml()
+
+    def _page(self):
+        last_id = None
+        for count, (element_id, element) in enumerate(self.elements):
+            if count == self.limit:
+                self.next_page_marker = last_id
+                break
+            last_id = element_id
+            yield element
+
+
 class AppUrl(object):
 
     def __init__(self, url):
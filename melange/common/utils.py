@@ -19,6 +19,7 @@
 
 import datetime
 import inspect
+import itertools
 import re
 import uuid
 
@@ -30,6 +31,8 @@ from melange.common import exception
 import_class = openstack_utils.import_class
 import_object = openstack_utils.import_object
 bool_from_string = openstack_utils.bool_from_string
+parse_isotime = openstack_utils.parse_isotime
+normalize_time = openstack_utils.normalize_time
 
 
 def parse_int(subject):
@@ -74,6 +77,25 @@ def find(predicate, items):
             return item
 
 
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def requested(fields, *names):
+    """True if any of names, or any field nested under one of them, is
+    selected by fields; None selects all.
+
+    """
+    return fields is None or any(
+        name in fields or any(field.startswith(name + ".") for field in fields)
+        for name in names)
+
+
 def generate_uuid():
     return str(uuid.uuid4())
 
@@ -113,6 +135,43 @@ class cached_property(object):
         return value
 
 
+class LRUCache(object):
+    """Keeps the values of the max_size most recently used keys.
+
+    When full, the least recently used quarter of the keys is dropped at
+    once, so that lookups stay cheap while the cache churns.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._values = {}
+        self._last_used = {}
+        self._clock = itertools.count()
+
+    def get(self, key, compute):
+        """The value of key, calling compute(key) when it is not cached."""
+        if key not in self._values:
+            if len(self._values) >= self.max_size:
+                self._evict()
+            self._values[key] = compute(key)
+        self._last_used[key] = next(self._clock)
+        return self._values[key]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def _evict(self):
+        least_recently_used = sorted(self._last_used,
+                                     key=self._last_used.get)
+        for key in least_recently_used[:max(self.max_size // 4, 1)]:
+            del self._values[key]
+            del self._last_used[key]
+
+
 class MethodInspector(object):
 
     def __init__(self, func):
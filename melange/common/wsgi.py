@@ -17,16 +17,24 @@
 
 """Utility methods for working with WSGI servers."""
 
+import datetime
 import eventlet.wsgi
 import logging
 import paste.urlmap
 import re
+import routes
+import StringIO
 import traceback
 import webob
 import webob.dec
 import webob.exc
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
+from melange.openstack.common import exception as openstack_exception
 from melange.openstack.common import wsgi as openstack_wsgi
 
 from melange.common import exception
@@ -42,12 +50,112 @@ eventlet.patcher.monkey_patch(all=False, socket=True)
 
 LOG = logging.getLogger('melange.wsgi')
 
+MSGPACK_CONTENT_TYPE = "application/x-msgpack"
+MSGPACK_VENDOR_CONTENT_TYPE = "application/vnd.openstack.melange+msgpack"
+
 
 def versioned_urlmap(*args, **kwargs):
     urlmap = paste.urlmap.urlmap_factory(*args, **kwargs)
     return VersionedURLMap(urlmap)
 
 
+class CompiledMapper(routes.Mapper):
+    """A routes.Mapper that tries only the routes which can fit a url.
+
+    A route fits when the url has its number of path segments and its
+    literal segments in the same places. Fitting routes depend only on
+    the request method and the url's shape, which keeps known literal
+    segments and blanks out the rest. They are worked out once per shape
+    and tried in their original order, so the first match is the one a
+    full scan would find.
+
+    """
+
+    max_cached_shapes = 1000
+
+    def __init__(self, *args, **kwargs):
+        super(CompiledMapper, self).__init__(*args, **kwargs)
+        self._fitting_routes = {}
+        self._literals = None
+
+    def connect(self, *args, **kwargs):
+        self._fitting_routes = {}
+        self._literals = None
+        self._created_regs = False
+        return super(CompiledMapper, self).connect(*args, **kwargs)
+
+    def _match(self, url, environ):
+        if (not self._created_regs or self.always_scan or self.prefix
+                or self.debug or self.minimization):
+            return super(CompiledMapper, self)._match(url, environ)
+
+        environ = environ or self.environ
+        method = environ.get('REQUEST_METHOD') if environ else None
+        for route in self._routes_fitting(method, url):
+            match = route.match(url, environ, self.sub_domains,
+                                self.sub_domains_ignore, self.domain_match)
+            if isinstance(match, dict) or match:
+                return (match, route, [])
+        return (None, None, [])
+
+    def _routes_fitting(self, method, url):
+        if self._literals is None:
+            self._literals = set(segment
+                                 for route in self.matchlist
+                                 for segment in _route_segments(route)[0]
+                                 if segment is not None)
+        shape = tuple(segment if segment in self._literals else None
+                      for segment in url.split("/"))
+        key = (method, shape)
+        fitting_routes = self._fitting_routes.get(key)
+        if fitting_routes is None:
+            if len(self._fitting_routes) >= self.max_cached_shapes:
+                self._fitting_routes.clear()
+            fitting_routes = [route for route in self.matchlist
+                              if _route_fits(route, method, shape)]
+            self._fitting_routes[key] = fitting_routes
+        return fitting_routes
+
+
+def _route_segments(route):
+    """Splits a route into path segments.
+
+    Returns the segments, with None for those holding a variable, and
+    whether the route's last variable segment may span more segments.
+
+    """
+    template = []
+    spans_segments = False
+    for part in route.routelist:
+        if isinstance(part, dict):
+            template.append("\0")
+            requirement = route.reqs.get(part['name'])
+            if (requirement is not None and
+                    re.match(r"(?:%s)\Z" % requirement, "a/b")):
+                spans_segments = True
+                break
+        else:
+            template.append(part)
+    segments = [None if "\0" in segment else segment
+                for segment in "".join(template).split("/")]
+    return segments, spans_segments
+
+
+def _route_fits(route, method, shape):
+    if route.static:
+        return False
+    methods = (route.conditions or {}).get('method')
+    if method is not None and methods and method not in methods:
+        return False
+    segments, spans_segments = _route_segments(route)
+    if len(shape) < len(segments):
+        return False
+    if len(shape) > len(segments) and not spans_segments:
+        return False
+    return all(segment is None or segment == shape_segment
+               for segment, shape_segment in zip(segments, shape))
+
+
 class VersionedURLMap(object):
 
     def __init__(self, urlmap):
@@ -68,6 +176,11 @@ class VersionedURLMap(object):
 
 class Request(openstack_wsgi.Request):
 
+    if msgpack is not None:
+        default_request_content_types = (
+            openstack_wsgi.Request.default_request_content_types +
+            (MSGPACK_CONTENT_TYPE, MSGPACK_VENDOR_CONTENT_TYPE))
+
     @property
     def params(self):
         return utils.stringify_keys(super(Request, self).params)
@@ -84,14 +197,22 @@ class Request(openstack_wsgi.Request):
             format = parts[1]
             if format in ['json', 'xml']:
                 return 'application/{0}'.format(parts[1])
-
-        ctypes = {'application/vnd.openstack.melange+json': "application/json",
-                  'application/vnd.openstack.melange+xml': "application/xml",
-                  'application/json': "application/json",
-                  'application/xml': "application/xml"}
-        bm = self.accept.best_match(ctypes.keys())
-
-        return ctypes.get(bm, 'application/json')
+            if format == 'msgpack' and msgpack is not None:
+                return MSGPACK_CONTENT_TYPE
+
+        # Offers are ordered, as the first one wins among equal qualities
+        offers = [('application/vnd.openstack.melange+json',
+                   "application/json"),
+                  ('application/json', "application/json"),
+                  ('application/vnd.openstack.melange+xml', "application/xml"),
+                  ('application/xml', "application/xml")]
+        if msgpack is not None:
+            offers.extend([(MSGPACK_VENDOR_CONTENT_TYPE,
+                            MSGPACK_VENDOR_CONTENT_TYPE),
+                           (MSGPACK_CONTENT_TYPE, MSGPACK_CONTENT_TYPE)])
+        bm = self.accept.best_match([offer for offer, ctype in offers])
+
+        return dict(offers).get(bm, 'application/json')
 
     @utils.cached_property
     def accept_version(self):
@@ -112,9 +233,17 @@ class Request(openstack_wsgi.Request):
 
 class Result(object):
 
-    def __init__(self, data, status=200):
+    def __init__(self, data, status=200, etag=None):
         self._data = data
         self.status = status
+        self.etag = etag
+
+    def streamable(self, serialization_type):
+        return (serialization_type == "application/json" and
+                hasattr(self._data, "json_chunks"))
+
+    def chunks(self, serializer):
+        return self._data.json_chunks(serializer)
 
     def data(self, serialization_type):
         if (serialization_type == "application/xml" and
@@ -185,28 +314,146 @@ class Controller(object):
     exception_map = {}
 
     def create_resource(self):
+        body_serializers = {'application/xml': MelangeXMLDictSerializer()}
+        body_deserializers = {}
+        if msgpack is not None:
+            body_serializers[MSGPACK_CONTENT_TYPE] = MsgpackDictSerializer()
+            body_serializers[MSGPACK_VENDOR_CONTENT_TYPE] = (
+                MsgpackDictSerializer())
+            body_deserializers[MSGPACK_CONTENT_TYPE] = MsgpackDeserializer()
+            body_deserializers[MSGPACK_VENDOR_CONTENT_TYPE] = (
+                MsgpackDeserializer())
         serializer = MelangeResponseSerializer(
-            body_serializers={'application/xml': MelangeXMLDictSerializer()})
+            body_serializers=body_serializers)
         return Resource(self,
-                        openstack_wsgi.RequestDeserializer(),
+                        openstack_wsgi.RequestDeserializer(
+                            body_deserializers=body_deserializers),
                         serializer,
                         self.exception_map)
 
 
 class MelangeXMLDictSerializer(openstack_wsgi.XMLDictSerializer):
-
-    def _to_xml_node(self, doc, metadata, nodename, data):
+    """Writes the same xml as XMLDictSerializer without a minidom tree.
+
+    Elements are written out as strings while walking the data, the way
+    minidom's toprettyxml would print the tree XMLDictSerializer builds.
+
+    """
+
+    indent = "    "
+    newline = "\n"
+
+    def default(self, data):
+        return "".join(self.chunks(data))
+
+    def chunks(self, data):
+        root_key = data.keys()[0]
+        root_attrs = {}
+        if self.xmlns is not None:
+            root_attrs['xmlns'] = self.xmlns
+        for chunk in self._element_chunks(self.metadata,
+                                          root_key,
+                                          data[root_key],
+                                          "",
+                                          root_attrs):
+            yield chunk.encode('UTF-8')
+
+    def _element_chunks(self, metadata, nodename, data, indent,
+                        extra_attrs=None):
+        if hasattr(data, "xml_attributes"):
+            return self._tag_chunks(indent, data.tag_name,
+                                    data.xml_attributes())
         if hasattr(data, "to_xml"):
-            return data.to_xml()
-        return super(MelangeXMLDictSerializer, self)._to_xml_node(doc,
-                                                                  metadata,
-                                                                  nodename,
-                                                                  data)
+            return self._dom_chunks(data.to_xml(), indent)
+
+        attrs = {}
+        xmlns = metadata.get('xmlns', None)
+        if xmlns:
+            attrs['xmlns'] = xmlns
+        attrs.update(extra_attrs or {})
+
+        if type(data) is list:
+            collections = metadata.get('list_collections', {})
+            if nodename in collections:
+                metadata = collections[nodename]
+                children = (self._tag_chunks(
+                    indent + self.indent,
+                    metadata['item_name'],
+                    {metadata['item_key']: str(item)}) for item in data)
+                return self._tag_chunks(indent, nodename, attrs,
+                                        children=children if data else None)
+            singular = metadata.get('plurals', {}).get(nodename, None)
+            if singular is None:
+                if nodename.endswith('s'):
+                    singular = nodename[:-1]
+                else:
+                    singular = 'item'
+            children = (self._element_chunks(metadata,
+                                             singular,
+                                             item,
+                                             indent + self.indent)
+                        for item in data)
+            return self._tag_chunks(indent, nodename, attrs,
+                                    children=children if data else None)
+
+        if type(data) is dict:
+            collections = metadata.get('dict_collections', {})
+            if nodename in collections:
+                metadata = collections[nodename]
+                children = (self._tag_chunks(indent + self.indent,
+                                             metadata['item_name'],
+                                             {metadata['item_key']: str(k)},
+                                             text=str(v))
+                            for k, v in data.items())
+                return self._tag_chunks(indent, nodename, attrs,
+                                        children=children if data else None)
+            attribute_names = metadata.get('attributes', {}).get(nodename, {})
+            child_items = []
+            for k, v in data.items():
+                if k in attribute_names:
+                    attrs[k] = str(v)
+                else:
+                    child_items.append((k, v))
+            children = (self._element_chunks(metadata,
+                                             k,
+                                             v,
+                                             indent + self.indent)
+                        for k, v in child_items)
+            return self._tag_chunks(indent, nodename, attrs,
+                                    children=children if child_items else None)
+
+        return self._tag_chunks(indent, nodename, attrs, text=str(data))
+
+    def _tag_chunks(self, indent, nodename, attrs, text=None, children=None):
+        start_tag = indent + "<" + nodename + "".join(
+            ' %s="%s"' % (name, _escape_xml(attrs[name]))
+            for name in sorted(attrs))
+        if text is not None:
+            yield "%s>%s</%s>%s" % (start_tag, _escape_xml(text),
+                                    nodename, self.newline)
+        elif children is not None:
+            yield start_tag + ">" + self.newline
+            for child in children:
+                for chunk in child:
+                    yield chunk
+            yield "%s</%s>%s" % (indent, nodename, self.newline)
+        else:
+            yield start_tag + "/>" + self.newline
+
+    def _dom_chunks(self, node, indent):
+        writer = StringIO.StringIO()
+        node.writexml(writer, indent, self.indent, self.newline)
+        yield writer.getvalue()
 
 
 class MelangeResponseSerializer(openstack_wsgi.ResponseSerializer):
 
     def serialize_body(self, response, data, content_type, action):
+        if isinstance(data, Result) and data.streamable(content_type):
+            response.headers['Content-Type'] = content_type
+            serializer = self.get_body_serializer(content_type)
+            response.app_iter = data.chunks(serializer)
+            return
         if isinstance(data, Result):
             data = data.data(content_type)
         super(MelangeResponseSerializer, self).serialize_body(response,
@@ -220,6 +467,41 @@ class MelangeResponseSerializer(openstack_wsgi.ResponseSerializer):
                                                                  action)
         if isinstance(data, Result):
             response.status = data.status
+            if data.etag:
+                response.etag = data.etag
+
+
+class MsgpackDictSerializer(openstack_wsgi.DictSerializer):
+    """Serializes response bodies as msgpack, with json's datetimes.
+
+    Byte strings are packed as text rather than binary, so that clients
+    decoding text as unicode get the same values as from json.
+
+    """
+
+    def default(self, data):
+        def sanitizer(obj):
+            if isinstance(obj, datetime.datetime):
+                _dtime = obj - datetime.timedelta(microseconds=obj.microsecond)
+                return _dtime.isoformat()
+            return obj
+        return msgpack.packb(data, default=sanitizer, use_bin_type=False)
+
+
+class MsgpackDeserializer(openstack_wsgi.TextDeserializer):
+
+    def default(self, datastring):
+        try:
+            return {'body': msgpack.unpackb(datastring, raw=False)}
+        except ValueError:
+            msg = _("cannot understand msgpack")
+            raise openstack_exception.MalformedRequestBody(reason=msg)
+
+
+def _escape_xml(data):
+    """Escapes text and attribute values the way minidom does."""
+    return (data.replace("&", "&amp;").replace("<", "&lt;").
+            replace("\"", "&quot;").replace(">", "&gt;"))
 
 
 class Fault(webob.exc.HTTPException):
@@ -249,10 +531,14 @@ class Fault(webob.exc.HTTPException):
         # 'code' is an attribute on the fault tag itself
         metadata = {'attributes': {fault_name: 'code'}}
         content_type = req.best_match_content_type()
-        serializer = {
-            'application/xml': openstack_wsgi.XMLDictSerializer(metadata),
+        serializers = {
+            'application/xml': MelangeXMLDictSerializer(metadata),
             'application/json': openstack_wsgi.JSONDictSerializer(),
-        }[content_type]
+        }
+        if msgpack is not None:
+            serializers[MSGPACK_CONTENT_TYPE] = MsgpackDictSerializer()
+            serializers[MSGPACK_VENDOR_CONTENT_TYPE] = MsgpackDictSerializer()
+        serializer = serializers[content_type]
 
         self.wrapped_exc.body = serializer.serialize(fault_data, content_type)
         self.wrapped_exc.content_type = content_type
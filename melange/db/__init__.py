@@ -38,6 +38,10 @@ class Query(object):
         self._model = model
         self._conditions = conditions
 
+    @property
+    def model(self):
+        return self._model
+
     def all(self):
         return db_api.list(self._query_func, self._model, **self._conditions)
 
@@ -47,12 +51,24 @@ class Query(object):
     def __iter__(self):
         return iter(self.all())
 
+    def version(self):
+        """Count and latest updated_at of the matching rows.
+
+        Creating, updating or deleting any of the rows changes the version.
+
+        """
+        return db_api.version(self._query_func, self._model,
+                              **self._conditions)
+
     def update(self, **values):
-        db_api.update_all(self._query_func, self._model, self._conditions,
-                          values)
+        """Updates the matching rows, returning how many matched."""
+        return db_api.update_all(self._query_func, self._model,
+                                 self._conditions, values)
 
     def delete(self):
-        db_api.delete_all(self._query_func, self._model, **self._conditions)
+        """Deletes the matching rows, returning how many matched."""
+        return db_api.delete_all(self._query_func, self._model,
+                                 **self._conditions)
 
     def limit(self, limit=200, marker=None, marker_column=None):
         return db_api.find_all_by_limit(self._query_func,
@@ -68,6 +84,44 @@ class Query(object):
             return (collection[0:-1], collection[-2]['id'])
         return (collection, None)
 
+    def rows(self, fields, joins=None, limit=200, marker=None,
+             marker_column=None):
+        """Fetches plain column tuples instead of mapped model instances.
+
+        fields are column names of the model, joins maps a relation name
+        (the model has a '<relation>_id' column) to a tuple of the related
+        model name and its column names. Related columns are labelled as
+        '<relation>_<column>'.
+
+        """
+        return db_api.find_all_rows_by_limit(self._query_func,
+                                             self._model,
+                                             self._conditions,
+                                             fields,
+                                             joins or {},
+                                             limit=limit,
+                                             marker=marker,
+                                             marker_column=marker_column)
+
+    def iter_rows(self, fields, joins=None, limit=200, marker=None,
+                  marker_column=None):
+        """Like rows, but lazily reads rows off a server side cursor."""
+        return db_api.iter_rows_by_limit(self._query_func,
+                                         self._model,
+                                         self._conditions,
+                                         fields,
+                                         joins or {},
+                                         limit=limit,
+                                         marker=marker,
+                                         marker_column=marker_column)
+
+    def paginated_rows(self, fields, joins=None, limit=200, marker=None,
+                       marker_column=None):
+        rows = self.rows(fields, joins, int(limit) + 1, marker, marker_column)
+        if len(rows) > int(limit):
+            return (rows[0:-1], rows[-2]['id'])
+        return (rows, None)
+
 
 class Queryable(object):
 
@@ -17,8 +17,11 @@
 
 import sqlalchemy.exc
 from sqlalchemy import and_
+from sqlalchemy import distinct
+from sqlalchemy import func
 from sqlalchemy import or_
 from sqlalchemy.orm import aliased
+from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm import clear_mappers
 
 from melange import ipam
@@ -41,36 +44,168 @@ def find_all(model, **conditions):
     return _query_by(model, **conditions)
 
 
+def version(query_func, model, **conditions):
+    return tuple(query_func(model, **conditions).with_entities(
+        func.count(model.id), func.max(model.updated_at)).one())
+
+
+def interface_configuration_version(interface_id):
+    ip_model = ipam.models.IpAddress
+    block_model = ipam.models.IpBlock
+    route_model = ipam.models.IpRoute
+    return tuple(_base_query(ip_model).
+                 join((block_model, ip_model.ip_block_id == block_model.id)).
+                 outerjoin((route_model,
+                            route_model.source_block_id == block_model.id)).
+                 filter(ip_model.interface_id == interface_id).
+                 with_entities(func.count(distinct(ip_model.id)),
+                               func.max(ip_model.updated_at),
+                               func.max(block_model.updated_at),
+                               func.count(distinct(route_model.id)),
+                               func.max(route_model.updated_at)).
+                 one())
+
+
+def ip_block_usage_version(**conditions):
+    """Count and latest updated_at of the ips on the matching blocks and of
+    the unusable ranges and octets of their policies.
+
+    """
+    block_model = ipam.models.IpBlock
+    blocks = _query_by(block_model, **conditions)
+    version = ()
+    for model, join_condition in [
+            (ipam.models.IpAddress,
+             ipam.models.IpAddress.ip_block_id == block_model.id),
+            (ipam.models.IpRange,
+             ipam.models.IpRange.policy_id == block_model.policy_id),
+            (ipam.models.IpOctet,
+             ipam.models.IpOctet.policy_id == block_model.policy_id)]:
+        version += tuple(blocks.join((model, join_condition)).
+                         with_entities(func.count(distinct(model.id)),
+                                       func.max(model.updated_at)).
+                         one())
+    return version
+
+
 def find_all_by_limit(query_func, model, conditions, limit, marker=None,
                       marker_column=None):
     return _limits(query_func, model, conditions, limit, marker,
                    marker_column).all()
 
 
+def find_all_rows_by_limit(query_func, model, conditions, fields, joins,
+                           limit, marker=None, marker_column=None):
+    return _rows_result(query_func, model, conditions, fields, joins,
+                        limit, marker, marker_column).fetchall()
+
+
+def iter_rows_by_limit(query_func, model, conditions, fields, joins,
+                       limit, marker=None, marker_column=None):
+    result = _rows_result(query_func, model, conditions, fields, joins,
+                          limit, marker, marker_column, stream_results=True)
+    try:
+        for row in result:
+            yield row
+    finally:
+        result.close()
+
+
+def _rows_result(query_func, model, conditions, fields, joins, limit,
+                 marker, marker_column, **execution_options):
+    query = query_func(model, **conditions)
+    columns = [getattr(model, field).label(field) for field in fields]
+    for relation, (related_model_name, related_fields) in joins.iteritems():
+        related_model = aliased(ipam.models.persisted_models()[
+            related_model_name])
+        query = query.outerjoin(
+            (related_model,
+             getattr(model, relation + "_id") == related_model.id))
+        columns.extend(getattr(related_model, field).label(
+            "%s_%s" % (relation, field)) for field in related_fields)
+
+    query = _paginate(query, model, limit, marker, marker_column)
+    statement = query.with_entities(*columns).statement
+    return query.session.execute(
+        statement.execution_options(**execution_options))
+
+
 def find_by(model, **kwargs):
     return _query_by(model, **kwargs).first()
 
 
-def save(model):
+def save(model, change_log=()):
     try:
         db_session = session.get_session()
-        model = db_session.merge(model)
-        db_session.flush()
+        with session.savepoint(db_session):
+            model = db_session.merge(model)
+            db_session.add_all(change_log)
+            db_session.flush()
         return model
     except sqlalchemy.exc.IntegrityError as error:
         raise exception.DBConstraintError(model_name=model.__class__.__name__,
                                           error=str(error.orig))
 
 
-def delete(model, db_session=None):
+def save_all(models, change_log=()):
+    """Inserts new models in one flush, batched into a single statement."""
+    try:
+        db_session = session.get_session()
+        with session.savepoint(db_session):
+            with db_session.begin(subtransactions=True):
+                db_session.add_all(models)
+                db_session.add_all(change_log)
+        return models
+    except sqlalchemy.exc.IntegrityError as error:
+        raise exception.DBConstraintError(
+            model_name=models[0].__class__.__name__, error=str(error.orig))
+
+
+def insert_all(model, values_list):
+    """Inserts a row for each of the values with one multi-row insert,
+    without building or validating models.
+
+    """
+    if not values_list:
+        return
+    try:
+        table = class_mapper(model).local_table
+        db_session = session.get_session()
+        with session.savepoint(db_session):
+            db_session.execute(table.insert(), values_list)
+    except sqlalchemy.exc.IntegrityError as error:
+        raise exception.DBConstraintError(model_name=model.__name__,
+                                          error=str(error.orig))
+
+
+def insert_natted_ips(values_list):
+    insert_all(mappers.IpNat, values_list)
+
+
+def insert_allowed_ips(values_list):
+    insert_all(mappers.AllowedIp, values_list)
+
+
+def iter_natted_ip_rows(fields):
+    return iter_rows_by_limit(_query_by, mappers.IpNat, {}, fields, {},
+                              limit=None)
+
+
+def iter_allowed_ip_rows(fields):
+    return iter_rows_by_limit(_query_by, mappers.AllowedIp, {}, fields, {},
+                              limit=None)
+
+
+def delete(model, db_session=None, change_log=()):
     db_session = db_session or session.get_session()
     model = db_session.merge(model)
     db_session.delete(model)
+    db_session.add_all(change_log)
     db_session.flush()
 
 
 def delete_all(query_func, model, **conditions):
-    query_func(model, **conditions).delete()
+    return query_func(model, **conditions).delete()
 
 
 def update(model, **values):
@@ -79,7 +214,11 @@ def update(model, **values):
 
 
 def update_all(query_func, model, conditions, values):
-    query_func(model, **conditions).update(values)
+    if hasattr(model, 'updated_at'):
+        # NOTE: keeps the versions of the updated rows changing, as a save
+        #       of each of them would
+        values = dict(values, updated_at=utils.utcnow())
+    return query_func(model, **conditions).update(values)
 
 
 def find_inside_globals(ip_model, local_address_id, **kwargs):
@@ -171,12 +310,41 @@ def find_all_top_level_blocks_in_network(network_id):
         filter(parent_block.id == id)
 
 
+def find_first_non_full_mac_range():
+    full = False
+    return _base_query(ipam.models.MacAddressRange).\
+        filter(ipam.models.MacAddressRange.is_full == full).\
+        order_by(ipam.models.MacAddressRange.created_at,
+                 ipam.models.MacAddressRange.id).first()
+
+
 def find_all_ips_in_network(model, network_id=None, **conditions):
     return _query_by(ipam.models.IpAddress, **conditions).\
         join(ipam.models.IpBlock).\
         filter(ipam.models.IpBlock.network_id == network_id)
 
 
+def find_changes_before(model, before_id=None, **conditions):
+    query = _query_by(model, **conditions)
+    if before_id is not None:
+        query = query.filter(model.id < before_id)
+    return query
+
+
+def recent_change_ids(model, created_after):
+    """The id of the last change created up to created_after, if any, and
+    the ids of the changes created after it in order.
+
+    """
+    last_id = _base_query(model).\
+        filter(model.created_at <= created_after).\
+        with_entities(func.max(model.id)).scalar()
+    recent_ids = [row[0] for row in _base_query(model).
+                  filter(model.created_at > created_after).
+                  with_entities(model.id).order_by(model.id)]
+    return last_id, recent_ids
+
+
 def find_all_allocated_ips(model, used_by_device=None, used_by_tenant=None,
                            **conditions):
     deallocated_on = None
@@ -195,9 +363,16 @@ def find_all_allocated_ips(model, used_by_device=None, used_by_tenant=None,
     return query
 
 
+def find_existing_addresses(address_model, addresses, **conditions):
+    query = _query_by(address_model, **conditions).\
+        filter(address_model.address.in_(addresses))
+    return set(row.address for row in query.with_entities(
+        address_model.address))
+
+
 def pop_allocatable_address(address_model, **conditions):
     db_session = session.get_session()
-    with db_session.begin():
+    with db_session.begin(subtransactions=True):
         address_rec = _query_by(
             address_model,
             db_session=db_session,
@@ -209,6 +384,57 @@ def pop_allocatable_address(address_model, **conditions):
         return address_rec.address
 
 
+def pop_allocatable_addresses(address_model, limit, **conditions):
+    db_session = session.get_session()
+    with db_session.begin(subtransactions=True):
+        address_recs = _query_by(
+            address_model,
+            db_session=db_session,
+            **conditions).with_lockmode('update').limit(limit).all()
+        for address_rec in address_recs:
+            db_session.delete(address_rec)
+        return [address_rec.address for address_rec in address_recs]
+
+
+def delete_allocatable_addresses(address_model, addresses, **conditions):
+    _query_by(address_model, **conditions).\
+        filter(address_model.address.in_(addresses)).\
+        delete(synchronize_session=False)
+
+
+def find_orphaned_mac_addresses():
+    interface = ipam.models.Interface
+    mac_address = ipam.models.MacAddress
+    id = None
+    return _base_query(mac_address).\
+        outerjoin((interface, mac_address.interface_id == interface.id)).\
+        filter(mac_address.interface_id != id).\
+        filter(interface.id == id)
+
+
+def find_orphaned_natted_ips():
+    ip_nat = mappers.IpNat
+    local_ip = aliased(ipam.models.IpAddress, name="local_ip")
+    global_ip = aliased(ipam.models.IpAddress, name="global_ip")
+    id = None
+    return _base_query(ip_nat).\
+        outerjoin((local_ip, ip_nat.inside_local_address_id == local_ip.id)).\
+        outerjoin((global_ip,
+                   ip_nat.inside_global_address_id == global_ip.id)).\
+        filter(or_(local_ip.id == id, global_ip.id == id))
+
+
+def delete_natted_ips(ids):
+    _base_query(mappers.IpNat).\
+        filter(mappers.IpNat.id.in_(ids)).\
+        delete(synchronize_session=False)
+
+
+def find_lowest_extent(extent_model, **conditions):
+    return _query_by(extent_model, **conditions).\
+        order_by(extent_model.first_address).first()
+
+
 def save_allowed_ip(interface_id, ip_address_id):
     allowed_ip = mappers.AllowedIp()
     update(allowed_ip,
@@ -237,6 +463,22 @@ def remove_allowed_ip(**conditions):
         delete()
 
 
+def unit_of_work(atomic=False):
+    return session.unit_of_work(atomic)
+
+
+def in_transaction():
+    return session.in_transaction()
+
+
+def snapshot():
+    return session.snapshot()
+
+
+def close_connections():
+    session.close_connections()
+
+
 def configure_db(options, *plugins):
     session.configure_db(options)
     configure_db_for_plugins(options, *plugins)
@@ -301,6 +543,10 @@ def _query_by(cls, db_session=None, **conditions):
 
 def _limits(query_func, model, conditions, limit, marker, marker_column=None):
     query = query_func(model, **conditions)
+    return _paginate(query, model, limit, marker, marker_column)
+
+
+def _paginate(query, model, limit, marker, marker_column=None):
     marker_column = marker_column or model.id
     if marker:
         query = query.filter(marker_column > marker)
@@ -47,6 +47,16 @@ def map(engine, models):
     orm.mapper(models["IpRoute"], ip_routes_table)
     orm.mapper(models["MacAddressRange"], mac_address_ranges_table)
     orm.mapper(models["MacAddress"], mac_addresses_table)
+    # NOTE: older migrations map the models before the changes and
+    #       tenant_offset_hints tables are created, so only map them once
+    #       they exist
+    if engine.has_table('changes'):
+        changes_table = Table('changes', meta, autoload=True)
+        orm.mapper(models["Change"], changes_table)
+    if engine.has_table('tenant_offset_hints'):
+        tenant_offset_hints_table = Table('tenant_offset_hints', meta,
+                                          autoload=True)
+        orm.mapper(models["TenantOffsetHint"], tenant_offset_hints_table)
 
     inside_global_join = (ip_nats_table.c.inside_global_address_id
                           == ip_addresses_table.c.id)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy.schema import Column
+from sqlalchemy.schema import Index
+from sqlalchemy.schema import MetaData
+
+from melange.db.sqlalchemy.migrate_repo.schema import create_tables
+from melange.db.sqlalchemy.migrate_repo.schema import DateTime
+from melange.db.sqlalchemy.migrate_repo.schema import drop_tables
+from melange.db.sqlalchemy.migrate_repo.schema import Integer
+from melange.db.sqlalchemy.migrate_repo.schema import String
+from melange.db.sqlalchemy.migrate_repo.schema import Table
+from melange.db.sqlalchemy.migrate_repo.schema import Text
+
+
+meta = MetaData()
+
+changes = Table(
+    'changes', meta,
+    Column('id', Integer(), primary_key=True, autoincrement=True),
+    Column('event', String(36), nullable=False),
+    Column('resource_type', String(36), nullable=False),
+    Column('resource_id', String(36), nullable=False),
+    Column('tenant_id', String(255)),
+    Column('payload', Text()),
+    Column('created_at', DateTime()),
+    Index('changes_tenant_id_idx', 'tenant_id', 'id'))
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    create_tables([changes])
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    drop_tables([changes])
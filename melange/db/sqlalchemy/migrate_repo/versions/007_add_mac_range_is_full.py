@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy.schema import Column
+from sqlalchemy.schema import Index
+from sqlalchemy.schema import MetaData
+from sqlalchemy.schema import Table
+
+from melange.db.sqlalchemy.migrate_repo.schema import Boolean
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    mac_address_ranges = Table('mac_address_ranges', meta, autoload=True)
+    is_full = Column('is_full', Boolean(), default=False)
+    mac_address_ranges.create_column(is_full)
+    mac_address_ranges.update().values(is_full=False).execute()
+    Index('mac_address_ranges_is_full_idx', mac_address_ranges.c.is_full,
+          mac_address_ranges.c.created_at, mac_address_ranges.c.id).create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    mac_address_ranges = Table('mac_address_ranges', meta, autoload=True)
+    Index('mac_address_ranges_is_full_idx', mac_address_ranges.c.is_full,
+          mac_address_ranges.c.created_at, mac_address_ranges.c.id).drop()
+    mac_address_ranges.drop_column('is_full')
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy.schema import Index
+from sqlalchemy.schema import MetaData
+from sqlalchemy.schema import Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    allocatable_ips = Table('allocatable_ips', meta, autoload=True)
+    seen = set()
+    duplicate_ids = []
+    for row in allocatable_ips.select().execute():
+        key = (row['ip_block_id'], row['address'])
+        if key in seen:
+            duplicate_ids.append(row['id'])
+        seen.add(key)
+    if duplicate_ids:
+        allocatable_ips.delete().where(
+            allocatable_ips.c.id.in_(duplicate_ids)).execute()
+    Index('allocatable_ips_ip_block_id_address_idx',
+          allocatable_ips.c.ip_block_id, allocatable_ips.c.address,
+          unique=True).create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    allocatable_ips = Table('allocatable_ips', meta, autoload=True)
+    Index('allocatable_ips_ip_block_id_address_idx',
+          allocatable_ips.c.ip_block_id, allocatable_ips.c.address,
+          unique=True).drop()
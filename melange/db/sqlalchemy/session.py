@@ -18,6 +18,7 @@
 import contextlib
 import logging
 import sqlalchemy as sql
+from eventlet import corolocal
 from sqlalchemy import create_engine
 from sqlalchemy import MetaData
 from sqlalchemy.exc import DisconnectionError
@@ -29,6 +30,7 @@ from melange.db.sqlalchemy import mappers
 
 _ENGINE = None
 _MAKER = None
+_LOCAL = corolocal.local()
 
 
 LOG = logging.getLogger('melange.db.sqlalchemy.session')
@@ -45,6 +47,15 @@ def configure_db(options, models_mapper=None):
         mappers.map(_ENGINE, ipam.models.persisted_models())
 
 
+def close_connections():
+    """Closes the pooled connections, so that processes forked afterwards
+    open their own instead of sharing the parent's.
+
+    """
+    if _ENGINE:
+        _ENGINE.dispose()
+
+
 def configure_sqlalchemy_log(options):
     debug = config.get_option(options, 'debug', type='bool', default=False)
     verbose = config.get_option(options, 'verbose', type='bool', default=False)
@@ -100,6 +111,10 @@ def _create_engine(options):
 def get_session(autocommit=True, expire_on_commit=False):
     """Helper method to grab session."""
 
+    unit_of_work_session = getattr(_LOCAL, 'session', None)
+    if unit_of_work_session is not None:
+        return unit_of_work_session
+
     global _MAKER, _ENGINE
     if not _MAKER:
         assert _ENGINE
@@ -109,6 +124,99 @@ def get_session(autocommit=True, expire_on_commit=False):
     return _MAKER()
 
 
+@contextlib.contextmanager
+def unit_of_work(atomic=False):
+    """Shares one session between all db calls the current green thread
+    makes within the block.
+
+    When atomic, the calls also share one transaction, which is committed
+    when the block exits and rolled back if it raises. An atomic block
+    nested in a unit of work begins a transaction of its own when the
+    outer one commits each write on its own, and takes a savepoint when
+    it runs in a transaction already.
+
+    """
+    db_session = getattr(_LOCAL, 'session', None)
+    if db_session is not None:
+        if not atomic:
+            yield db_session
+        elif _in_transaction(db_session):
+            with savepoint(db_session):
+                yield db_session
+        else:
+            with db_session.begin(subtransactions=True):
+                yield db_session
+        return
+
+    get_session()
+    db_session = _MAKER(autocommit=not atomic)
+    _LOCAL.session = db_session
+    try:
+        yield db_session
+        if atomic:
+            db_session.commit()
+    except Exception:
+        if atomic:
+            db_session.rollback()
+        raise
+    finally:
+        _LOCAL.session = None
+        db_session.close()
+
+
+@contextlib.contextmanager
+def savepoint(db_session):
+    """Rolls back only the writes of the block when it raises, instead of
+    the whole transaction of the atomic unit of work it runs in.
+
+    Sessions that commit each write on their own need no savepoint, and
+    none is taken on sqlite, whose python driver does not support them.
+
+    """
+    if (not _in_transaction(db_session)
+            or db_session.bind.dialect.name == "sqlite"):
+        yield
+        return
+    nested = db_session.begin_nested()
+    try:
+        yield
+    except Exception:
+        nested.rollback()
+        raise
+    nested.commit()
+
+
+def in_transaction():
+    """Whether the current green thread runs in the transaction of an
+    atomic unit of work.
+
+    """
+    db_session = getattr(_LOCAL, 'session', None)
+    return db_session is not None and _in_transaction(db_session)
+
+
+def _in_transaction(db_session):
+    return db_session.transaction is not None
+
+
+@contextlib.contextmanager
+def snapshot():
+    """An atomic unit of work whose reads all see the database as it was
+    when the first of them ran.
+
+    """
+    with unit_of_work(atomic=True) as db_session:
+        dialect = db_session.bind.dialect.name
+        if dialect == "mysql":
+            db_session.execute("SET TRANSACTION ISOLATION LEVEL "
+                               "REPEATABLE READ")
+            db_session.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+        elif dialect == "postgresql":
+            db_session.execute("SET TRANSACTION ISOLATION LEVEL "
+                               "REPEATABLE READ")
+        yield db_session
+
+
 def raw_query(model, autocommit=True, expire_on_commit=False):
     return get_session(autocommit, expire_on_commit).query(model)
 
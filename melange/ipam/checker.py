@@ -0,0 +1,229 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Checks of the invariants allocation relies on, with their repair.
+
+Blocks are checked in batches spread over a pool of processes. Each block's
+allocated addresses and the free addresses its generator hands out first
+are read in address order and joined as sorted arrays. Records left behind
+by deleted interfaces and addresses are found with an outer join each.
+MAC address ranges, being few, are checked in this process.
+
+"""
+
+import collections
+import itertools
+import logging
+import multiprocessing
+
+from melange import ipv4
+from melange import mac
+from melange.common import address_codec
+from melange.common import utils
+from melange.db import db_api
+from melange.ipam import models
+
+
+LOG = logging.getLogger('melange.ipam.checker')
+
+
+Inconsistency = collections.namedtuple(
+    'Inconsistency', ['resource_type', 'resource_id', 'problem'])
+
+
+class Checker(object):
+
+    def __init__(self, workers=1, batch_size=100, repair=False):
+        self.workers = int(workers)
+        self.batch_size = int(batch_size)
+        self.repair = repair
+        self.inconsistencies = []
+
+    def check(self):
+        """Finds the inconsistencies, repairing them when asked to, and
+        returns them.
+
+        """
+        block_ids = [row['id'] for row
+                     in models.IpBlock.find_all().iter_rows(['id'],
+                                                            limit=None)]
+        batches = [(batch, self.repair)
+                   for batch in utils.chunks(block_ids, self.batch_size)]
+        for inconsistencies in self._map(_check_blocks, batches):
+            self.inconsistencies.extend(inconsistencies)
+        self._check_mac_address_ranges()
+        self._check_orphaned_mac_addresses()
+        self._check_orphaned_natted_ips()
+        return self.inconsistencies
+
+    def report(self):
+        lines = [_("%(resource_type)s %(resource_id)s: %(problem)s")
+                 % inconsistency._asdict()
+                 for inconsistency in self.inconsistencies]
+        done = _("repaired") if self.repair else _("found")
+        lines.append(_("%(count)d inconsistencies %(done)s")
+                     % dict(count=len(self.inconsistencies), done=done))
+        return lines
+
+    def _map(self, func, batches):
+        if self.workers <= 1 or len(batches) <= 1:
+            return itertools.imap(func, batches)
+        # NOTE: forked workers would otherwise share the connections
+        #       pooled by this process
+        db_api.close_connections()
+        pool = multiprocessing.Pool(min(self.workers, len(batches)))
+        try:
+            return pool.map(func, batches)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _check_mac_address_ranges(self):
+        mac_ranges = models.MacAddressRange.find_all().all()
+        for batch in utils.chunks(mac_ranges, self.batch_size):
+            with db_api.unit_of_work(atomic=self.repair):
+                for mac_range in batch:
+                    for problem in _check_mac_range(mac_range, self.repair):
+                        self._found('mac_address_range', mac_range.id,
+                                    problem)
+
+    def _check_orphaned_mac_addresses(self):
+        orphans = db_api.find_orphaned_mac_addresses().all()
+        for mac_address in orphans:
+            self._found('mac_address', mac_address.id,
+                        _("interface %s does not exist")
+                        % mac_address.interface_id)
+        if self.repair:
+            for batch in utils.chunks(orphans, self.batch_size):
+                with db_api.unit_of_work(atomic=True):
+                    for mac_address in batch:
+                        mac_address.delete()
+
+    def _check_orphaned_natted_ips(self):
+        orphan_ids = []
+        for ip_nat in db_api.find_orphaned_natted_ips():
+            self._found('ip_nat', ip_nat.id,
+                        _("ip address %(local)s or %(global)s does not "
+                          "exist")
+                        % {'local': ip_nat.inside_local_address_id,
+                           'global': ip_nat.inside_global_address_id})
+            orphan_ids.append(ip_nat.id)
+        if self.repair:
+            for batch in utils.chunks(orphan_ids, self.batch_size):
+                with db_api.unit_of_work(atomic=True):
+                    db_api.delete_natted_ips(batch)
+
+    def _found(self, resource_type, resource_id, problem):
+        LOG.warn("%s %s: %s" % (resource_type, resource_id, problem))
+        self.inconsistencies.append(
+            Inconsistency(resource_type, resource_id, problem))
+
+
+def _check_blocks(batch):
+    """The inconsistencies of a batch of blocks, repaired in one transaction
+    when asked to.
+
+    """
+    block_ids, repair = batch
+    inconsistencies = []
+    with db_api.unit_of_work(atomic=repair):
+        for block_id in block_ids:
+            block = models.IpBlock.get(block_id)
+            if block is None or block.is_ipv6():
+                continue
+            for problem in _check_block(block, repair):
+                LOG.warn("ip_block %s: %s" % (block_id, problem))
+                inconsistencies.append(
+                    Inconsistency('ip_block', block_id, problem))
+    return inconsistencies
+
+
+def _check_block(block, repair):
+    geometry = block.geometry()
+    generator = ipv4.plugin().get_generator(block)
+    free_count = 0
+    if hasattr(generator, "allocatable_addresses"):
+        allocated = sorted(
+            address_codec.parse_ip(row['address'])[1] for row
+            in models.IpAddress.find_all(ip_block_id=block.id).iter_rows(
+                ['address'], limit=None))
+        free = sorted((address_codec.parse_ip(address)[1], address)
+                      for address in generator.allocatable_addresses())
+        taken = list(_allocated_free_addresses(allocated, free))
+        if taken:
+            yield (_("free addresses %s are allocated")
+                   % ", ".join(sorted(set(taken))))
+            if repair:
+                generator.remove_allocatable_addresses(taken)
+        free_count = len(free) - len(taken)
+
+    counter = block.allocatable_ip_counter
+    if counter is not None and counter > geometry.last + 1:
+        yield _("allocatable ip counter is past the end of the block")
+        if repair:
+            counter = geometry.last + 1
+            block.update(allocatable_ip_counter=counter)
+
+    exhausted = counter is not None and counter > geometry.last
+    if (exhausted and not free_count
+            and hasattr(generator, "unallocated_addresses")):
+        lost_count = sum(1 for address in generator.unallocated_addresses())
+        if lost_count:
+            yield (_("%d free addresses are missing from the allocatable "
+                     "list") % lost_count)
+            if repair:
+                generator.recover_free_addresses()
+            free_count = lost_count
+
+    if block.is_full and (free_count or not exhausted):
+        yield _("block is marked full but has free addresses")
+        if repair:
+            block.update(is_full=False)
+
+
+def _check_mac_range(mac_range, repair):
+    last_address = mac_range.last_address()
+    next_address = mac_range.next_address
+    if next_address is not None and next_address > last_address + 1:
+        yield _("next address is past the end of the range")
+        if repair:
+            mac_range.update(next_address=last_address + 1)
+
+    generator = mac.plugin().get_generator(mac_range)
+    has_free_addresses = (not generator.is_full()
+                          or (hasattr(generator, "allocatable_addresses")
+                              and bool(generator.allocatable_addresses())))
+    if mac_range.is_full and has_free_addresses:
+        yield _("range is marked full but has free addresses")
+        if repair:
+            mac_range.update(is_full=False)
+
+
+def _allocated_free_addresses(allocated, free):
+    """The free addresses that are allocated too, joining the sorted
+    address values with the sorted (value, address) pairs.
+
+    """
+    allocated = iter(allocated)
+    current = next(allocated, None)
+    for value, address in free:
+        while current is not None and current < value:
+            current = next(allocated, None)
+        if current is None:
+            return
+        if current == value:
+            yield address
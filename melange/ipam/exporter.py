@@ -0,0 +1,179 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Snapshots of the whole ipam state, in the records the importer reads.
+
+Every table is read off a server side cursor within one repeatable read
+transaction, so the records are consistent with each other however long
+the export takes, and only blocks waiting for their parent are held in
+memory. Records are written in the order the importer needs them, parents
+before children.
+
+"""
+
+import collections
+import datetime
+import json
+import logging
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from melange.common import exception
+from melange.db import db_api
+from melange.ipam import importer
+from melange.ipam import models
+
+
+LOG = logging.getLogger('melange.ipam.exporter')
+
+
+class Exporter(object):
+
+    record_types = importer.Importer.record_types
+
+    _models = {
+        'policy': models.Policy,
+        'ip_range': models.IpRange,
+        'ip_octet': models.IpOctet,
+        'ip_block': models.IpBlock,
+        'ip_route': models.IpRoute,
+        'mac_address_range': models.MacAddressRange,
+        'interface': models.Interface,
+        'mac_address': models.MacAddress,
+        'ip_address': models.IpAddress,
+    }
+
+    _columns = {
+        'policy': ['id', 'name', 'tenant_id', 'description'],
+        'ip_range': ['id', 'policy_id', 'offset', 'length'],
+        'ip_octet': ['id', 'policy_id', 'octet'],
+        'ip_block': ['id', 'cidr', 'type', 'tenant_id', 'network_id',
+                     'network_name', 'parent_id', 'policy_id', 'gateway',
+                     'dns1', 'dns2', 'omg_do_not_use',
+                     'allocatable_ip_counter'],
+        'ip_route': ['id', 'source_block_id', 'destination', 'netmask',
+                     'gateway'],
+        'mac_address_range': ['id', 'cidr', 'next_address'],
+        'interface': ['id', 'vif_id_on_device', 'device_id', 'tenant_id'],
+        'mac_address': ['id', 'address', 'mac_address_range_id',
+                        'interface_id'],
+        'ip_address': ['id', 'address', 'ip_block_id', 'interface_id',
+                       'used_by_tenant_id', 'marked_for_deallocation',
+                       'deallocated_at'],
+        'ip_nat': ['id', 'inside_local_address_id',
+                   'inside_global_address_id'],
+        'allowed_ip': ['id', 'ip_address_id', 'interface_id'],
+    }
+
+    _untimestamped_types = ['allowed_ip']
+
+    # NOTE: columns named differently in records, as they are in the api
+    _record_fields = {
+        'vif_id_on_device': 'virtual_interface_id',
+    }
+
+    formats = ["jsonl", "msgpack"]
+
+    def __init__(self, stream, format="jsonl"):
+        if format not in self.formats:
+            raise exception.InvalidParamError(value=format, param="format")
+        if format == "msgpack" and msgpack is None:
+            raise exception.MelangeError(_("msgpack is not installed"))
+        self.counts = collections.defaultdict(int)
+        self.elapsed = 0.0
+        self._stream = stream
+        self._format = format
+
+    def dump(self):
+        started_at = time.time()
+        try:
+            with db_api.snapshot():
+                for record_type in self.record_types:
+                    for record in self._records(record_type):
+                        self._write(record)
+                        self.counts[record_type] += 1
+                    LOG.info("Exported %d %s records"
+                             % (self.counts[record_type], record_type))
+        finally:
+            self.elapsed += time.time() - started_at
+
+    def report(self):
+        return importer.throughput_report(self.record_types, self.counts,
+                                          self.elapsed, _("exported"))
+
+    def _records(self, record_type):
+        if record_type == 'ip_block':
+            return self._parents_first(self._table_records('ip_block'))
+        return self._table_records(record_type)
+
+    def _table_records(self, record_type):
+        columns = self._columns[record_type]
+        if record_type not in self._untimestamped_types:
+            columns = columns + ['created_at', 'updated_at']
+        if record_type == 'ip_nat':
+            rows = db_api.iter_natted_ip_rows(columns)
+        elif record_type == 'allowed_ip':
+            rows = db_api.iter_allowed_ip_rows(columns)
+        else:
+            rows = self._models[record_type].find_all().iter_rows(
+                columns, limit=None)
+        for row in rows:
+            record = dict(resource_type=record_type)
+            for column in columns:
+                if row[column] is not None:
+                    field = self._record_fields.get(column, column)
+                    record[field] = _serializable(row[column])
+            yield record
+
+    def _parents_first(self, blocks):
+        """Holds back the blocks read before their parent until it is
+        written.
+
+        """
+        written = set()
+        waiting = collections.defaultdict(list)
+        for block in blocks:
+            parent_id = block.get('parent_id')
+            if parent_id is not None and parent_id not in written:
+                waiting[parent_id].append(block)
+                continue
+            pending = [block]
+            while pending:
+                block = pending.pop()
+                written.add(block['id'])
+                yield block
+                pending.extend(waiting.pop(block['id'], []))
+        for orphans in waiting.itervalues():
+            for block in orphans:
+                yield block
+
+    def _write(self, record):
+        if self._format == "msgpack":
+            self._stream.write(msgpack.packb(record))
+        else:
+            self._stream.write(json.dumps(record, separators=(',', ':')))
+            self._stream.write("\n")
+
+
+def _serializable(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
@@ -0,0 +1,650 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Bulk import of ipam records, for migrating from another ipam.
+
+Records are read from JSON lines, msgpack or CSV, each naming its kind
+in a 'resource_type' field, as in the change log: policy, ip_range,
+ip_octet, ip_block, ip_route, mac_address_range, interface, mac_address,
+ip_address, ip_nat or allowed_ip. A record has to come after the records
+it refers to, as parents come before children in a dump.
+
+Records are validated as a set instead of one model at a time: references
+are resolved against the ids already in the database or imported before
+them, and blocks are checked for overlaps by sweeping the sorted cidrs of
+each network, parent block and the public blocks once. Valid records are
+written with multi-row inserts, chunk_size records per transaction, and
+without notifications. The transaction of a chunk of addresses also moves
+the allocatable_ip_counter of their blocks and the next_address of their
+mac ranges past the highest address imported, so generators never hand
+out an imported address.
+
+"""
+
+import collections
+import csv
+import datetime
+import itertools
+import json
+import logging
+import time
+
+import netaddr
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from melange.common import address_codec
+from melange.common import config
+from melange.common import exception
+from melange.common import utils
+from melange.db import db_api
+from melange.ipam import models
+
+
+LOG = logging.getLogger('melange.ipam.importer')
+
+
+_Block = collections.namedtuple(
+    '_Block', ['cidr', 'geometry', 'type', 'network_id', 'parent_id', 'new'])
+
+_Interface = collections.namedtuple(
+    '_Interface', ['tenant_id', 'virtual_interface_id', 'device_id'])
+
+
+class Importer(object):
+
+    record_types = ['policy', 'ip_range', 'ip_octet', 'ip_block',
+                    'ip_route', 'mac_address_range', 'interface',
+                    'mac_address', 'ip_address', 'ip_nat', 'allowed_ip']
+
+    _models = {
+        'policy': models.Policy,
+        'ip_range': models.IpRange,
+        'ip_octet': models.IpOctet,
+        'ip_block': models.IpBlock,
+        'ip_route': models.IpRoute,
+        'mac_address_range': models.MacAddressRange,
+        'interface': models.Interface,
+        'mac_address': models.MacAddress,
+        'ip_address': models.IpAddress,
+    }
+
+    _fields = {
+        'policy': ['id', 'name', 'tenant_id', 'description'],
+        'ip_range': ['id', 'policy_id', 'offset', 'length'],
+        'ip_octet': ['id', 'policy_id', 'octet'],
+        'ip_block': ['id', 'cidr', 'type', 'tenant_id', 'network_id',
+                     'network_name', 'parent_id', 'policy_id', 'gateway',
+                     'dns1', 'dns2', 'omg_do_not_use',
+                     'allocatable_ip_counter'],
+        'ip_route': ['id', 'source_block_id', 'destination', 'netmask',
+                     'gateway'],
+        'mac_address_range': ['id', 'cidr', 'next_address'],
+        'interface': ['id', 'virtual_interface_id', 'device_id',
+                      'tenant_id'],
+        'mac_address': ['id', 'address', 'mac_address_range_id',
+                        'interface_id'],
+        'ip_address': ['id', 'address', 'ip_block_id', 'interface_id',
+                       'used_by_tenant_id', 'marked_for_deallocation',
+                       'deallocated_at'],
+        'ip_nat': ['id', 'inside_local_address_id',
+                   'inside_global_address_id'],
+        'allowed_ip': ['id', 'ip_address_id', 'interface_id'],
+    }
+
+    _untimestamped_types = ['allowed_ip']
+
+    def __init__(self, chunk_size=1000):
+        self.chunk_size = int(chunk_size)
+        self.counts = collections.defaultdict(int)
+        self.elapsed = 0.0
+        self._policy_ids = set()
+        self._blocks = {}
+        self._subnetted_block_ids = set()
+        self._blocks_with_ips = set()
+        self._network_types = {}
+        self._ip_counters = {}
+        self._mac_ranges = {}
+        self._mac_counters = {}
+        self._interfaces = {}
+        self._virtual_interface_ids = set()
+        self._loaded_existing = False
+
+    def load(self, records):
+        """Imports (line number, record) pairs, stopping at the first chunk
+        with invalid records. Chunks imported before it stay imported.
+
+        """
+        started_at = time.time()
+        try:
+            self._load_existing()
+            runs = itertools.groupby(
+                records, lambda numbered: numbered[1].get('resource_type'))
+            for record_type, run in runs:
+                if record_type not in self.record_types:
+                    line_number = next(run)[0]
+                    raise InvalidRecordsError(errors=[
+                        _("line %(line)s: unknown resource_type %(type)s")
+                        % dict(line=line_number, type=record_type)])
+                if record_type == 'ip_block':
+                    self._load_blocks(list(run))
+                    continue
+                for chunk in utils.chunks(run, self.chunk_size):
+                    self._load_chunk(record_type, chunk)
+        finally:
+            self.elapsed += time.time() - started_at
+
+    def report(self):
+        return throughput_report(self.record_types, self.counts,
+                                 self.elapsed, _("imported"))
+
+    def _load_existing(self):
+        if self._loaded_existing:
+            return
+        for row in _all_rows(models.Policy, ['id']):
+            self._policy_ids.add(row['id'])
+        for row in _all_rows(models.IpBlock,
+                             ['id', 'cidr', 'type', 'network_id', 'parent_id',
+                              'allocatable_ip_counter']):
+            self._add_block(row, new=False)
+            self._ip_counters[row['id']] = row['allocatable_ip_counter']
+        for row in _all_rows(models.MacAddressRange,
+                             ['id', 'cidr', 'next_address']):
+            self._mac_ranges[row['id']] = models.MacAddressRange(
+                cidr=row['cidr'])
+            self._mac_counters[row['id']] = row['next_address']
+        for row in _all_rows(models.Interface,
+                             ['id', 'tenant_id', 'vif_id_on_device',
+                              'device_id']):
+            self._add_interface(row)
+        self._loaded_existing = True
+
+    def _load_chunk(self, record_type, numbered_records):
+        self._insert(record_type,
+                     self._checked_rows(record_type, numbered_records),
+                     _line_span(numbered_records))
+
+    def _load_blocks(self, numbered_records):
+        """Checks a run of blocks for overlaps as a whole before inserting
+        any of it.
+
+        """
+        rows = self._checked_rows('ip_block', numbered_records,
+                                  self._overlaps)
+        for chunk in utils.chunks(rows, self.chunk_size):
+            self._insert('ip_block', chunk, _line_span(numbered_records))
+
+    def _checked_rows(self, record_type, numbered_records,
+                      set_check=lambda: []):
+        rows = []
+        errors = []
+        check = getattr(self, "_check_%s" % record_type)
+        for line_number, record in numbered_records:
+            try:
+                row = self._row(record_type, record)
+                check(row)
+            except InvalidRecordError as error:
+                errors.append(_("line %(line)s: %(error)s")
+                              % dict(line=line_number, error=error))
+                continue
+            rows.append(row)
+        errors.extend(set_check())
+        if errors:
+            raise InvalidRecordsError(errors=errors)
+        return rows
+
+    def _row(self, record_type, record):
+        fields = self._fields[record_type]
+        timestamped = record_type not in self._untimestamped_types
+        if timestamped:
+            fields = fields + ['created_at', 'updated_at']
+        unknown_fields = set(record) - set(fields) - set(['resource_type'])
+        if unknown_fields:
+            raise InvalidRecordError(_("unknown fields %s")
+                                     % ", ".join(sorted(unknown_fields)))
+        row = dict((field, record.get(field)) for field in fields)
+        row['id'] = row['id'] or utils.generate_uuid()
+        if timestamped:
+            now = utils.utcnow()
+            row['created_at'] = _timestamp(row, 'created_at') or now
+            row['updated_at'] = _timestamp(row, 'updated_at') or now
+        return row
+
+    def _insert(self, record_type, rows, lines):
+        try:
+            with db_api.unit_of_work(atomic=True):
+                self._insert_rows(record_type, rows)
+                if record_type == 'ip_address':
+                    self._advance_ip_counters(rows)
+                if record_type == 'mac_address':
+                    self._advance_mac_counters(rows)
+        except exception.DBConstraintError as error:
+            # NOTE: duplicates of rows in the database or in earlier chunks
+            #       are left to the unique constraints to find
+            raise InvalidRecordsError(errors=[
+                _("lines %(lines)s: %(error)s")
+                % dict(lines=lines, error=error)])
+        self.counts[record_type] += len(rows)
+        LOG.info("Imported %d %s records" % (len(rows), record_type))
+
+    def _insert_rows(self, record_type, rows):
+        if record_type == 'ip_nat':
+            return db_api.insert_natted_ips(rows)
+        if record_type == 'allowed_ip':
+            return db_api.insert_allowed_ips(rows)
+        model = self._models[record_type]
+        db_api.insert_all(model, rows)
+        if model.change_log_fields:
+            db_api.insert_all(models.Change,
+                              [getattr(self, "_%s_change" % record_type)(row)
+                               for row in rows])
+
+    def _check_policy(self, row):
+        _require(row, 'name', 'tenant_id')
+        self._policy_ids.add(row['id'])
+
+    def _check_ip_range(self, row):
+        self._check_policy_exists(row['policy_id'])
+        row['offset'] = _integer(row, 'offset')
+        row['length'] = _integer(row, 'length')
+        if row['length'] < 0:
+            raise InvalidRecordError(_("length should be a positive integer"))
+
+    def _check_ip_octet(self, row):
+        self._check_policy_exists(row['policy_id'])
+        row['octet'] = _integer(row, 'octet')
+
+    def _check_policy_exists(self, policy_id):
+        if policy_id not in self._policy_ids:
+            raise InvalidRecordError(_("policy %s not found") % policy_id)
+
+    def _check_ip_block(self, row):
+        _require(row, 'cidr', 'tenant_id')
+        if row['type'] not in models.IpBlock._allowed_block_types:
+            raise InvalidRecordError(
+                _("type should be one among %s")
+                % ", ".join(models.IpBlock._allowed_block_types))
+        try:
+            row['cidr'] = str(netaddr.IPNetwork(row['cidr']).cidr)
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            raise InvalidRecordError(_("cidr is invalid"))
+        geometry = models.BlockGeometry.of(row['cidr'])
+        if row['policy_id'] is not None:
+            self._check_policy_exists(row['policy_id'])
+        if row['gateway'] is not None:
+            try:
+                address_codec.parse_ip(row['gateway'])
+            except (netaddr.AddrFormatError, ValueError, TypeError):
+                raise InvalidRecordError(_("Gateway is not a valid address"))
+        if row['parent_id'] is not None:
+            self._check_parent(row, geometry)
+        network_type = self._network_types.get(row['network_id'])
+        if network_type is not None and network_type != row['type']:
+            raise InvalidRecordError(_("type should be same within a "
+                                       "network"))
+        row['omg_do_not_use'] = _boolean(row['omg_do_not_use'])
+        row['dns1'] = row['dns1'] or config.Config.get("dns1")
+        row['dns2'] = row['dns2'] or config.Config.get("dns2")
+        row['is_full'] = False
+        row['allocatable_ip_counter'] = _optional_integer(
+            row, 'allocatable_ip_counter')
+        self._add_block(row, new=True)
+        self._ip_counters[row['id']] = row['allocatable_ip_counter']
+
+    def _check_parent(self, row, geometry):
+        parent = self._blocks.get(row['parent_id'])
+        if parent is None or parent.type != row['type']:
+            raise InvalidRecordError(_("parent block %s not found")
+                                     % row['parent_id'])
+        if not parent.geometry.includes(geometry):
+            raise InvalidRecordError(_("cidr should be within parent "
+                                       "block's cidr"))
+        if parent.network_id and parent.network_id != row['network_id']:
+            raise InvalidRecordError(_("network_id should be same as that "
+                                       "of parent"))
+        if self._holds_ips(row['parent_id']):
+            raise InvalidRecordError(_("parent is not subnettable since it "
+                                       "has allocated ips"))
+
+    def _holds_ips(self, block_id):
+        if block_id in self._blocks_with_ips:
+            return True
+        if self._blocks[block_id].new:
+            return False
+        if models.IpAddress.get_by(ip_block_id=block_id) is not None:
+            self._blocks_with_ips.add(block_id)
+            return True
+        return False
+
+    def _add_block(self, row, new):
+        geometry = models.BlockGeometry.of(row['cidr'])
+        self._blocks[row['id']] = _Block(row['cidr'], geometry, row['type'],
+                                         row['network_id'], row['parent_id'],
+                                         new)
+        if row['parent_id'] is not None:
+            self._subnetted_block_ids.add(row['parent_id'])
+        if row['network_id'] is not None:
+            self._network_types.setdefault(row['network_id'], row['type'])
+
+    def _overlaps(self):
+        """Errors for the new blocks that overlap another block they must
+        not overlap, found with one sweep over each scope's sorted cidrs.
+
+        """
+        scopes = collections.defaultdict(list)
+        for block in self._blocks.itervalues():
+            for scope in self._overlap_scopes(block):
+                scopes[scope].append(block)
+
+        errors = []
+        for blocks in scopes.itervalues():
+            blocks.sort(key=lambda block: (block.geometry.version,
+                                           block.geometry.first,
+                                           -block.geometry.last))
+            widest = None
+            for block in blocks:
+                if (widest is not None
+                        and widest.geometry.version == block.geometry.version
+                        and block.geometry.first <= widest.geometry.last):
+                    if block.new or widest.new:
+                        errors.append(_("cidr %(cidr)s overlaps with block "
+                                        "%(other)s")
+                                      % dict(cidr=block.cidr,
+                                             other=widest.cidr))
+                    if block.geometry.last <= widest.geometry.last:
+                        continue
+                widest = block
+        return errors
+
+    def _overlap_scopes(self, block):
+        parent = self._blocks.get(block.parent_id)
+        if parent is not None:
+            yield ('siblings', block.parent_id)
+        if block.network_id and (parent is None
+                                 or parent.network_id != block.network_id):
+            yield ('network', block.network_id)
+        if parent is None and block.type == models.IpBlock.PUBLIC_TYPE:
+            yield ('public',)
+
+    def _check_mac_address_range(self, row):
+        _require(row, 'cidr')
+        mac_range = models.MacAddressRange(cidr=row['cidr'])
+        try:
+            mac_range.first_address()
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            raise InvalidRecordError(_("cidr is invalid"))
+        row['next_address'] = _optional_integer(row, 'next_address')
+        row['is_full'] = False
+        self._mac_ranges[row['id']] = mac_range
+        self._mac_counters[row['id']] = row['next_address']
+
+    def _check_interface(self, row):
+        _require(row, 'tenant_id')
+        row['vif_id_on_device'] = row.pop('virtual_interface_id')
+        if row['vif_id_on_device'] is not None:
+            if row['vif_id_on_device'] in self._virtual_interface_ids:
+                raise InvalidRecordError(_("Virtual Interface %s already "
+                                           "exists")
+                                         % row['vif_id_on_device'])
+        self._add_interface(row)
+
+    def _add_interface(self, row):
+        self._interfaces[row['id']] = _Interface(
+            row['tenant_id'],
+            row['vif_id_on_device'] or row['id'],
+            row['device_id'])
+        if row['vif_id_on_device'] is not None:
+            self._virtual_interface_ids.add(row['vif_id_on_device'])
+
+    def _check_interface_exists(self, interface_id):
+        if interface_id is not None and interface_id not in self._interfaces:
+            raise InvalidRecordError(_("interface %s not found")
+                                     % interface_id)
+
+    def _check_mac_address(self, row):
+        self._check_interface_exists(row['interface_id'])
+        mac_range = self._mac_ranges.get(row['mac_address_range_id'])
+        if mac_range is None:
+            raise InvalidRecordError(_("mac address range %s not found")
+                                     % row['mac_address_range_id'])
+        try:
+            row['address'] = address_codec.mac_value(row['address'])
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            raise InvalidRecordError(_("address is invalid"))
+        if not mac_range.contains(row['address']):
+            raise InvalidRecordError(_("address does not belong to range"))
+
+    def _check_ip_address(self, row):
+        self._check_interface_exists(row['interface_id'])
+        block = self._blocks.get(row['ip_block_id'])
+        if block is None:
+            raise InvalidRecordError(_("ip block %s not found")
+                                     % row['ip_block_id'])
+        if row['ip_block_id'] in self._subnetted_block_ids:
+            raise InvalidRecordError(_("Subnetted block cannot allocate "
+                                       "IPAddress"))
+        try:
+            row['address'] = address_codec.canonical_ip(row['address'])
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            raise InvalidRecordError(_("address is invalid"))
+        if not block.geometry.contains(row['address']):
+            raise InvalidRecordError(_("Address does not belong to "
+                                       "IpBlock"))
+        if row['used_by_tenant_id'] is None and row['interface_id']:
+            row['used_by_tenant_id'] = self._interfaces[
+                row['interface_id']].tenant_id
+        _require(row, 'used_by_tenant_id')
+        row['marked_for_deallocation'] = _boolean(
+            row['marked_for_deallocation'])
+        row['deallocated_at'] = _timestamp(row, 'deallocated_at')
+        if row['marked_for_deallocation'] and not row['deallocated_at']:
+            row['deallocated_at'] = row['created_at']
+        self._blocks_with_ips.add(row['ip_block_id'])
+
+    def _check_ip_route(self, row):
+        _require(row, 'destination', 'gateway')
+        if row['source_block_id'] not in self._blocks:
+            raise InvalidRecordError(_("ip block %s not found")
+                                     % row['source_block_id'])
+
+    def _check_ip_nat(self, row):
+        self._check_ip_exists(row['inside_local_address_id'])
+        self._check_ip_exists(row['inside_global_address_id'])
+
+    def _check_allowed_ip(self, row):
+        self._check_ip_exists(row['ip_address_id'])
+        _require(row, 'interface_id')
+        self._check_interface_exists(row['interface_id'])
+
+    def _check_ip_exists(self, ip_address_id):
+        # NOTE: natted and allowed ips are few, so the ips they refer to
+        #       are looked up instead of remembering every imported ip
+        if models.IpAddress.get_by(id=ip_address_id) is None:
+            raise InvalidRecordError(_("ip address %s not found")
+                                     % ip_address_id)
+
+    def _advance_ip_counters(self, rows):
+        highest = {}
+        for row in rows:
+            version, value = address_codec.parse_ip(row['address'])
+            if version == 4:
+                block_id = row['ip_block_id']
+                highest[block_id] = max(highest.get(block_id, value), value)
+        for block_id, value in highest.iteritems():
+            counter = (self._ip_counters.get(block_id)
+                       or self._blocks[block_id].geometry.first)
+            if value >= counter:
+                self._ip_counters[block_id] = value + 1
+                models.IpBlock.find_all(id=block_id).update(
+                    allocatable_ip_counter=value + 1)
+
+    def _advance_mac_counters(self, rows):
+        highest = {}
+        for row in rows:
+            range_id = row['mac_address_range_id']
+            highest[range_id] = max(highest.get(range_id, row['address']),
+                                    row['address'])
+        for range_id, value in highest.iteritems():
+            counter = (self._mac_counters.get(range_id)
+                       or self._mac_ranges[range_id].first_address())
+            if value >= counter:
+                self._mac_counters[range_id] = value + 1
+                models.MacAddressRange.find_all(id=range_id).update(
+                    next_address=value + 1)
+
+    def _ip_block_change(self, row):
+        return _change(models.IpBlock, 'create', row, row['tenant_id'])
+
+    def _interface_change(self, row):
+        return _change(models.Interface, 'create', row, row['tenant_id'],
+                       virtual_interface_id=row['vif_id_on_device']
+                       or row['id'])
+
+    def _ip_address_change(self, row):
+        interface = self._interfaces.get(row['interface_id'])
+        return _change(models.IpAddress, 'allocate', row,
+                       row['used_by_tenant_id'],
+                       marked_for_deallocation=row['marked_for_deallocation'],
+                       interface_id=(interface.virtual_interface_id
+                                     if interface else None),
+                       used_by_device_id=(interface.device_id
+                                          if interface else None))
+
+
+def read_records(stream, format="jsonl"):
+    """Yields (line number, record) pairs read from JSON lines, msgpack, or
+    CSV with a header row. Empty CSV cells are left out of the records, and
+    msgpack records are numbered in place of lines.
+
+    """
+    if format == "msgpack":
+        unpacker = msgpack.Unpacker(stream, raw=False)
+        for record_number, record in enumerate(unpacker, 1):
+            yield record_number, record
+        return
+
+    if format == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, dict((field, value) for field, value
+                                        in record.iteritems() if value)
+        return
+
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as error:
+            raise InvalidRecordsError(errors=[
+                _("line %(line)s: %(error)s")
+                % dict(line=line_number, error=error)])
+
+
+def throughput_report(record_types, counts, elapsed, done):
+    """A line per record type with a count, with its throughput."""
+    seconds = max(elapsed, 0.001)
+    lines = [_("%(type)s: %(count)d records (%(rate).0f/s)")
+             % dict(type=record_type, count=counts[record_type],
+                    rate=counts[record_type] / seconds)
+             for record_type in record_types if counts[record_type]]
+    total = sum(counts.values())
+    lines.append(_("%(done)s %(total)d records in %(elapsed).1fs "
+                   "(%(rate).0f/s)")
+                 % dict(done=done, total=total, elapsed=elapsed,
+                        rate=total / seconds))
+    return lines
+
+
+def _change(model, event, row, tenant_id, **payload):
+    for field in model.change_log_fields:
+        payload.setdefault(field, row.get(field))
+    return dict(event=event,
+                resource_type=utils.underscore(model.__name__),
+                resource_id=row['id'],
+                tenant_id=tenant_id,
+                payload=json.dumps(payload),
+                created_at=row['created_at'])
+
+
+def _all_rows(model, fields, page_size=1000):
+    marker = None
+    while True:
+        rows = model.find_all().rows(fields, limit=page_size, marker=marker)
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        marker = rows[-1]['id']
+
+
+def _line_span(numbered_records):
+    return "%s-%s" % (numbered_records[0][0], numbered_records[-1][0])
+
+
+def _require(row, *fields):
+    for field in fields:
+        if row.get(field) in (None, ""):
+            raise InvalidRecordError(_("%s should be present") % field)
+
+
+def _optional_integer(row, field):
+    if row[field] is None:
+        return None
+    return _integer(row, field)
+
+
+def _timestamp(row, field):
+    value = row[field]
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        timestamp = utils.normalize_time(utils.parse_isotime(value))
+        return timestamp.replace(tzinfo=None)
+    except ValueError:
+        raise InvalidRecordError(_("%s should be an ISO 8601 time") % field)
+
+
+def _integer(row, field):
+    value = utils.parse_int(row[field])
+    if value is None:
+        raise InvalidRecordError(_("%s should be an integer") % field)
+    return value
+
+
+def _boolean(value):
+    if isinstance(value, basestring):
+        return utils.bool_from_string(value)
+    return bool(value)
+
+
+class InvalidRecordError(exception.MelangeError):
+
+    message = _("Invalid record")
+
+
+class InvalidRecordsError(exception.MelangeError):
+
+    message = _("Import stopped at invalid records: %(errors)s")
+
+    def __init__(self, errors, message=None):
+        self.errors = errors
+        super(InvalidRecordsError, self).__init__(message,
+                                                  errors="; ".join(errors))
@@ -17,17 +17,25 @@
 
 """Model classes that form the core of ipam functionality."""
 
+import collections
 import datetime
+import heapq
+import json
 import logging
 import netaddr
 import operator
 
+import eventlet
+from eventlet import event
+
 from melange import db
 from melange import ipv6
 from melange import ipv4
 from melange import mac
+from melange.common import address_codec
 from melange.common import config
 from melange.common import exception
+from melange.common import intervals
 from melange.common import notifier
 from melange.common import utils
 
@@ -40,18 +48,42 @@ class ModelBase(object):
     _fields_for_type_conversion = {}
     _auto_generated_attrs = ["id", "created_at", "updated_at"]
     _data_fields = []
+    _row_fields = []
+    _row_joins = {}
     on_create_notification_fields = []
     on_update_notification_fields = []
     on_delete_notification_fields = []
+    change_log_fields = []
+    change_log_tenant_field = 'tenant_id'
+    _change_event = "update"
 
     @classmethod
     def create(cls, **values):
         values['id'] = utils.generate_uuid()
         values['created_at'] = utils.utcnow()
-        instance = cls(**values).save()
+        instance = cls(**values)
+        instance._change_event = "create"
+        instance = instance.save()
         instance._notify_fields("create")
         return instance
 
+    @classmethod
+    def create_all(cls, values_list):
+        """Creates a row for each of the values with a single insert."""
+        instances = []
+        change_log = []
+        for values in values_list:
+            values['id'] = utils.generate_uuid()
+            values['created_at'] = utils.utcnow()
+            instance = cls(**values)
+            instance._change_event = "create"
+            change_log.extend(instance._prepare_save().get('change_log', []))
+            instances.append(instance)
+        instances = db.db_api.save_all(instances, change_log=change_log)
+        for instance in instances:
+            instance._notify_fields("create")
+        return instances
+
     def _notify_fields(self, event):
         fields = getattr(self, "on_%s_notification_fields" % event)
         if not fields:
@@ -71,18 +103,36 @@ class ModelBase(object):
         return result
 
     def save(self):
+        return db.db_api.save(self, **self._prepare_save())
+
+    def _prepare_save(self):
         if not self.is_valid():
             raise InvalidModelError(self.errors)
         self._convert_columns_to_proper_type()
         self._before_save()
         self['updated_at'] = utils.utcnow()
         LOG.debug("Saving %s: %s" % (self.__class__.__name__, self.__dict__))
-        return db.db_api.save(self)
+        change_log = self._change_log(self._change_event)
+        self._change_event = "update"
+        return change_log
 
     def delete(self):
-        db.db_api.delete(self)
+        db.db_api.delete(self, **self._change_log("delete"))
         self._notify_fields("delete")
 
+    def _change_log(self, event):
+        """Changes to record along with the event, in the same transaction."""
+        if not self.change_log_fields:
+            return {}
+        change = Change.of(self, self._change_log_event(event))
+        return dict(change_log=[change])
+
+    def _change_log_event(self, event):
+        return event
+
+    def _change_log_payload(self):
+        return dict((field, self[field]) for field in self.change_log_fields)
+
     def __init__(self, **kwargs):
         self.merge_attributes(kwargs)
 
@@ -169,6 +219,10 @@ class ModelBase(object):
     def count(cls, **conditions):
         return cls.find_all(**conditions).count()
 
+    def version(self):
+        """Changes whenever the model is saved."""
+        return (self.id, self.updated_at)
+
     def merge_attributes(self, values):
         """dict.update() behaviour."""
         for k, v in values.iteritems():
@@ -192,8 +246,51 @@ class ModelBase(object):
         return self.id.__hash__()
 
     def data(self, **options):
+        fields = options.get('fields')
         data_fields = self._data_fields + self._auto_generated_attrs
-        return dict([(field, self[field]) for field in data_fields])
+        return dict([(field, self[field]) for field in data_fields
+                     if utils.requested(fields, field)])
+
+    @classmethod
+    def projectable(cls):
+        """True if data() can be built from a row of plain columns."""
+        return bool(cls._row_fields)
+
+    @classmethod
+    def paginated_data(cls, query, fields=None, **limits):
+        """Returns data of a page of query results and the next marker."""
+        if not cls.projectable():
+            elements, next_marker = query.paginated_collection(**limits)
+            return ([element.data(fields=fields) for element in elements],
+                    next_marker)
+
+        rows, next_marker = query.paginated_rows(cls._row_fields,
+                                                 cls._row_joins,
+                                                 **limits)
+        return [cls.row_data(row, fields) for row in rows], next_marker
+
+    @classmethod
+    def streamed_data(cls, query, fields=None, limit=200, marker=None):
+        """Lazily yields (id, data) pairs for a page of query results.
+
+        One element beyond limit is yielded when there is a next page.
+
+        """
+        limit = int(limit) + 1
+        if not cls.projectable():
+            for element in query.limit(limit, marker):
+                yield element.id, element.data(fields=fields)
+            return
+
+        for row in query.iter_rows(cls._row_fields, cls._row_joins,
+                                   limit, marker):
+            yield row['id'], cls.row_data(row, fields)
+
+    @classmethod
+    def row_data(cls, row, fields=None):
+        """Builds the same dict as data() from a projected row."""
+        return dict((field, row[field]) for field in cls._row_fields
+                    if utils.requested(fields, field))
 
     def _validate_positive_integer(self, attribute_name):
         if utils.parse_int(self[attribute_name]) < 0:
@@ -220,6 +317,57 @@ class Converter(object):
         return self.data_type_converters[self.data_type](value)
 
 
+class BlockGeometry(collections.namedtuple(
+        'BlockGeometry',
+        ['version', 'prefixlen', 'first', 'last', 'broadcast', 'netmask'])):
+    """The parsed cidr of a block, with its first and last address as
+    integers. Geometries are memoized per cidr, so blocks sharing a cidr
+    share one geometry.
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, cidr):
+        return _block_geometries.get(cidr, cls._parse)
+
+    @classmethod
+    def _parse(cls, cidr):
+        network = netaddr.IPNetwork(cidr)
+        if network.version == 6:
+            netmask = network.prefixlen
+        else:
+            netmask = network.netmask
+        return cls(version=network.version,
+                   prefixlen=network.prefixlen,
+                   first=network.first,
+                   last=network.last,
+                   broadcast=str(network.broadcast),
+                   netmask=str(netmask))
+
+    @property
+    def size(self):
+        return self.last - self.first + 1
+
+    def index_of(self, address):
+        """Position of address within the block, None when outside it."""
+        version, value = address_codec.parse_ip(address)
+        if version != self.version or not self.first <= value <= self.last:
+            return None
+        return value - self.first
+
+    def contains(self, address):
+        return self.index_of(address) is not None
+
+    def includes(self, other):
+        return (self.version == other.version and
+                self.first <= other.first and other.last <= self.last)
+
+
+_block_geometries = utils.LRUCache(max_size=1024)
+
+
 class IpAddressIterator(object):
 
     def __init__(self, generator):
@@ -255,6 +403,8 @@ class IpBlock(ModelBase):
                     'netmask', 'percent_used', 'ips_used', 'network_name']
     on_create_notification_fields = ['tenant_id', 'id', 'type', 'created_at']
     on_delete_notification_fields = ['tenant_id', 'id', 'type', 'created_at']
+    change_log_fields = ['cidr', 'network_id', 'type', 'gateway',
+                         'parent_id', 'policy_id']
 
     @classmethod
     def find_allocated_ip(cls, ip_block_id, tenant_id, **conditions):
@@ -272,16 +422,26 @@ class IpBlock(ModelBase):
         for block in db.db_api.find_all_blocks_with_deallocated_ips():
             block.delete_deallocated_ips(deallocated_by_func)
 
+    def geometry(self):
+        return BlockGeometry.of(self.cidr)
+
     @property
     def broadcast(self):
-        return str(netaddr.IPNetwork(self.cidr).broadcast)
+        return self.geometry().broadcast
 
     @property
     def netmask(self):
-        if self.is_ipv6():
-            return str(netaddr.IPNetwork(self.cidr).prefixlen)
-        else:
-            return str(netaddr.IPNetwork(self.cidr).netmask)
+        return self.geometry().netmask
+
+    @classmethod
+    def usage_version(cls, **conditions):
+        """Changes whenever the ips_used of a matching block may have."""
+        return db.db_api.ip_block_usage_version(**conditions)
+
+    def version(self):
+        """Changes whenever the block is saved or its ips_used may have."""
+        return (super(IpBlock, self).version(),
+                IpBlock.usage_version(id=self.id))
 
     @property
     def ips_used(self):
@@ -296,14 +456,59 @@ class IpBlock(ModelBase):
     def percent_used(self):
         return (float(self.ips_used) / self.size()) * 100.0
 
+    def free_ranges(self, after=None):
+        """The ranges of addresses left to allocate, as coalesced (first,
+        last) integer pairs in address order, starting past the address
+        after when given.
+
+        Allocated addresses, the gateway, the broadcast address and the
+        addresses the policy disallows are taken out as intervals, so even
+        the largest blocks are not enumerated address by address. Blocks
+        with subnets allocate no addresses, so they have no free ranges.
+
+        """
+        if self.subnets():
+            return iter([])
+
+        geometry = self.geometry()
+        first = geometry.first
+        if after is not None:
+            first = max(first, address_codec.parse_ip(after)[1] + 1)
+
+        allocated = sorted(
+            address_codec.parse_ip(row['address'])[1] for row
+            in IpAddress.find_all(ip_block_id=self.id).iter_rows(['address'],
+                                                                 limit=None))
+        taken = [((value, value) for value in allocated),
+                 sorted((value, value) for value
+                        in (address_codec.parse_ip(address)[1]
+                            for address in [self.gateway, self.broadcast]
+                            if address))]
+
+        policy = self.policy()
+        if policy:
+            taken.append(sorted(
+                (geometry.first + start, geometry.first + stop - 1)
+                for start, stop in (ip_range.bounds(self.cidr)
+                                    for ip_range in policy.unusable_ip_ranges)
+                if start < stop))
+            word_size = 2 ** (8 if geometry.version == 4 else 16)
+            taken.extend(intervals.periodic(first, geometry.last, word_size,
+                                            ip_octet.octet)
+                         for ip_octet in policy.unusable_ip_octets
+                         if 0 <= ip_octet.octet < word_size)
+
+        return intervals.complement(intervals.union(*taken),
+                                    first, geometry.last)
+
     def is_ipv6(self):
-        return netaddr.IPNetwork(self.cidr).version == 6
+        return self.geometry().version == 6
 
     def subnets(self):
         return IpBlock.find_all(parent_id=self.id).all()
 
     def size(self):
-        return netaddr.IPNetwork(self.cidr).size
+        return self.geometry().size
 
     def siblings(self):
         if not self.parent:
@@ -314,6 +519,7 @@ class IpBlock(ModelBase):
         for block in self.subnets():
             block.delete()
         IpAddress.find_all(ip_block_id=self.id).delete()
+        TenantOffsetHint.find_all(ip_block_id=self.id).delete()
         ipv4.plugin().get_generator(self).delete()
         super(IpBlock, self).delete()
 
@@ -358,43 +564,159 @@ class IpBlock(ModelBase):
         return self._allocate_available_ip(interface, **kwargs)
 
     def _allocate_available_ip(self, interface, **kwargs):
+        if self.is_ipv6() or db.db_api.in_transaction():
+            return self._allocate_one_available_ip(interface, **kwargs)
+        return IpAllocationQueue.allocate(self, interface)
+
+    def _allocate_one_available_ip(self, interface, **kwargs):
         max_allowed_retry = int(config.Config.get("ip_allocation_retries", 10))
+        generator = self._address_generator(
+            used_by_tenant=interface.tenant_id,
+            mac_address=interface.mac_address_eui_format,
+            **kwargs)
+        known_offset = self._skip_known_taken_addresses(generator,
+                                                        interface.tenant_id)
+        addresses = self._available_addresses(generator)
 
         for retries in range(max_allowed_retry):
-            address = self._generate_ip(
-                used_by_tenant=interface.tenant_id,
-                mac_address=interface.mac_address_eui_format,
-                **kwargs)
+            address = next(addresses, None)
+            if not address:
+                self.update(is_full=True)
+                raise exception.NoMoreAddressesError(_("IpBlock is full"))
             try:
-                return IpAddress.create(address=address,
-                                        ip_block_id=self.id,
-                                        used_by_tenant_id=interface.tenant_id,
-                                        interface_id=interface.id)
+                ip = IpAddress.create(address=address,
+                                      ip_block_id=self.id,
+                                      used_by_tenant_id=interface.tenant_id,
+                                      interface_id=interface.id,
+                                      interface=interface)
             except exception.DBConstraintError as error:
-                LOG.debug("IP allocation retry count :{0}".format(retries + 1))
-                LOG.exception(error)
+                # NOTE: expected in optimistic allocation mode, where taken
+                #       addresses are only found out when they are inserted
+                LOG.debug("IP allocation retry count :{0}: {1}".format(
+                    retries + 1, error))
+                continue
+            self._remember_offset(generator, ip, known_offset)
+            return ip
 
         raise ConcurrentAllocationError(
             _("Cannot allocate address for block %s at this time") % self.id)
 
-    def _generate_ip(self, **kwargs):
+    def _allocate_available_ips(self, interfaces):
+        """Allocates an address to each of the interfaces with one counter
+        reservation and one insert.
+
+        Returns fewer addresses than interfaces when the block runs out.
+
+        The reservation and the insert share one transaction, so that the
+        addresses and counter values reserved for an insert that fails are
+        not lost.
+
+        """
+        reserved = dict(allocatable_ip_counter=self.allocatable_ip_counter,
+                        is_full=self.is_full)
+        try:
+            with db.db_api.unit_of_work(atomic=True):
+                addresses = self._generate_ips(len(interfaces))
+                return IpAddress.create_all([
+                    dict(address=address,
+                         ip_block_id=self.id,
+                         used_by_tenant_id=interface.tenant_id,
+                         interface_id=interface.id,
+                         interface=interface)
+                    for address, interface in zip(addresses, interfaces)])
+        except exception.NoMoreAddressesError:
+            self.merge_attributes(reserved)
+            self.update(is_full=True)
+            raise
+        except Exception:
+            self.merge_attributes(reserved)
+            raise
+
+    def _generate_ips(self, count):
+        generator = ipv4.plugin().get_generator(self)
+        policy = self.policy()
+        addresses = []
+        try:
+            while len(addresses) < count:
+                addresses.extend(
+                    address for address
+                    in _next_ips(generator, count - len(addresses))
+                    if self._address_is_allocatable(policy, address))
+        except exception.NoMoreAddressesError:
+            if not addresses:
+                raise exception.NoMoreAddressesError(_("IpBlock is full"))
+        return addresses
+
+    def _address_generator(self, **kwargs):
         if self.is_ipv6():
-            generator = ipv6.address_generator_factory(self.cidr,
-                                                       **kwargs)
-            address = next((address for address in IpAddressIterator(generator)
-                           if self.does_address_exists(address) is False),
-                           None)
+            return ipv6.address_generator_factory(self.cidr, **kwargs)
+        return ipv4.plugin().get_generator(self)
+
+    def _skip_known_taken_addresses(self, generator, tenant_id):
+        """Moves generators that can skip past the addresses the tenant's
+        last allocation on this block found taken, and returns the offset
+        remembered for it.
+
+        The interface's own address is tried first, and the offset only
+        skipped to once that is found taken.
+
+        """
+        if not hasattr(generator, "skip"):
+            return None
+        offset = TenantOffsetHint.offset(self.id, tenant_id)
+        if offset and self.does_address_exists(generator.next_ip()):
+            generator.skip(offset)
         else:
-            generator = ipv4.plugin().get_generator(self)
-            address = next((address for address in IpAddressIterator(generator)
-                            if self._address_is_allocatable(self.policy(),
-                                                            address)),
-                           None)
+            generator.skip(0)
+        return offset
 
-        if not address:
-            self.update(is_full=True)
-            raise exception.NoMoreAddressesError(_("IpBlock is full"))
-        return address
+    def _remember_offset(self, generator, ip, known_offset):
+        if not hasattr(generator, "offset_of"):
+            return
+        offset = generator.offset_of(ip.address)
+        if offset != known_offset:
+            TenantOffsetHint.remember(self.id, ip.used_by_tenant_id, offset)
+
+    def _available_addresses(self, generator):
+        """Addresses from the generator to try allocating, in order.
+
+        In optimistic allocation mode, addresses are not looked up before
+        they are tried; the unique (ip_block_id, address) constraint turns
+        away the ones already allocated when they are inserted.
+
+        """
+        if self.is_ipv6():
+            unavailable_addresses = [self.gateway, self.broadcast]
+            if self.allocates_optimistically():
+                return (address for address in IpAddressIterator(generator)
+                        if address not in unavailable_addresses)
+            return (address for address
+                    in self._unallocated_addresses(generator)
+                    if address not in unavailable_addresses)
+
+        policy = self.policy()
+        return (address for address in IpAddressIterator(generator)
+                if self._address_is_allocatable(policy, address))
+
+    def _unallocated_addresses(self, generator):
+        """Candidates from the generator that are not allocated yet, looked
+        up in batches of ipv6_candidate_batch_size.
+
+        """
+        batch_size = int(config.Config.get("ipv6_candidate_batch_size", 8))
+        while True:
+            candidates = generator.next_ips(batch_size)
+            if not candidates:
+                return
+            existing = IpAddress.existing_addresses(self.id, candidates)
+            for address in candidates:
+                if address not in existing:
+                    yield address
+
+    def allocates_optimistically(self):
+        version = "ipv6" if self.is_ipv6() else "ipv4"
+        mode = config.Config.get("%s_allocation_mode" % version, "checked")
+        return mode == "optimistic"
 
     def _allocate_specific_ip(self, interface, address):
 
@@ -412,24 +734,27 @@ class IpBlock(ModelBase):
         return IpAddress.create(address=address,
                                 ip_block_id=self.id,
                                 used_by_tenant_id=interface.tenant_id,
-                                interface_id=interface.id)
+                                interface_id=interface.id,
+                                interface=interface)
 
     def _address_is_allocatable(self, policy, address):
         unavailable_addresses = [self.gateway, self.broadcast]
         return ((address not in unavailable_addresses
                  and self._allowed_by_policy(policy, address)) and
-                not self.does_address_exists(address))
+                (self.allocates_optimistically()
+                 or not self.does_address_exists(address)))
 
     def _allowed_by_policy(self, policy, address):
         return policy is None or policy.allows(self.cidr, address)
 
     def contains(self, address):
-        return netaddr.IPAddress(address) in netaddr.IPNetwork(self.cidr)
+        return self.geometry().contains(address)
 
     def _overlaps(self, other_block):
-        network = netaddr.IPNetwork(self.cidr)
-        other_network = netaddr.IPNetwork(other_block.cidr)
-        return network in other_network or other_network in network
+        geometry = self.geometry()
+        other_geometry = other_block.geometry()
+        return (other_geometry.includes(geometry)
+                or geometry.includes(other_geometry))
 
     def find_ip(self, **kwargs):
         LOG.debug("Searching for IP block %r for IP matching "
@@ -477,8 +802,7 @@ class IpBlock(ModelBase):
 
     def _validate_cidr_is_within_parent_block_cidr(self):
         parent = self.parent
-        if (parent and netaddr.IPNetwork(self.cidr) not in
-                netaddr.IPNetwork(parent.cidr)):
+        if parent and not parent.geometry().includes(self.geometry()):
             self._add_error('cidr',
                             _("cidr should be within parent block's cidr"))
 
@@ -579,15 +903,146 @@ class IpBlock(ModelBase):
         self.dns2 = self.dns2 or config.Config.get("dns2")
 
 
+def _next_ips(generator, count):
+    if hasattr(generator, "next_ips"):
+        return generator.next_ips(count)
+    return [generator.next_ip()]
+
+
+class IpAllocationQueue(object):
+    """Funnels concurrent allocations on a block through one green thread.
+
+    The first allocation on a block spawns a green thread that serves every
+    allocation queued on the block, in batches of up to
+    ip_allocation_batch_size, so that allocations within a process neither
+    race for the same address nor retry.
+
+    """
+
+    _queues = {}
+
+    def __init__(self, ip_block_id):
+        self.ip_block_id = ip_block_id
+        self._pending = []
+        self._serving = False
+
+    @classmethod
+    def allocate(cls, ip_block, interface):
+        queue = cls._queues.get(ip_block.id)
+        if queue is None:
+            queue = cls._queues[ip_block.id] = cls(ip_block.id)
+        return queue.submit(ip_block, interface)
+
+    def submit(self, ip_block, interface):
+        allocation = _PendingAllocation(interface)
+        self._pending.append(allocation)
+        if not self._serving:
+            self._serving = True
+            eventlet.spawn_n(self._serve, ip_block)
+        return allocation.wait()
+
+    def _serve(self, ip_block):
+        batch_size = int(config.Config.get("ip_allocation_batch_size", 50))
+        batch = []
+        try:
+            # NOTE: lets allocations that arrived together join the batch
+            eventlet.sleep(0)
+            while self._pending:
+                batch = self._pending[:batch_size]
+                del self._pending[:batch_size]
+                self._allocate(ip_block, batch)
+        except Exception as error:
+            LOG.exception(error)
+            self._abandon(batch, error)
+        except BaseException:
+            self._abandon(batch, ConcurrentAllocationError(
+                _("Cannot allocate address for block %s at this time")
+                % self.ip_block_id))
+            raise
+        finally:
+            self._serving = False
+            del self._queues[self.ip_block_id]
+
+    def _abandon(self, batch, error):
+        """Fails the allocations left unserved when serving stops early."""
+        for allocation in batch + self._pending:
+            if not allocation.done():
+                allocation.fail(error)
+        del self._pending[:]
+
+    def _allocate(self, ip_block, batch):
+        if len(batch) == 1:
+            return self._allocate_one(ip_block, batch[0])
+        try:
+            ips = ip_block._allocate_available_ips([allocation.interface
+                                                    for allocation in batch])
+        except (exception.DBConstraintError, InvalidModelError) as error:
+            LOG.debug("Allocating batch of %s on block %s failed, "
+                      "allocating one at a time" % (len(batch), ip_block.id))
+            LOG.exception(error)
+            for allocation in batch:
+                self._allocate_one(ip_block, allocation)
+            return
+        except Exception as error:
+            for allocation in batch:
+                allocation.fail(error)
+            return
+
+        for allocation, ip in zip(batch, ips):
+            allocation.succeed(ip)
+        for allocation in batch[len(ips):]:
+            allocation.fail(exception.NoMoreAddressesError(
+                _("IpBlock is full")))
+
+    def _allocate_one(self, ip_block, allocation):
+        try:
+            ip = ip_block._allocate_one_available_ip(allocation.interface)
+        except Exception as error:
+            allocation.fail(error)
+        else:
+            allocation.succeed(ip)
+
+
+class _PendingAllocation(object):
+
+    def __init__(self, interface):
+        self.interface = interface
+        self._event = event.Event()
+
+    def succeed(self, ip):
+        self._event.send((ip, None))
+
+    def fail(self, error):
+        self._event.send((None, error))
+
+    def done(self):
+        return self._event.ready()
+
+    def wait(self):
+        ip, error = self._event.wait()
+        if error is not None:
+            raise error
+        return ip
+
+
 class IpAddress(ModelBase):
 
     _data_fields = ['ip_block_id', 'address', 'version']
+    _row_fields = ['id', 'ip_block_id', 'address', 'interface_id',
+                   'created_at', 'updated_at']
+    _row_joins = {
+        'interface': ('Interface',
+                      ['tenant_id', 'device_id', 'vif_id_on_device']),
+    }
     on_create_notification_fields = ['used_by_tenant_id', 'id', 'ip_block_id',
                                      'used_by_device_id', 'created_at',
                                      'address']
     on_delete_notification_fields = ['used_by_tenant_id', 'id', 'ip_block_id',
                                      'used_by_device_id', 'created_at',
                                      'address']
+    change_log_fields = ['address', 'ip_block_id', 'used_by_tenant_id',
+                         'marked_for_deallocation']
+    change_log_tenant_field = 'used_by_tenant_id'
 
     def _validate(self):
         self._validate_presence_of("used_by_tenant_id")
@@ -602,8 +1057,7 @@ class IpAddress(ModelBase):
 
     @classmethod
     def _formatted(cls, address):
-        ipv6_format_dialect = netaddr.strategy.ipv6.ipv6_verbose
-        return netaddr.IPAddress(address).format(dialect=ipv6_format_dialect)
+        return address_codec.canonical_ip(address)
 
     @classmethod
     def find_all_by_network(cls, network_id, **conditions):
@@ -618,6 +1072,15 @@ class IpAddress(ModelBase):
         LOG.debug("Retrieving all allocated IPs.")
         return db.db_query.find_all_allocated_ips(cls, **conditions)
 
+    @classmethod
+    def existing_addresses(cls, ip_block_id, addresses):
+        """The ones of the addresses allocated on the block, in one query."""
+        formatted_addresses = dict((cls._formatted(address), address)
+                                   for address in addresses)
+        existing = db.db_api.find_existing_addresses(
+            cls, formatted_addresses.keys(), ip_block_id=ip_block_id)
+        return set(formatted_addresses[address] for address in existing)
+
     def delete(self):
         LOG.debug("Deleting IP address: %r" % self)
         if self._explicitly_allowed_on_interfaces():
@@ -645,6 +1108,33 @@ class IpAddress(ModelBase):
              }
             for local_address in ip_addresses])
 
+    def _change_log_event(self, event):
+        if event == "create":
+            return "allocate"
+        if event == "update" and self.marked_for_deallocation:
+            return "deallocate"
+        return event
+
+    def _change_log_payload(self):
+        payload = super(IpAddress, self)._change_log_payload()
+        payload['marked_for_deallocation'] = bool(
+            self.marked_for_deallocation)
+        interface = self._loaded_interface()
+        payload['interface_id'] = (interface.virtual_interface_id
+                                   if interface else None)
+        payload['used_by_device_id'] = (interface.device_id
+                                        if interface else None)
+        return payload
+
+    def _loaded_interface(self):
+        """The interface, reusing the one the address was created with."""
+        if not self.interface_id:
+            return None
+        interface = self.__dict__.get('interface')
+        if interface is None or interface.id != self.interface_id:
+            interface = Interface.get(self.interface_id)
+        return interface
+
     def deallocate(self):
         LOG.debug("Marking IP address for deallocation: %r" % self)
         self.update(marked_for_deallocation=True,
@@ -684,7 +1174,7 @@ class IpAddress(ModelBase):
 
     @property
     def version(self):
-        return netaddr.IPAddress(self.address).version
+        return address_codec.ip_version(self.address)
 
     @utils.cached_property
     def interface(self):
@@ -705,12 +1195,37 @@ class IpAddress(ModelBase):
 
     def data(self, **options):
         data = super(IpAddress, self).data(**options)
+        fields = options.get('fields')
+        if not utils.requested(fields, 'used_by_tenant', 'used_by_device',
+                               'interface_id'):
+            return data
+
         iface = self.interface
-        data['used_by_tenant'] = iface.tenant_id
-        data['used_by_device'] = iface.device_id
-        data['interface_id'] = iface.virtual_interface_id
+        interface_data = {'used_by_tenant': iface.tenant_id,
+                          'used_by_device': iface.device_id,
+                          'interface_id': iface.virtual_interface_id,
+                          }
+        data.update((field, value)
+                    for field, value in interface_data.iteritems()
+                    if utils.requested(fields, field))
         return data
 
+    @classmethod
+    def row_data(cls, row, fields=None):
+        interface_id = row['interface_vif_id_on_device'] or row['interface_id']
+        data = {'id': row['id'],
+                'ip_block_id': row['ip_block_id'],
+                'address': row['address'],
+                'version': address_codec.ip_version(row['address']),
+                'created_at': row['created_at'],
+                'updated_at': row['updated_at'],
+                'used_by_tenant': row['interface_tenant_id'],
+                'used_by_device': row['interface_device_id'],
+                'interface_id': interface_id,
+                }
+        return dict((field, value) for field, value in data.iteritems()
+                    if utils.requested(fields, field))
+
     def __str__(self):
         return self.address
 
@@ -718,6 +1233,7 @@ class IpAddress(ModelBase):
 class IpRoute(ModelBase):
 
     _data_fields = ['destination', 'netmask', 'gateway']
+    _row_fields = _data_fields + ModelBase._auto_generated_attrs
 
     def _validate(self):
         self._validate_presence_of("destination", "gateway")
@@ -728,20 +1244,62 @@ class MacAddressRange(ModelBase):
 
     _data_fields = ['cidr']
 
+    # NOTE: first and last address of each range cidr parsed so far
+    _bounds = {}
+
     @classmethod
     def allocate_next_free_mac(cls, **kwargs):
-        ranges = sorted(cls.find_all(),
-                        key=operator.attrgetter('created_at', 'id'))
-        for range in ranges:
+        """Allocates from the oldest range not known to be full, flagging
+        the ranges that turn out to be full on the way.
+
+        """
+        while True:
+            range = db.db_api.find_first_non_full_mac_range()
+            if range is None:
+                raise NoMoreMacAddressesError()
             try:
                 return range.allocate_mac(**kwargs)
             except NoMoreMacAddressesError:
                 LOG.debug("no more addresses in range %s" % range.id)
-        raise NoMoreMacAddressesError()
+                range.update(is_full=True)
+
+    @classmethod
+    def allocate_macs(cls, interface_ids):
+        """Allocates a MAC address to each of the interfaces, reserving
+        consecutive addresses of a range and inserting them at once.
+
+        Falls back to allocating one address at a time when the insert runs
+        into an address that is already taken. The reservation is rolled
+        back with the insert then, so the reserved addresses are not lost.
+
+        """
+        macs = []
+        while len(macs) < len(interface_ids):
+            range = db.db_api.find_first_non_full_mac_range()
+            if range is None:
+                raise NoMoreMacAddressesError()
+            try:
+                with db.db_api.unit_of_work(atomic=True):
+                    allocated = range._allocate_macs(interface_ids[len(macs):])
+            except exception.DBConstraintError as error:
+                LOG.exception(error)
+                macs.extend(cls.allocate_next_free_mac(interface_id=id)
+                            for id in interface_ids[len(macs):])
+            else:
+                macs.extend(allocated)
+        return macs
 
     @classmethod
     def mac_allocation_enabled(cls):
-        return cls.count() > 0
+        return cls.get_by() is not None
+
+    def _before_save(self):
+        if self.is_full is None:
+            self.is_full = False
+
+    def delete(self):
+        self._bounds.pop(self.cidr, None)
+        super(MacAddressRange, self).delete()
 
     def allocate_mac(self, **kwargs):
         generator = mac.plugin().get_generator(self)
@@ -764,25 +1322,48 @@ class MacAddressRange(ModelBase):
         raise ConcurrentAllocationError(
             _("Cannot allocate mac address at this time"))
 
+    def _allocate_macs(self, interface_ids):
+        generator = mac.plugin().get_generator(self)
+        addresses = []
+        if not generator.is_full():
+            addresses = generator.next_macs(len(interface_ids))
+        if len(addresses) < len(interface_ids):
+            self.update(is_full=True)
+        # NOTE: the addresses come from this range, so hand it to the new
+        #       macs instead of each of them looking it up to validate
+        return MacAddress.create_all([
+            dict(address=address,
+                 mac_address_range_id=self.id,
+                 interface_id=interface_id,
+                 mac_range=self)
+            for address, interface_id in zip(addresses, interface_ids)])
+
     def contains(self, address):
-        address = int(netaddr.EUI(address))
-        return (address >= self.first_address() and
-                address <= self.last_address())
+        address = address_codec.mac_value(address)
+        first_address, last_address = self._address_bounds()
+        return first_address <= address <= last_address
 
     def length(self):
-        base_address, slash, prefix_length = self.cidr.partition("/")
-        prefix_length = int(prefix_length)
-        return 2 ** (48 - prefix_length)
+        first_address, last_address = self._address_bounds()
+        return last_address - first_address + 1
 
     def first_address(self):
-        base_address, slash, prefix_length = self.cidr.partition("/")
-        prefix_length = int(prefix_length)
-        netmask = (2 ** prefix_length - 1) << (48 - prefix_length)
-        base_address = netaddr.EUI(base_address)
-        return int(netaddr.EUI(int(base_address) & netmask))
+        return self._address_bounds()[0]
 
     def last_address(self):
-        return self.first_address() + self.length() - 1
+        return self._address_bounds()[1]
+
+    def _address_bounds(self):
+        bounds = self._bounds.get(self.cidr)
+        if bounds is None:
+            base_address, slash, prefix_length = self.cidr.partition("/")
+            prefix_length = int(prefix_length)
+            netmask = (2 ** prefix_length - 1) << (48 - prefix_length)
+            first_address = address_codec.mac_value(base_address) & netmask
+            length = 2 ** (48 - prefix_length)
+            bounds = (first_address, first_address + length - 1)
+            self._bounds[self.cidr] = bounds
+        return bounds
 
     def no_macs_allocated(self):
         return MacAddress.find_all(mac_address_range_id=self.id).count() == 0
@@ -792,14 +1373,14 @@ class MacAddress(ModelBase):
 
     @property
     def eui_format(self):
-        return str(netaddr.EUI(self.address))
+        return address_codec.format_mac(self.address)
 
     @property
     def unix_format(self):
         return self.eui_format.replace('-', ':')
 
     def _before_save(self):
-        self.address = int(netaddr.EUI(self.address))
+        self.address = address_codec.mac_value(self.address)
 
     def _validate_belongs_to_mac_address_range(self):
         if self.mac_range:
@@ -813,6 +1394,8 @@ class MacAddress(ModelBase):
         if self.mac_range:
             generator = mac.plugin().get_generator(self.mac_range)
             generator.mac_removed(self.address)
+            if self.mac_range.is_full:
+                self.mac_range.update(is_full=False)
         super(MacAddress, self).delete()
 
     @utils.cached_property
@@ -824,6 +1407,7 @@ class MacAddress(ModelBase):
 class Interface(ModelBase):
 
     _data_fields = ["device_id", "tenant_id"]
+    change_log_fields = ["virtual_interface_id", "device_id"]
 
     @classmethod
     def find_or_configure(cls, virtual_interface_id=None, device_id=None,
@@ -845,13 +1429,31 @@ class Interface(ModelBase):
                                 **kwargs):
         interface = Interface.create_and_configure(device_id=device_id,
                                                    **kwargs)
+        interface._allocate_ips(network_params)
+        return interface
 
+    @classmethod
+    def create_all_and_allocate_ips(cls, interfaces_params, device_id=None,
+                                    tenant_id=None):
+        """Same as create_and_allocate_ips for each of the interfaces, but
+        with their MAC addresses allocated together.
+
+        """
+        interfaces = cls.create_all_and_configure(
+            [utils.exclude(params, 'network_params')
+             for params in interfaces_params],
+            device_id=device_id,
+            tenant_id=tenant_id)
+        for interface, params in zip(interfaces, interfaces_params):
+            interface._allocate_ips(params.get('network_params'))
+        return interfaces
+
+    def _allocate_ips(self, network_params):
         if network_params:
             network = Network.find_or_create_by(
                 network_params.pop('id'),
                 network_params.pop('tenant_id'))
-            network.allocate_ips(interface=interface, **network_params)
-        return interface
+            network.allocate_ips(interface=self, **network_params)
 
     @classmethod
     def create_and_configure(cls, virtual_interface_id=None, device_id=None,
@@ -865,6 +1467,28 @@ class Interface(ModelBase):
             MacAddressRange.allocate_next_free_mac(interface_id=interface.id)
         return interface
 
+    @classmethod
+    def create_all_and_configure(cls, interfaces_params, device_id=None,
+                                 tenant_id=None):
+        interfaces = []
+        interfaces_needing_mac = []
+        for params in interfaces_params:
+            interface = Interface.create(
+                vif_id_on_device=params.get('virtual_interface_id'),
+                device_id=device_id,
+                tenant_id=tenant_id)
+            if params.get('mac_address'):
+                MacAddress.create(address=params['mac_address'],
+                                  interface_id=interface.id)
+            else:
+                interfaces_needing_mac.append(interface)
+            interfaces.append(interface)
+
+        if interfaces_needing_mac and MacAddressRange.mac_allocation_enabled():
+            MacAddressRange.allocate_macs(
+                [interface.id for interface in interfaces_needing_mac])
+        return interfaces
+
     @classmethod
     def none_object(cls):
         return Interface(id=None, virtual_interface_id=None, device_id=None)
@@ -880,8 +1504,9 @@ class Interface(ModelBase):
         super(Interface, self).delete()
 
     def data(self, **options):
-        data = super(Interface, self).data()
-        data['id'] = self.virtual_interface_id
+        data = super(Interface, self).data(**options)
+        if utils.requested(options.get('fields'), 'id'):
+            data['id'] = self.virtual_interface_id
         return data
 
     def allow_ip(self, ip):
@@ -940,6 +1565,15 @@ class Interface(ModelBase):
         if self.mac_address:
             return self.mac_address.unix_format
 
+    def configuration_version(self):
+        """Changes whenever the interface, its mac address, or any of its
+        ips, their blocks or routes are saved or deleted.
+
+        """
+        return (self.version(),
+                MacAddress.find_all(interface_id=self.id).version(),
+                db.db_api.interface_configuration_version(self.id))
+
     def _validate(self):
         self._validate_presence_of("tenant_id")
         self._validate_uniqueness_of_virtual_interface_id()
@@ -968,6 +1602,7 @@ class Interface(ModelBase):
 class Policy(ModelBase):
 
     _data_fields = ['name', 'description', 'tenant_id']
+    _row_fields = _data_fields + ModelBase._auto_generated_attrs
 
     def _validate(self):
         self._validate_presence_of('name', 'tenant_id')
@@ -1021,21 +1656,37 @@ class IpRange(ModelBase):
 
     _fields_for_type_conversion = {'offset': 'integer', 'length': 'integer'}
     _data_fields = ['offset', 'length', 'policy_id']
+    _row_fields = _data_fields + ModelBase._auto_generated_attrs
 
     def contains(self, cidr, address):
+        index = BlockGeometry.of(cidr).index_of(address)
+        if index is None:
+            return False
+        start, stop = self.bounds(cidr)
+        return start <= index < stop
+
+    def bounds(self, cidr):
+        """Positions of the first address of the range within the block
+        and of the one past its last.
+
+        """
         end_index = self.offset + self.length
         end_index_overshoots_length_for_negative_offset = (self.offset < 0
                                                            and end_index >= 0)
         if end_index_overshoots_length_for_negative_offset:
             end_index = None
-        return (netaddr.IPAddress(address) in
-                netaddr.IPNetwork(cidr)[self.offset:end_index])
+        size = BlockGeometry.of(cidr).size
+        # NOTE: same bounds as slicing the block's addresses by
+        #       [offset:end_index]
+        start = _slice_bound(self.offset, size)
+        stop = size if end_index is None else _slice_bound(end_index, size)
+        return start, stop
 
     def _validate(self):
         self._validate_positive_integer('length')
 
     def size(self, cidr):
-        block_size = netaddr.IPNetwork(cidr).size
+        block_size = BlockGeometry.of(cidr).size
         if self.offset >= 0:
             if (self.offset + self.length) <= block_size:
                 size = self.length
@@ -1051,16 +1702,23 @@ class IpRange(ModelBase):
         return size
 
 
+def _slice_bound(index, size):
+    if index < 0:
+        return max(size + index, 0)
+    return min(index, size)
+
+
 class IpOctet(ModelBase):
 
     _fields_for_type_conversion = {'octet': 'integer'}
     _data_fields = ['octet', 'policy_id']
+    _row_fields = _data_fields + ModelBase._auto_generated_attrs
 
     def applies_to(self, address):
-        return self.octet == netaddr.IPAddress(address).words[-1]
+        return self.octet == address_codec.last_word(address)
 
     def size(size, cidr):
-        cidr_prefix_length = netaddr.IPNetwork(cidr).prefixlen
+        cidr_prefix_length = BlockGeometry.of(cidr).prefixlen
         if cidr_prefix_length < 24:
             size = 2 ** (24 - cidr_prefix_length)
         else:
@@ -1095,6 +1753,23 @@ class Network(ModelBase):
                                       type=IpBlock.PRIVATE_TYPE)
             return cls(id=id, ip_blocks=[ip_block])
 
+    def free_ranges(self, after=None):
+        """The free ranges of all the network's blocks as (block, first,
+        last), ipv4 before ipv6 and in address order, starting past the
+        address after when given.
+
+        """
+        after_version = after and address_codec.ip_version(after)
+        ranges = []
+        for ip_block in self.ip_blocks:
+            version = ip_block.geometry().version
+            if after_version and version < after_version:
+                continue
+            block_after = after if version == after_version else None
+            ranges.append(_versioned_free_ranges(ip_block, block_after))
+        return ((ip_block, first, last)
+                for version, first, last, ip_block in heapq.merge(*ranges))
+
     def allocated_ips(self, interface_id):
         ips_by_block = [IpAddress.find_all(interface_id=interface_id,
                                            ip_block_id=ip_block.id).all()
@@ -1164,6 +1839,102 @@ class Network(ModelBase):
                 pass
 
 
+def _versioned_free_ranges(ip_block, after):
+    version = ip_block.geometry().version
+    for first, last in ip_block.free_ranges(after):
+        yield version, first, last, ip_block
+
+
+class Change(ModelBase):
+    """An entry of the append only log of changes to ips, interfaces and
+    blocks. Ids are sequential, so consumers read changes since the last
+    id they have seen instead of listing everything again.
+
+    """
+
+    _auto_generated_attrs = ["id", "created_at"]
+    _data_fields = ['event', 'resource_type', 'resource_id', 'tenant_id']
+
+    @classmethod
+    def find_committed(cls, **conditions):
+        """Changes up to the first id missing among the recent ones.
+
+        Ids are handed out when a change is inserted but show up only when
+        its transaction commits, so a newer change can be read before an
+        older one. A missing id may be that of a transaction still open, so
+        the changes after it are held back, and consumers do not read past
+        it. Ids missing for longer than change_feed_commit_lag are taken
+        for rolled back changes, which makes the lag a best-effort bound on
+        how long a transaction recording changes may stay open.
+
+        """
+        lag = int(config.Config.get('change_feed_commit_lag', 5))
+        created_after = utils.utcnow() - datetime.timedelta(seconds=lag)
+        last_id, recent_ids = db.db_api.recent_change_ids(cls, created_after)
+        return db.db_query.find_changes_before(
+            cls, before_id=_first_missing_id(last_id, recent_ids),
+            **conditions)
+
+    @classmethod
+    def of(cls, model, event):
+        return cls(event=event,
+                   resource_type=utils.underscore(model.__class__.__name__),
+                   resource_id=model.id,
+                   tenant_id=model[model.change_log_tenant_field],
+                   payload=json.dumps(model._change_log_payload()),
+                   created_at=utils.utcnow())
+
+    def data(self, **options):
+        data = super(Change, self).data(**options)
+        if utils.requested(options.get('fields'), 'data'):
+            data['data'] = json.loads(self.payload)
+        return data
+
+
+def _first_missing_id(last_id, ids):
+    if last_id is None:
+        if not ids:
+            return None
+        last_id = ids[0] - 1
+    expected = last_id + 1
+    for id in ids:
+        if id > expected:
+            return expected
+        expected = max(expected, id + 1)
+    return None
+
+
+class TenantOffsetHint(ModelBase):
+    """How far past an interface's own address the last IPv6 allocation for
+    a tenant on a block had to go to find a free address. Generators that
+    can skip continue the next allocation whose own address is taken
+    there, instead of probing again through the addresses taken before it.
+
+    """
+
+    def _validate(self):
+        self._validate_presence_of("ip_block_id", "tenant_id")
+
+    @classmethod
+    def offset(cls, ip_block_id, tenant_id):
+        hint = cls.get_by(ip_block_id=ip_block_id, tenant_id=tenant_id)
+        return hint.address_offset if hint else 0
+
+    @classmethod
+    def remember(cls, ip_block_id, tenant_id, offset):
+        hint = cls.get_by(ip_block_id=ip_block_id, tenant_id=tenant_id)
+        if hint is not None:
+            return hint.update(address_offset=offset)
+        try:
+            return cls.create(ip_block_id=ip_block_id,
+                              tenant_id=tenant_id,
+                              address_offset=offset)
+        except exception.DBConstraintError:
+            # NOTE: a concurrent allocation for the tenant remembered its
+            #       offset first, which is as good a hint as this one
+            return None
+
+
 def persisted_models():
     return {'IpBlock': IpBlock,
             'IpAddress': IpAddress,
@@ -1174,6 +1945,8 @@ def persisted_models():
             'MacAddressRange': MacAddressRange,
             'MacAddress': MacAddress,
             'Interface': Interface,
+            'Change': Change,
+            'TenantOffsetHint': TenantOffsetHint,
             }
 
 
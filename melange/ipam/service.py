@@ -15,11 +15,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import eventlet
+import hashlib
+import json
 import logging
-import routes
+import netaddr
+import time
+import webob
 import webob.exc
 
+from melange import db
+from melange.common import address_codec
+from melange.common import config
 from melange.common import exception
+from melange.common import notifier
 from melange.common import pagination
 from melange.common import utils
 from melange.common import wsgi
@@ -33,6 +43,7 @@ LOG = logging.getLogger('melange.ipam.service')
 class BaseController(wsgi.Controller):
 
     exclude_attr = []
+    etag_settle_time = datetime.timedelta(seconds=2)
     exception_map = {
         webob.exc.HTTPUnprocessableEntity: [
             exception.NoMoreAddressesError,
@@ -46,6 +57,8 @@ class BaseController(wsgi.Controller):
         webob.exc.HTTPBadRequest: [
             models.InvalidModelError,
             exception.ParamsMissingError,
+            exception.InvalidParamError,
+            exception.BatchTooLargeError,
         ],
         webob.exc.HTTPNotFound: [
             models.ModelNotFoundError,
@@ -66,16 +79,95 @@ class BaseController(wsgi.Controller):
         return dict([(key, params[key]) for key in params.keys()
                      if key in ["limit", "marker"]])
 
+    def _extract_fields(self, params):
+        fields = params.get('fields')
+        if not fields:
+            return None
+        return [field.strip() for field in fields.split(",") if field.strip()]
+
+    def _conditional_response(self, request, version, render):
+        """Answers 304 Not Modified without calling render when the
+        request's If-None-Match has the ETag of version.
+
+        Responses are left untagged while version has a timestamp younger
+        than etag_settle_time: timestamps are stored to the second, so
+        another write within the same second would not change version.
+
+        """
+        if _has_timestamp_after(version,
+                                utils.utcnow() - self.etag_settle_time):
+            return self._result(render())
+        etag = hashlib.md5(repr((version,
+                                 request.path_qs,
+                                 request.best_match_content_type()))
+                           ).hexdigest()
+        if etag in request.if_none_match:
+            return wsgi.Result(None, 304, etag=etag)
+        result = self._result(render())
+        result.etag = etag
+        return result
+
+    def _result(self, result):
+        if isinstance(result, wsgi.Result):
+            return result
+        return wsgi.Result(result)
+
+    def _interface_response(self, request, interface):
+        fields = self._extract_fields(request.params)
+        return self._conditional_response(
+            request,
+            interface.configuration_version(),
+            lambda: dict(interface=views.InterfaceConfigurationView(
+                interface, fields=fields).data()))
+
     def _paginated_response(self, collection_type, collection_query, request):
-        elements, next_marker = collection_query.paginated_collection(
-            **self._extract_limits(request.params))
-        collection = [element.data() for element in elements]
+        fields = self._extract_fields(request.params)
+        limits = self._extract_limits(request.params)
+        model = collection_query.model
+        if self._stream_collections():
+            elements = model.streamed_data(collection_query,
+                                           fields=fields,
+                                           **limits)
+            return wsgi.Result(pagination.StreamedDataView(
+                collection_type,
+                elements,
+                request.url,
+                **utils.filter_dict(limits, 'limit')))
+
+        collection, next_marker = model.paginated_data(collection_query,
+                                                       fields=fields,
+                                                       **limits)
 
         return wsgi.Result(pagination.PaginatedDataView(collection_type,
                                                         collection,
                                                         request.url,
                                                         next_marker))
 
+    def _stream_collections(self):
+        return utils.bool_from_string(
+            config.Config.get('stream_collections', 'False'))
+
+    def _free_ranges_response(self, request, free_ranges):
+        """Pages of free ranges, marked by the last address of a page."""
+        elements = (_free_range_element(ip_block, first, last)
+                    for ip_block, first, last in free_ranges)
+        limits = self._extract_limits(request.params)
+        return wsgi.Result(pagination.StreamedDataView(
+            'free_ranges',
+            elements,
+            request.url,
+            **utils.filter_dict(limits, 'limit')))
+
+    def _extract_address_marker(self, params):
+        marker = params.get('marker')
+        if marker is None:
+            return None
+        try:
+            address_codec.parse_ip(marker)
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            raise exception.InvalidParamError(value=marker, param='marker')
+        return marker
+
 
 class DeleteAction:
     def delete(self, request, **kwargs):
@@ -84,8 +176,13 @@ class DeleteAction:
 
 class ShowAction:
     def show(self, request, **kwargs):
-        data = self._model.find_by(**kwargs).data()
-        return {utils.underscore(self._model.__name__): data}
+        model = self._model.find_by(**kwargs)
+        fields = self._extract_fields(request.params)
+        return self._conditional_response(
+            request,
+            model.version(),
+            lambda: {utils.underscore(self._model.__name__):
+                     model.data(fields=fields)})
 
 
 class IpBlockController(BaseController, DeleteAction, ShowAction):
@@ -100,7 +197,11 @@ class IpBlockController(BaseController, DeleteAction, ShowAction):
         LOG.info("Listing all IP blocks for tenant '%s'" % tenant_id)
         filters = utils.filter_dict(request.params, 'type', 'network_id')
         all_blocks = models.IpBlock.find_all(tenant_id=tenant_id, **filters)
-        return self._paginated_response('ip_blocks', all_blocks, request)
+        return self._conditional_response(
+            request,
+            (all_blocks.version(),
+             models.IpBlock.usage_version(tenant_id=tenant_id, **filters)),
+            lambda: self._paginated_response('ip_blocks', all_blocks, request))
 
     def create(self, request, tenant_id, body=None):
         LOG.info("Creating an IP block for tenant '%s'" % tenant_id)
@@ -117,6 +218,14 @@ class IpBlockController(BaseController, DeleteAction, ShowAction):
         LOG.debug("Updated IP block %(id)s parameters: %(params)s" % locals())
         return wsgi.Result(dict(ip_block=ip_block.data()), 200)
 
+    def free_ranges(self, request, id, tenant_id):
+        ip_block = self._find_block(id=id, tenant_id=tenant_id)
+        after = self._extract_address_marker(request.params)
+        return self._free_ranges_response(
+            request,
+            ((ip_block, first, last)
+             for first, last in ip_block.free_ranges(after)))
+
 
 class SubnetController(BaseController):
 
@@ -125,7 +234,9 @@ class SubnetController(BaseController):
 
     def index(self, request, ip_block_id, tenant_id):
         ip_block = self._find_block(id=ip_block_id, tenant_id=tenant_id)
-        return dict(subnets=[subnet.data() for subnet in ip_block.subnets()])
+        fields = self._extract_fields(request.params)
+        return dict(subnets=[subnet.data(fields=fields)
+                             for subnet in ip_block.subnets()])
 
     def create(self, request, ip_block_id, tenant_id, body=None):
         ip_block = self._find_block(id=ip_block_id, tenant_id=tenant_id)
@@ -150,7 +261,9 @@ class IpAddressController(BaseController):
 
     def show(self, request, address, ip_block_id, tenant_id):
         ip_block = self._find_block(id=ip_block_id, tenant_id=tenant_id)
-        return dict(ip_address=ip_block.find_ip(address=address).data())
+        ip_address = ip_block.find_ip(address=address)
+        return dict(ip_address=ip_address.data(
+            fields=self._extract_fields(request.params)))
 
     def delete(self, request, address, ip_block_id, tenant_id):
         ip_block = self._find_block(id=ip_block_id, tenant_id=tenant_id)
@@ -194,7 +307,10 @@ class IpRoutesController(BaseController):
         source_block = models.IpBlock.find_by(id=source_block_id,
                                               tenant_id=tenant_id)
         ip_routes = models.IpRoute.find_all(source_block_id=source_block.id)
-        return self._paginated_response('ip_routes', ip_routes, request)
+        return self._conditional_response(
+            request,
+            ip_routes.version(),
+            lambda: self._paginated_response('ip_routes', ip_routes, request))
 
     def create(self, request, tenant_id, source_block_id, body=None):
         source_block = models.IpBlock.find_by(id=source_block_id,
@@ -209,7 +325,11 @@ class IpRoutesController(BaseController):
                                               tenant_id=tenant_id)
         ip_route = models.IpRoute.find_by(id=id,
                                           source_block_id=source_block.id)
-        return dict(ip_route=ip_route.data())
+        fields = self._extract_fields(request.params)
+        return self._conditional_response(
+            request,
+            ip_route.version(),
+            lambda: dict(ip_route=ip_route.data(fields=fields)))
 
     def delete(self, request, id, tenant_id, source_block_id):
         source_block = models.IpBlock.find_by(id=source_block_id,
@@ -247,7 +367,8 @@ class InsideGlobalsController(BaseController):
         ip = ip_block.find_ip(address=address)
         global_ips, marker = ip.inside_globals().paginated_collection(
             **self._extract_limits(request.params))
-        return dict(ip_addresses=[ip.data() for ip in global_ips])
+        fields = self._extract_fields(request.params)
+        return dict(ip_addresses=[ip.data(fields=fields) for ip in global_ips])
 
     def delete(self, request, ip_block_id, address, tenant_id,
                inside_globals_address=None):
@@ -278,7 +399,8 @@ class InsideLocalsController(BaseController):
         ip = ip_block.find_ip(address=address)
         local_ips, marker = ip.inside_locals().paginated_collection(
             **self._extract_limits(request.params))
-        return dict(ip_addresses=[ip.data() for ip in local_ips])
+        fields = self._extract_fields(request.params)
+        return dict(ip_addresses=[ip.data(fields=fields) for ip in local_ips])
 
     def delete(self, request, ip_block_id, address, tenant_id,
                inside_locals_address=None):
@@ -298,7 +420,8 @@ class UnusableIpRangesController(BaseController):
     def show(self, request, policy_id, id, tenant_id):
         policy = models.Policy.find_by(id=policy_id, tenant_id=tenant_id)
         ip_range = policy.find_ip_range(id)
-        return dict(ip_range=ip_range.data())
+        return dict(ip_range=ip_range.data(
+            fields=self._extract_fields(request.params)))
 
     def index(self, request, policy_id, tenant_id):
         policy = models.Policy.find_by(id=policy_id, tenant_id=tenant_id)
@@ -334,7 +457,8 @@ class UnusableIpOctetsController(BaseController):
     def show(self, request, policy_id, id, tenant_id):
         policy = models.Policy.find_by(id=policy_id, tenant_id=tenant_id)
         ip_octet = policy.find_ip_octet(id)
-        return dict(ip_octet=ip_octet.data())
+        return dict(ip_octet=ip_octet.data(
+            fields=self._extract_fields(request.params)))
 
     def update(self, request, policy_id, id, tenant_id, body=None):
         policy = models.Policy.find_by(id=policy_id, tenant_id=tenant_id)
@@ -356,7 +480,10 @@ class PoliciesController(BaseController, ShowAction, DeleteAction):
 
     def index(self, request, tenant_id):
         policies = models.Policy.find_all(tenant_id=tenant_id)
-        return self._paginated_response('policies', policies, request)
+        return self._conditional_response(
+            request,
+            policies.version(),
+            lambda: self._paginated_response('policies', policies, request))
 
     def create(self, request, tenant_id, body=None):
         params = self._extract_required_params(body, 'policy')
@@ -373,7 +500,15 @@ class NetworksController(BaseController):
 
     def index(self, request, tenant_id, network_id):
         network = models.Network.find_by(network_id, tenant_id=tenant_id)
-        return dict(ip_blocks=[block.data() for block in network.ip_blocks])
+        fields = self._extract_fields(request.params)
+        return dict(ip_blocks=[block.data(fields=fields)
+                               for block in network.ip_blocks])
+
+    def free_ranges(self, request, tenant_id, network_id):
+        network = models.Network.find_by(network_id, tenant_id=tenant_id)
+        after = self._extract_address_marker(request.params)
+        return self._free_ranges_response(request,
+                                          network.free_ranges(after))
 
 
 class InterfaceIpAllocationsController(BaseController):
@@ -403,7 +538,8 @@ class InterfaceIpAllocationsController(BaseController):
         network = models.Network.find_by(id=network_id, tenant_id=tenant_id)
         interface = models.Interface.find_by(vif_id_on_device=interface_id)
         ips_on_interface = network.allocated_ips(interface_id=interface.id)
-        ip_configuration_view = views.IpConfigurationView(*ips_on_interface)
+        ip_configuration_view = views.IpConfigurationView(
+            *ips_on_interface, fields=self._extract_fields(request.params))
         return dict(ip_addresses=ip_configuration_view.data())
 
 
@@ -431,8 +567,7 @@ class InterfacesController(BaseController, ShowAction, DeleteAction):
         interface = models.Interface.find_by(
             vif_id_on_device=virtual_interface_id,
             tenant_id=tenant_id)
-        view_data = views.InterfaceConfigurationView(interface).data()
-        return dict(interface=view_data)
+        return self._interface_response(request, interface)
 
     def delete(self, request, **kwargs):
         kwargs['vif_id_on_device'] = kwargs.pop('virtual_interface_id', None)
@@ -447,27 +582,31 @@ class InstanceInterfacesController(BaseController):
 
         params = self._extract_required_params(body, 'instance')
         tenant_id = params['tenant_id']
-        created_interfaces = []
         for iface in params['interfaces']:
+            iface['network_params'] = utils.stringify_keys(
+                iface.pop('network', None))
+        interfaces = models.Interface.create_all_and_allocate_ips(
+            params['interfaces'],
+            device_id=device_id,
+            tenant_id=tenant_id)
 
-            network_params = utils.stringify_keys(iface.pop('network', None))
-            interface = models.Interface.create_and_allocate_ips(
-                device_id=device_id,
-                network_params=network_params,
-                tenant_id=tenant_id,
-                **iface)
-
-            view_data = views.InterfaceConfigurationView(interface).data()
-            created_interfaces.append(view_data)
-
+        created_interfaces = [views.InterfaceConfigurationView(iface).data()
+                              for iface in interfaces]
         return {'instance': {'interfaces': created_interfaces}}
 
     def index(self, request, device_id):
-        interfaces = models.Interface.find_all(device_id=device_id)
-        view_data = [views.InterfaceConfigurationView(iface).data()
-                     for iface in interfaces]
+        interfaces = models.Interface.find_all(device_id=device_id).all()
+        fields = self._extract_fields(request.params)
 
-        return {'instance': {'interfaces': view_data}}
+        def render():
+            view_data = [views.InterfaceConfigurationView(
+                iface, fields=fields).data() for iface in interfaces]
+            return {'instance': {'interfaces': view_data}}
+
+        return self._conditional_response(
+            request,
+            [iface.configuration_version() for iface in interfaces],
+            render)
 
     def delete_all(self, request, device_id):
         LOG.debug("Deleting instance interface (device_id=%s)" % device_id)
@@ -490,8 +629,7 @@ class InstanceInterfacesController(BaseController):
             iface_params.update(dict(tenant_id=tenant_id))
 
         interface = models.Interface.find_by(**iface_params)
-        view_data = views.InterfaceConfigurationView(interface).data()
-        return dict(interface=view_data)
+        return self._interface_response(request, interface)
 
     def delete(self, request, id, device_id):
         interface = models.Interface.find_by(id=id, device_id=device_id)
@@ -534,8 +672,9 @@ class MacAddressRangesController(BaseController, ShowAction, DeleteAction):
         return wsgi.Result(dict(mac_address_range=mac_range.data()), 201)
 
     def index(self, request):
+        fields = self._extract_fields(request.params)
         return dict(
-            mac_address_ranges=[m.data() for m
+            mac_address_ranges=[m.data(fields=fields) for m
                                 in models.MacAddressRange.find_all()])
 
 
@@ -545,7 +684,9 @@ class InterfaceAllowedIpsController(BaseController):
         interface = models.Interface.find_by(
             vif_id_on_device=interface_id,
             tenant_id=tenant_id)
-        return dict(ip_addresses=[ip.data() for ip in interface.ips_allowed()])
+        fields = self._extract_fields(request.params)
+        return dict(ip_addresses=[ip.data(fields=fields)
+                                  for ip in interface.ips_allowed()])
 
     def create(self, request, interface_id, tenant_id, body=None):
         params = self._extract_required_params(body, 'allowed_ip')
@@ -563,7 +704,8 @@ class InterfaceAllowedIpsController(BaseController):
             vif_id_on_device=interface_id,
             tenant_id=tenant_id)
         ip = interface.find_allowed_ip(address)
-        return dict(ip_address=ip.data())
+        return dict(ip_address=ip.data(
+            fields=self._extract_fields(request.params)))
 
     def delete(self, request, interface_id, tenant_id, address):
         interface = models.Interface.find_by(
@@ -572,10 +714,119 @@ class InterfaceAllowedIpsController(BaseController):
         interface.disallow_ip(ip)
 
 
+class ChangesController(BaseController):
+
+    def index(self, request, tenant_id=None):
+        conditions = utils.filter_dict(request.params, 'resource_type')
+        if tenant_id:
+            conditions['tenant_id'] = tenant_id
+        since = self._extract_int_param(request.params, 'since', 0)
+        wait = min(self._extract_int_param(request.params, 'wait', 0),
+                   int(config.Config.get('change_feed_max_wait', 30)))
+        poll_interval = float(config.Config.get('change_feed_poll_interval',
+                                                1))
+        limits = utils.filter_dict(request.params, 'limit')
+        fields = self._extract_fields(request.params)
+
+        deadline = time.time() + wait
+        while True:
+            changes = models.Change.find_committed(**conditions)
+            data, next_since = models.Change.paginated_data(changes,
+                                                            fields=fields,
+                                                            marker=since,
+                                                            **limits)
+            if data or time.time() >= deadline:
+                break
+            eventlet.sleep(poll_interval)
+
+        return wsgi.Result(pagination.PaginatedDataView('changes',
+                                                        data,
+                                                        request.url,
+                                                        next_since,
+                                                        marker_param='since'))
+
+    def _extract_int_param(self, params, param, default):
+        value = utils.parse_int(params.get(param, default))
+        if value is None or value < 0:
+            raise exception.InvalidParamError(value=params[param],
+                                              param=param)
+        return value
+
+
+class BatchController(BaseController):
+    """Runs a list of sub requests through the api's own routes.
+
+    The sub requests share one db session. With atomic set they also
+    share one transaction, and the first failed sub request rolls back
+    all of them and stops the batch. Notifications of an atomic batch are
+    sent only once it commits.
+
+    Sub requests go through admission control one by one when it is in
+    the pipeline.
+
+    """
+
+    def __init__(self, router):
+        self.router = router
+
+    def create(self, request, body=None):
+        params = self._extract_required_params(body, 'batch')
+        sub_requests = params.get('requests')
+        if not sub_requests:
+            raise exception.ParamsMissingError(_("Batch has no requests"))
+        limit = int(config.Config.get('batch_max_requests', 100))
+        if len(sub_requests) > limit:
+            raise exception.BatchTooLargeError(count=len(sub_requests),
+                                               limit=limit)
+        atomic = utils.bool_from_string(params.get('atomic', False))
+
+        responses = []
+        with notifier.deferred(enabled=atomic) as notifications:
+            with db.db_api.unit_of_work(atomic=atomic) as unit:
+                for sub_request in sub_requests:
+                    sub_response = self._dispatch(request, sub_request)
+                    responses.append(self._response_data(sub_response))
+                    if atomic and sub_response.status_int >= 400:
+                        LOG.debug("Rolling back batch after failed %s %s"
+                                  % (sub_request.get('method'),
+                                     sub_request.get('path')))
+                        unit.rollback()
+                        notifications.discard()
+                        return wsgi.Result(
+                            dict(batch={'responses': responses}),
+                            sub_response.status_int)
+
+        return dict(batch={'responses': responses})
+
+    def _dispatch(self, request, sub_request):
+        headers = dict((name, value)
+                       for name, value in request.headers.iteritems()
+                       if name.upper().startswith("X"))
+        headers['Accept'] = "application/json"
+        sub = webob.Request.blank(sub_request.get('path', ""),
+                                  base_url=request.host_url +
+                                  request.script_name,
+                                  method=sub_request.get('method', "GET"),
+                                  headers=headers)
+        if sub_request.get('body') is not None:
+            sub.content_type = "application/json"
+            sub.body = json.dumps(sub_request['body'])
+        admission = request.environ.get('melange.admission_control')
+        if admission is not None:
+            return admission.get_response(sub, self.router)
+        return sub.get_response(self.router)
+
+    def _response_data(self, response):
+        body = None
+        if response.body and response.content_type == "application/json":
+            body = json.loads(response.body)
+        return {'status': response.status_int, 'body': body}
+
+
 class APICommon(wsgi.Router):
 
     def __init__(self):
-        mapper = routes.Mapper()
+        mapper = wsgi.CompiledMapper()
         super(APICommon, self).__init__(mapper)
         self._natting_mapper(mapper,
                              "inside_globals",
@@ -589,6 +840,20 @@ class APICommon(wsgi.Router):
         self._ip_routes_mapper(mapper)
         self._instance_interface_mapper(mapper)
         self._mac_address_range_mapper(mapper)
+        self._changes_mapper(mapper)
+
+    def _changes_mapper(self, mapper):
+        changes_res = ChangesController().create_resource()
+        _connect(mapper,
+                 "/ipam/changes",
+                 controller=changes_res,
+                 action="index",
+                 conditions=dict(method=['GET']))
+        _connect(mapper,
+                 "/ipam/tenants/{tenant_id}/changes",
+                 controller=changes_res,
+                 action="index",
+                 conditions=dict(method=['GET']))
 
     def _allocated_ips_mapper(self, mapper):
         allocated_ips_res = AllocatedIpAddressesController().create_resource()
@@ -660,8 +925,14 @@ class APICommon(wsgi.Router):
 
     def _block_and_nested_resource_mapper(self, mapper):
         block_resource_path = "/ipam/tenants/{tenant_id}/ip_blocks"
+        block_resource = IpBlockController().create_resource()
         mapper.resource("ip_blocks", block_resource_path,
-                        controller=IpBlockController().create_resource())
+                        controller=block_resource)
+        _connect(mapper,
+                 block_resource_path + "/{id}/free_ranges",
+                 controller=block_resource,
+                 action="free_ranges",
+                 conditions=dict(method=["GET"]))
         block_as_parent = dict(member_name="ip_block",
                                collection_path=block_resource_path)
         self._ip_address_mapper(mapper,
@@ -736,6 +1007,13 @@ class APIV01(APICommon):
     def _networks_mapper(self, mapper):
         resource = NetworksController().create_resource()
         path = "/ipam/tenants/{tenant_id}/networks/{network_id}"
+        # NOTE: connected ahead of the resource, whose member routes would
+        #       take free_ranges for the id of a network
+        _connect(mapper,
+                 path + "/free_ranges",
+                 controller=resource,
+                 action="free_ranges",
+                 conditions=dict(method=['GET']))
         mapper.resource("networks", path, controller=resource)
 
     def _interface_ip_allocations_mapper(self, mapper):
@@ -798,6 +1076,14 @@ class APIV10(APICommon):
     def __init__(self):
         super(APIV10, self).__init__()
         self._instance_interface_ips_mapper(self.map)
+        self._batch_mapper(self.map)
+
+    def _batch_mapper(self, mapper):
+        _connect(mapper,
+                 "/batch",
+                 controller=BatchController(self).create_resource(),
+                 action="create",
+                 conditions=dict(method=['POST']))
 
     def _instance_interface_ips_mapper(self, mapper):
         res = InstanceInterfaceIpsController().create_resource()
@@ -819,5 +1105,24 @@ class APIV10(APICommon):
         return APIV10()
 
 
+def _free_range_element(ip_block, first, last):
+    version = ip_block.geometry().version
+    last_address = address_codec.format_ip(last, version)
+    return last_address, dict(ip_block_id=ip_block.id,
+                              first_address=address_codec.format_ip(first,
+                                                                    version),
+                              last_address=last_address,
+                              size=last - first + 1)
+
+
+def _has_timestamp_after(version, moment):
+    if isinstance(version, datetime.datetime):
+        return version > moment
+    if isinstance(version, (tuple, list)):
+        return any(_has_timestamp_after(part, moment) for part in version)
+    return False
+
+
 def _connect(mapper, path, *args, **kwargs):
-    return mapper.connect(path + "{.format:(json|xml)?}", *args, **kwargs)
+    return mapper.connect(path + "{.format:(json|xml|msgpack)?}",
+                          *args, **kwargs)
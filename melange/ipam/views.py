@@ -15,62 +15,90 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from melange.common import utils
+
 
 class IpConfigurationView(object):
 
-    def __init__(self, *ip_addresses):
+    def __init__(self, *ip_addresses, **options):
         self.ip_addresses = ip_addresses
+        self.fields = options.get('fields')
 
     def data(self):
+        block_fields = _nested_fields(self.fields, 'ip_block')
+        route_fields = _nested_fields(block_fields, 'ip_routes')
         data = []
         for ip in self.ip_addresses:
-            routes = ip.ip_block.ip_routes()
             ip_address_data = self._ip_address_data(ip)
-            block_data = self._block_data(ip.ip_block)
-            routes_data = [self._route_data(route) for route in routes]
-
-            block_data['ip_routes'] = routes_data
-            ip_address_data['ip_block'] = block_data
+            if utils.requested(self.fields, 'ip_block'):
+                block_data = self._block_data(ip.ip_block, block_fields)
+                if utils.requested(block_fields, 'ip_routes'):
+                    routes = ip.ip_block.ip_routes()
+                    block_data['ip_routes'] = [
+                        self._route_data(route, route_fields)
+                        for route in routes]
+                ip_address_data['ip_block'] = block_data
             data.append(ip_address_data)
 
         return data
 
     def _ip_address_data(self, ip):
-        return {'id': ip.id,
-                'interface_id': ip.virtual_interface_id,
-                'address': ip.address,
-                'version': ip.version,
-                }
-
-    def _block_data(self, block):
-        return {'id': block.id,
-                'cidr': block.cidr,
-                'broadcast': block.broadcast,
-                'gateway': block.gateway,
-                'network_id': block.network_id,
-                'network_name': block.network_name,
-                'netmask': block.netmask,
-                'dns1': block.dns1,
-                'dns2': block.dns2,
-                'tenant_id': block.tenant_id,
-                }
-
-    def _route_data(self, route):
-        return {'id': route.id,
-                'destination': route.destination,
-                'gateway': route.gateway,
-                'netmask': route.netmask,
-                }
+        return _select(ip, self.fields,
+                       id='id',
+                       interface_id='virtual_interface_id',
+                       address='address',
+                       version='version')
+
+    def _block_data(self, block, fields):
+        return _select(block, fields,
+                       id='id',
+                       cidr='cidr',
+                       broadcast='broadcast',
+                       gateway='gateway',
+                       network_id='network_id',
+                       network_name='network_name',
+                       netmask='netmask',
+                       dns1='dns1',
+                       dns2='dns2',
+                       tenant_id='tenant_id')
+
+    def _route_data(self, route, fields):
+        return _select(route, fields,
+                       id='id',
+                       destination='destination',
+                       gateway='gateway',
+                       netmask='netmask')
 
 
 class InterfaceConfigurationView(object):
 
-    def __init__(self, interface):
+    def __init__(self, interface, **options):
         self.interface = interface
+        self.fields = options.get('fields')
 
     def data(self):
-        data = self.interface.data()
-        data['mac_address'] = self.interface.mac_address_unix_format
-        ip_addresses = self.interface.ip_addresses
-        data['ip_addresses'] = IpConfigurationView(*ip_addresses).data()
+        data = self.interface.data(fields=self.fields)
+        if utils.requested(self.fields, 'mac_address'):
+            data['mac_address'] = self.interface.mac_address_unix_format
+        if utils.requested(self.fields, 'ip_addresses'):
+            ip_addresses = self.interface.ip_addresses
+            ip_fields = _nested_fields(self.fields, 'ip_addresses')
+            data['ip_addresses'] = IpConfigurationView(
+                *ip_addresses, fields=ip_fields).data()
         return data
+
+
+def _nested_fields(fields, name):
+    """Returns the fields selected under name, or None to select all."""
+    if fields is None or name in fields:
+        return None
+    prefix = name + "."
+    return [field[len(prefix):] for field in fields
+            if field.startswith(prefix)]
+
+
+def _select(model, fields, **attributes):
+    """Reads only the selected attributes, as they may be expensive."""
+    return dict((key, getattr(model, attribute))
+                for key, attribute in attributes.iteritems()
+                if utils.requested(fields, key))
@@ -15,17 +15,28 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import netaddr
+import itertools
+import logging
 
+from melange.common import address_codec
 from melange.common import exception
+from melange.common import utils
 from melange.db import db_api
+from melange.ipam import models as ipam_models
 from melange.ipv4.db_based_ip_generator import models
 
 
+LOG = logging.getLogger('melange.ipv4.db_based_ip_generator.generator')
+
+
 class DbBasedIpGenerator(object):
 
+    recovered_batch_size = 1000
+
     def __init__(self, ip_block):
         self.ip_block = ip_block
+        self._recovered = False
+        self._handed_out = set()
 
     def next_ip(self):
         allocatable_address = db_api.pop_allocatable_address(
@@ -34,21 +45,156 @@ class DbBasedIpGenerator(object):
         if allocatable_address is not None:
                 return allocatable_address
 
-        ips = netaddr.IPNetwork(self.ip_block.cidr)
+        geometry = self.ip_block.geometry()
         allocatable_ip_counter = (self.ip_block.allocatable_ip_counter
-                                  or int(ips[0]))
+                                  or geometry.first)
 
-        if(allocatable_ip_counter > int(ips[-1])):
+        if(allocatable_ip_counter > geometry.last):
+            if self._recover_free_addresses():
+                return self.next_ip()
             raise exception.NoMoreAddressesError
 
-        address = str(netaddr.IPAddress(allocatable_ip_counter))
+        address = address_codec.format_ip(allocatable_ip_counter, 4)
         self.ip_block.update(allocatable_ip_counter=allocatable_ip_counter + 1)
 
         return address
 
+    def next_ips(self, count):
+        """Up to count addresses, reserving counter values in one update."""
+        addresses = db_api.pop_allocatable_addresses(
+            models.AllocatableIp, count, ip_block_id=self.ip_block.id)
+        if len(addresses) == count:
+            self._handed_out.update(addresses)
+            return addresses
+
+        geometry = self.ip_block.geometry()
+        allocatable_ip_counter = (self.ip_block.allocatable_ip_counter
+                                  or geometry.first)
+        reserved_until = min(allocatable_ip_counter + count - len(addresses),
+                             geometry.last + 1)
+
+        if reserved_until > allocatable_ip_counter:
+            addresses.extend(address_codec.format_ip(counter, 4) for counter
+                             in xrange(allocatable_ip_counter, reserved_until))
+            self.ip_block.update(allocatable_ip_counter=reserved_until)
+
+        if not addresses:
+            if self._recover_free_addresses():
+                return self.next_ips(count)
+            raise exception.NoMoreAddressesError
+        self._handed_out.update(addresses)
+        return addresses
+
+    def _recover_free_addresses(self):
+        """Puts up to recovered_batch_size of the unallocated addresses of
+        an exhausted block back in the allocatable list, once per generator.
+
+        Addresses freed without going through ip_removed are otherwise lost
+        once the counter passes the end of the block. Recovering a bounded
+        batch keeps the allocation that ran into exhaustion short; fsck
+        --repair recovers the rest at once. Returns whether any were found.
+
+        """
+        if self._recovered:
+            return False
+        self._recovered = True
+        try:
+            recovered = self.recover_free_addresses(
+                limit=self.recovered_batch_size)
+        except exception.DBConstraintError:
+            LOG.debug("Free addresses of block %s were recovered "
+                      "concurrently" % self.ip_block.id)
+            return True
+        return recovered > 0
+
+    def recover_free_addresses(self, limit=None):
+        """Puts the unallocated addresses, or the first limit of them, back
+        in the allocatable list, and returns how many.
+
+        A concurrent recovery of the same block runs into the unique
+        (ip_block_id, address) index instead of putting its addresses back
+        a second time.
+
+        """
+        addresses = self.unallocated_addresses()
+        if limit is not None:
+            addresses = itertools.islice(addresses, limit)
+
+        # NOTE: an address allocated concurrently may still be recovered;
+        #       allocating it later runs into the unique constraint and is
+        #       retried like any other taken address
+        recovered = 0
+        for batch in utils.chunks(addresses, self.recovered_batch_size):
+            models.AllocatableIp.create_all(
+                [dict(ip_block_id=self.ip_block.id, address=address)
+                 for address in batch])
+            recovered += len(batch)
+        if recovered:
+            LOG.info("Recovered %d free addresses of exhausted block %s"
+                     % (recovered, self.ip_block.id))
+        return recovered
+
+    def unallocated_addresses(self):
+        """The allocatable addresses of the block that nothing is allocated
+        at and that are not in the allocatable list, in address order.
+
+        The addresses this generator handed out before are left out, as
+        they may not be inserted yet.
+
+        """
+        geometry = self.ip_block.geometry()
+        allocated = sorted(
+            address_codec.parse_ip(row['address'])[1] for row
+            in ipam_models.IpAddress.find_all(
+                ip_block_id=self.ip_block.id).iter_rows(['address'],
+                                                        limit=None))
+        unavailable = set(address_codec.parse_ip(address)[1] for address
+                          in [self.ip_block.gateway, self.ip_block.broadcast]
+                          if address)
+        skipped = self._handed_out.union(self.allocatable_addresses())
+        free_addresses = (address_codec.format_ip(value, 4) for value
+                          in _gaps(allocated, geometry.first, geometry.last)
+                          if value not in unavailable)
+        free_addresses = (address for address in free_addresses
+                          if address not in skipped)
+        policy = self.ip_block.policy()
+        if policy is not None:
+            free_addresses = (address for address in free_addresses
+                              if policy.allows(self.ip_block.cidr, address))
+        return free_addresses
+
     def ip_removed(self, address):
-        models.AllocatableIp.create(ip_block_id=self.ip_block.id,
-                                    address=address)
+        try:
+            models.AllocatableIp.create(ip_block_id=self.ip_block.id,
+                                        address=address)
+        except exception.DBConstraintError:
+            LOG.debug("Address %s of block %s is allocatable already"
+                      % (address, self.ip_block.id))
+
+    def allocatable_addresses(self):
+        return [allocatable_ip.address for allocatable_ip
+                in models.AllocatableIp.find_all(ip_block_id=self.ip_block.id)]
+
+    def remove_allocatable_addresses(self, addresses):
+        db_api.delete_allocatable_addresses(models.AllocatableIp, addresses,
+                                            ip_block_id=self.ip_block.id)
 
     def delete(self):
         models.AllocatableIp.find_all(ip_block_id=self.ip_block.id).delete()
+
+
+def _gaps(allocated, first, last):
+    """The values from first to last missing from the sorted allocated
+    values, found in one pass over them.
+
+    """
+    expected = first
+    for value in allocated:
+        if value > last:
+            break
+        if value >= expected:
+            for gap in xrange(expected, value):
+                yield gap
+            expected = value + 1
+    for gap in xrange(expected, last + 1):
+        yield gap
@@ -22,22 +22,22 @@ class RFC2462IpV6Generator(object):
 
     required_params = ["mac_address"]
 
+    # NOTE: the universal/local bit of the modified EUI-64 interface id
+    universal_local_bit = 0x02 << 56
+
     def __init__(self, cidr, **kwargs):
-        self._cidr = cidr
-        self._mac_address = netaddr.EUI(kwargs['mac_address'])
+        network = netaddr.IPNetwork(cidr)
+        self._network = int(network.cidr.ip)
+        self._hostmask = int(network.hostmask)
+        self._mac_address = int(netaddr.EUI(kwargs['mac_address']))
 
     def next_ip(self):
-        address = self._deduce_ip_address()
-        next_mac = int(self._mac_address) + 1
-        self._mac_address = netaddr.EUI(next_mac)
-        return address
-
-    def _deduce_ip_address(self):
-        variable_segment = self._variable_segment()
-        network = netaddr.IPNetwork(self._cidr)
-        return str(variable_segment & network.hostmask | network.cidr.ip)
-
-    def _variable_segment(self):
-        mac64 = self._mac_address.eui64().words
-        int_addr = int(''.join(['%02x' % i for i in mac64]), 16)
-        return netaddr.IPAddress(int_addr) ^ netaddr.IPAddress("::0200:0:0:0")
+        mac = self._mac_address
+        self._mac_address += 1
+        eui64 = (mac >> 24) << 40 | 0xfffe << 24 | mac & 0xffffff
+        variable_segment = eui64 ^ self.universal_local_bit
+        return str(netaddr.IPAddress(
+            variable_segment & self._hostmask | self._network, 6))
+
+    def next_ips(self, count):
+        return [self.next_ip() for i in range(count)]
@@ -24,25 +24,30 @@ class TenantBasedIpV6Generator(object):
     required_params = ["used_by_tenant", "mac_address"]
 
     def __init__(self, cidr, **kwargs):
-        self._cidr = cidr
-        self._tenant_id = kwargs['used_by_tenant']
-        self._mac_address = netaddr.EUI(kwargs['mac_address'])
+        network = netaddr.IPNetwork(cidr)
+        self._network = int(network.cidr.ip)
+        self._hostmask = int(network.hostmask)
+        tenant_hash = hashlib.sha1(kwargs['used_by_tenant']).hexdigest()
+        # NOTE: the first 32 bits of the tenant hash, followed by 0xff and
+        # the 24 bits of the mac address that vary between interfaces
+        self._tenant_segment = int(tenant_hash[:8], 16) << 32 | 0xff << 24
+        self._first_mac_address = int(netaddr.EUI(kwargs['mac_address']))
+        self._mac_address = self._first_mac_address
 
     def next_ip(self):
-        address = self._deduce_ip_address()
-        next_mac = int(self._mac_address) + 1
-        self._mac_address = netaddr.EUI(next_mac)
-        return address
-
-    def _deduce_ip_address(self):
-        variable_segment = self._variable_segment()
-        network = netaddr.IPNetwork(self._cidr)
-        return str(variable_segment & network.hostmask | network.cidr.ip)
-
-    def _variable_segment(self):
-        tenant_hash = hashlib.sha1(self._tenant_id).hexdigest()
-        first_2_segments = int(tenant_hash[:8], 16) << 32
-        constant = 0xff << 24
-        ei_mac_address = int(self._mac_address) & int("ffffff", 16)
-        last_2_segments = constant | ei_mac_address
-        return netaddr.IPAddress(first_2_segments | last_2_segments)
+        variable_segment = self._tenant_segment | self._mac_address & 0xffffff
+        self._mac_address += 1
+        return str(netaddr.IPAddress(
+            variable_segment & self._hostmask | self._network, 6))
+
+    def next_ips(self, count):
+        return [self.next_ip() for i in range(count)]
+
+    def skip(self, offset):
+        """Continues from offset addresses past the interface's own one."""
+        self._mac_address = self._first_mac_address + offset
+
+    def offset_of(self, address):
+        """How many addresses past the interface's own one address is."""
+        return ((int(netaddr.IPAddress(address)) - self._first_mac_address)
+                & 0xffffff)
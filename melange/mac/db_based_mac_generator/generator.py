@@ -34,6 +34,22 @@ class DbBasedMacGenerator(object):
         self.mac_range.update(next_address=address + 1)
         return address
 
+    def next_macs(self, count):
+        """Up to count addresses, reserving counter values in one update."""
+        addresses = db_api.pop_allocatable_addresses(
+            models.AllocatableMac, count,
+            mac_address_range_id=self.mac_range.id)
+        if len(addresses) == count:
+            return addresses
+
+        next_address = self._next_eligible_address()
+        reserved_until = min(next_address + count - len(addresses),
+                             self.mac_range.last_address() + 1)
+        if reserved_until > next_address:
+            addresses.extend(xrange(next_address, reserved_until))
+            self.mac_range.update(next_address=reserved_until)
+        return addresses
+
     def _next_eligible_address(self):
         return self.mac_range.next_address or self.mac_range.first_address()
 
@@ -44,3 +60,8 @@ class DbBasedMacGenerator(object):
         models.AllocatableMac.create(
             mac_address_range_id=self.mac_range.id,
             address=address)
+
+    def allocatable_addresses(self):
+        return [allocatable_mac.address for allocatable_mac
+                in models.AllocatableMac.find_all(
+                    mac_address_range_id=self.mac_range.id)]
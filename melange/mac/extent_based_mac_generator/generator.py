@@ -0,0 +1,105 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from melange.db import db_api
+from melange.ipam import models as ipam_models
+from melange.mac.extent_based_mac_generator import models
+
+
+class ExtentBasedMacGenerator(object):
+    """Allocates freed addresses of a range from coalesced extents before
+    moving the range's next_address counter.
+
+    Both are claimed with conditional updates, so concurrent allocations
+    retry on a changed row instead of waiting on a locked one, and a mass
+    release of addresses leaves a handful of extents behind rather than a
+    row per address.
+
+    """
+
+    def __init__(self, mac_range):
+        self.mac_range = mac_range
+
+    def next_mac(self):
+        addresses = self.next_macs(1)
+        if not addresses:
+            raise ipam_models.NoMoreMacAddressesError()
+        return addresses[0]
+
+    def next_macs(self, count):
+        """Up to count free addresses, freed ones first."""
+        addresses = []
+        while len(addresses) < count:
+            extent = models.FreeMacExtent.lowest(self.mac_range.id)
+            if extent is None:
+                break
+            addresses.extend(extent.claim(count - len(addresses)))
+        if len(addresses) < count:
+            addresses.extend(self._claim_unused(count - len(addresses)))
+        return addresses
+
+    def _claim_unused(self, count):
+        while True:
+            next_address = self._next_eligible_address()
+            last_address = min(next_address + count - 1,
+                               self.mac_range.last_address())
+            if next_address > last_address:
+                return []
+            claimed = ipam_models.MacAddressRange.find_all(
+                id=self.mac_range.id,
+                next_address=self.mac_range.next_address).update(
+                    next_address=last_address + 1)
+            if claimed:
+                self.mac_range.next_address = last_address + 1
+                return range(next_address, last_address + 1)
+            self.mac_range = ipam_models.MacAddressRange.find(
+                self.mac_range.id)
+
+    def _next_eligible_address(self):
+        return self.mac_range.next_address or self.mac_range.first_address()
+
+    def is_full(self):
+        if self._next_eligible_address() <= self.mac_range.last_address():
+            return False
+        return models.FreeMacExtent.get_by(
+            mac_address_range_id=self.mac_range.id) is None
+
+    def mac_removed(self, address):
+        """Frees address, coalescing it with the extents on either side."""
+        address = int(address)
+        range_id = self.mac_range.id
+        with db_api.unit_of_work(atomic=True):
+            before = models.FreeMacExtent.get_by(
+                mac_address_range_id=range_id, last_address=address - 1)
+            after = models.FreeMacExtent.get_by(
+                mac_address_range_id=range_id, first_address=address + 1)
+
+            if before is None and after is not None:
+                if after.prepend_from(address):
+                    return
+                after = None
+
+            last_address = address
+            if (before is not None and after is not None
+                    and after.claim(after.length())):
+                last_address = after.last_address
+            if before is not None and before.extend_to(last_address):
+                return
+
+            models.FreeMacExtent.create(mac_address_range_id=range_id,
+                                        first_address=address,
+                                        last_address=last_address)
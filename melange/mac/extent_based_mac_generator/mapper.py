@@ -0,0 +1,33 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import MetaData
+from sqlalchemy import orm
+from sqlalchemy import Table
+
+from melange.db.sqlalchemy import mappers
+from melange.mac.extent_based_mac_generator import models
+
+
+def map(engine):
+    if mappers.mapping_exists(models.FreeMacExtent):
+        return
+    meta_data = MetaData()
+    meta_data.bind = engine
+    free_mac_extents_table = Table('free_mac_extents', meta_data,
+                                   autoload=True)
+    orm.mapper(models.FreeMacExtent, free_mac_extents_table)
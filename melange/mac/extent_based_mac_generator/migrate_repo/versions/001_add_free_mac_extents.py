@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import ForeignKey
+from sqlalchemy.schema import Column
+from sqlalchemy.schema import Index
+from sqlalchemy.schema import MetaData
+
+from melange.db.sqlalchemy.migrate_repo.schema import BigInteger
+from melange.db.sqlalchemy.migrate_repo.schema import create_tables
+from melange.db.sqlalchemy.migrate_repo.schema import DateTime
+from melange.db.sqlalchemy.migrate_repo.schema import drop_tables
+from melange.db.sqlalchemy.migrate_repo.schema import String
+from melange.db.sqlalchemy.migrate_repo.schema import Table
+
+
+meta = MetaData()
+
+free_mac_extents = Table(
+    'free_mac_extents', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('mac_address_range_id', String(36),
+           ForeignKey('mac_address_ranges.id', ondelete="CASCADE"),
+           nullable=False),
+    Column('first_address', BigInteger(), nullable=False),
+    Column('last_address', BigInteger(), nullable=False),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()),
+    Index('free_mac_extents_first_address_idx',
+          'mac_address_range_id', 'first_address'),
+    Index('free_mac_extents_last_address_idx',
+          'mac_address_range_id', 'last_address'))
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    Table('mac_address_ranges', meta, autoload=True)
+    create_tables([free_mac_extents])
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    drop_tables([free_mac_extents])
@@ -0,0 +1,68 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from melange.db import db_api
+from melange.ipam import models
+
+
+class FreeMacExtent(models.ModelBase):
+    """A run of freed addresses of a mac range, first to last inclusive.
+
+    Extents are claimed from and grown with conditional updates, which only
+    apply when the extent still has the bounds it was read with, so that
+    concurrent allocations never take a row lock.
+
+    """
+
+    @classmethod
+    def lowest(cls, mac_address_range_id):
+        return db_api.find_lowest_extent(
+            cls, mac_address_range_id=mac_address_range_id)
+
+    def length(self):
+        return self.last_address - self.first_address + 1
+
+    def claim(self, count):
+        """Takes up to count addresses off the front of the extent.
+
+        Returns no addresses when a concurrent allocation or release changed
+        the extent first.
+
+        """
+        first_address = self.first_address
+        last_address = min(first_address + count - 1, self.last_address)
+        if last_address == self.last_address:
+            claimed = self._unchanged().delete()
+        else:
+            claimed = self._unchanged().update(
+                first_address=last_address + 1)
+        if not claimed:
+            return []
+        return range(first_address, last_address + 1)
+
+    def extend_to(self, last_address):
+        """Grows the extent to end at last_address, unless it changed."""
+        return self._unchanged().update(last_address=last_address) > 0
+
+    def prepend_from(self, first_address):
+        """Grows the extent to start at first_address, unless it changed."""
+        return self._unchanged().update(first_address=first_address) > 0
+
+    def _unchanged(self):
+        return FreeMacExtent.find_all(id=self.id,
+                                      first_address=self.first_address,
+                                      last_address=self.last_address)
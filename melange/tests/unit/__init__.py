@@ -25,6 +25,7 @@ from melange.common import wsgi
 from melange.db import db_api
 from melange.ipv4 import db_based_ip_generator
 from melange.mac import db_based_mac_generator
+from melange.mac import extent_based_mac_generator
 
 
 def sanitize(data):
@@ -75,4 +76,5 @@ def setup():
     options = {"config_file": tests.test_config_file()}
     conf = config.Config.load_paste_config("melange", options, None)
 
-    db_api.db_reset(conf, db_based_ip_generator, db_based_mac_generator)
+    db_api.db_reset(conf, db_based_ip_generator, db_based_mac_generator,
+                    extent_based_mac_generator)
@@ -53,10 +53,83 @@ class TestDbBasedIpGenerator(tests.BaseTest):
         full_counter = int(netaddr.IPAddress("10.0.0.8"))
         block = factory_models.PrivateIpBlockFactory(
             cidr="10.0.0.0/29", allocatable_ip_counter=full_counter)
+        for address in netaddr.IPNetwork("10.0.0.0/29")[:-1]:
+            factory_models.IpAddressFactory(ip_block_id=block.id,
+                                            address=str(address))
 
         self.assertRaises(exception.NoMoreAddressesError,
                           generator.DbBasedIpGenerator(block).next_ip)
 
+    def test_next_ip_recovers_free_addresses_when_counter_overflows(self):
+        full_counter = int(netaddr.IPAddress("10.0.0.8"))
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29", allocatable_ip_counter=full_counter,
+            gateway="10.0.0.1")
+        for address in ["10.0.0.0", "10.0.0.3", "10.0.0.4", "10.0.0.6"]:
+            factory_models.IpAddressFactory(ip_block_id=block.id,
+                                            address=address)
+
+        address = generator.DbBasedIpGenerator(block).next_ip()
+
+        free_addresses = generator.DbBasedIpGenerator(
+            block).allocatable_addresses()
+        self.assertEqual(sorted([address] + free_addresses),
+                         ["10.0.0.2", "10.0.0.5"])
+
+    def test_next_ip_recovers_one_batch_of_free_addresses_at_a_time(self):
+        full_counter = int(netaddr.IPAddress("10.0.0.8"))
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29", allocatable_ip_counter=full_counter,
+            gateway="10.0.0.1")
+        ip_generator = generator.DbBasedIpGenerator(block)
+        ip_generator.recovered_batch_size = 2
+
+        address = ip_generator.next_ip()
+
+        self.assertEqual(
+            sorted([address] + ip_generator.allocatable_addresses()),
+            ["10.0.0.0", "10.0.0.2"])
+
+    def test_next_ips_recovers_only_free_addresses_allowed_by_policy(self):
+        policy = factory_models.PolicyFactory()
+        factory_models.IpRangeFactory(policy_id=policy.id, offset=2,
+                                      length=1)
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/30", policy_id=policy.id,
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.4")))
+        factory_models.IpAddressFactory(ip_block_id=block.id,
+                                        address="10.0.0.0")
+
+        addresses = generator.DbBasedIpGenerator(block).next_ips(5)
+
+        self.assertEqual(addresses, ["10.0.0.1"])
+
+    def test_next_ips_recovers_after_handing_out_unallocatable_address(self):
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.7")))
+        for address in ["10.0.0.0", "10.0.0.1", "10.0.0.3", "10.0.0.4",
+                        "10.0.0.5", "10.0.0.6"]:
+            factory_models.IpAddressFactory(ip_block_id=block.id,
+                                            address=address)
+        ip_generator = generator.DbBasedIpGenerator(block)
+
+        self.assertEqual(ip_generator.next_ips(1), ["10.0.0.7"])
+        self.assertEqual(ip_generator.next_ips(1), ["10.0.0.2"])
+
+    def test_next_ips_does_not_recover_addresses_it_handed_out(self):
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.6")))
+        for address in netaddr.IPNetwork("10.0.0.0/29")[:6]:
+            factory_models.IpAddressFactory(ip_block_id=block.id,
+                                            address=str(address))
+        ip_generator = generator.DbBasedIpGenerator(block)
+
+        self.assertEqual(ip_generator.next_ips(2), ["10.0.0.6", "10.0.0.7"])
+        self.assertRaises(exception.NoMoreAddressesError,
+                          ip_generator.next_ips, 2)
+
     def test_next_ip_picks_from_allocatable_list_even_if_cntr_overflows(self):
         full_counter = int(netaddr.IPAddress("10.0.0.8"))
         block = factory_models.PrivateIpBlockFactory(
@@ -68,6 +141,38 @@ class TestDbBasedIpGenerator(tests.BaseTest):
 
         self.assertEqual(address, "10.0.0.4")
 
+    def test_next_ips_picks_from_allocatable_ip_list_then_counter(self):
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/24",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.5")))
+        factories.AllocatableIpFactory(ip_block_id=block.id,
+                                       address="10.0.0.2")
+
+        addresses = generator.DbBasedIpGenerator(block).next_ips(3)
+
+        self.assertEqual(addresses, ["10.0.0.2", "10.0.0.5", "10.0.0.6"])
+        reloaded_counter = models.IpBlock.find(block.id).allocatable_ip_counter
+        self.assertEqual(str(netaddr.IPAddress(reloaded_counter)),
+                         "10.0.0.7")
+        self.assertIsNone(ipv4_models.AllocatableIp.get_by(
+            ip_block_id=block.id))
+
+    def test_next_ips_returns_fewer_addresses_at_end_of_block(self):
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.6")))
+        for address in netaddr.IPNetwork("10.0.0.0/29")[:6]:
+            factory_models.IpAddressFactory(ip_block_id=block.id,
+                                            address=str(address))
+
+        addresses = generator.DbBasedIpGenerator(block).next_ips(5)
+
+        self.assertEqual(addresses, ["10.0.0.6", "10.0.0.7"])
+        factory_models.IpAddressFactory(ip_block_id=block.id,
+                                        address="10.0.0.6")
+        self.assertRaises(exception.NoMoreAddressesError,
+                          generator.DbBasedIpGenerator(block).next_ips, 5)
+
     def test_ip_removed_adds_ip_to_allocatable_list(self):
         block = factory_models.PrivateIpBlockFactory(
             cidr="10.0.0.0/29")
@@ -79,3 +184,23 @@ class TestDbBasedIpGenerator(tests.BaseTest):
             ip_block_id=block.id)
 
         self.assertIsNotNone(allocatable_ip)
+
+    def test_ip_removed_twice_adds_ip_to_allocatable_list_once(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        ip_generator = generator.DbBasedIpGenerator(block)
+
+        ip_generator.ip_removed("10.0.0.2")
+        ip_generator.ip_removed("10.0.0.2")
+
+        self.assertEqual(ip_generator.allocatable_addresses(), ["10.0.0.2"])
+
+    def test_remove_allocatable_addresses_removes_them_from_the_list(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        ip_generator = generator.DbBasedIpGenerator(block)
+        ip_generator.ip_removed("10.0.0.2")
+        ip_generator.ip_removed("10.0.0.3")
+        ip_generator.ip_removed("10.0.0.3")
+
+        ip_generator.remove_allocatable_addresses(["10.0.0.3"])
+
+        self.assertEqual(ip_generator.allocatable_addresses(), ["10.0.0.2"])
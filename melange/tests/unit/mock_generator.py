@@ -15,6 +15,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
+
 
 class MockIpV6Generator(object):
 
@@ -26,3 +28,18 @@ class MockIpV6Generator(object):
 
     def next_ip(self):
         return self.ips.next()
+
+    def next_ips(self, count):
+        return list(itertools.islice(self.ips, count))
+
+
+class MockIpV4Generator(object):
+
+    ip_list = ["10.0.0.4", "10.0.0.5"]
+
+    def __init__(self, ip_block):
+        self.ip_block = ip_block
+        self.ips = iter(self.ip_list)
+
+    def next_ip(self):
+        return self.ips.next()
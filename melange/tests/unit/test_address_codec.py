@@ -0,0 +1,91 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import random
+
+import netaddr
+
+from melange.common import address_codec
+from melange import tests
+
+
+def netaddr_stored_form(address):
+    return netaddr.IPAddress(address).format(
+        dialect=netaddr.strategy.ipv6.ipv6_verbose)
+
+
+def random_ip_forms():
+    for i in range(200):
+        value = random.choice([random.getrandbits(32),
+                               random.getrandbits(128),
+                               random.getrandbits(16),
+                               0xffff << 32 | random.getrandbits(32)])
+        ip = netaddr.IPAddress(value)
+        yield value
+        yield str(ip)
+        yield str(ip).upper()
+        yield netaddr_stored_form(value)
+
+
+class TestIpCodec(tests.BaseTest):
+
+    def test_canonical_ip_matches_netaddr_stored_form(self):
+        for address in random_ip_forms():
+            self.assertEqual(address_codec.canonical_ip(address),
+                             netaddr_stored_form(address))
+
+    def test_canonical_ip_of_edge_addresses(self):
+        for address in ["0.0.0.0", "255.255.255.255", "::", "1::",
+                        "::ffff:1.2.3.4", "fe80::1"]:
+            self.assertEqual(address_codec.canonical_ip(address),
+                             netaddr_stored_form(address))
+
+    def test_ip_version_and_last_word_match_netaddr(self):
+        for address in random_ip_forms():
+            ip = netaddr.IPAddress(address)
+            self.assertEqual(address_codec.ip_version(address), ip.version)
+            self.assertEqual(address_codec.last_word(address), ip.words[-1])
+
+    def test_parse_ip_returns_version_and_value(self):
+        self.assertEqual(address_codec.parse_ip("10.0.0.1"), (4, 0x0a000001))
+        self.assertEqual(address_codec.parse_ip("fe::1"), (6, 0xfe << 112 | 1))
+
+    def test_invalid_ips_raise_netaddr_errors(self):
+        for address in ["10.0.0.256", "fe::1::2", "junk"]:
+            self.assertRaises(netaddr.AddrFormatError,
+                              address_codec.canonical_ip, address)
+
+
+class TestMacCodec(tests.BaseTest):
+
+    def test_mac_value_and_format_match_netaddr(self):
+        for i in range(200):
+            eui = netaddr.EUI(random.getrandbits(48))
+            for address in [int(eui), str(eui), str(eui).lower(),
+                            str(eui).replace("-", ":")]:
+                self.assertEqual(address_codec.mac_value(address), int(eui))
+                self.assertEqual(address_codec.format_mac(address),
+                                 str(eui))
+
+    def test_mac_value_falls_back_to_netaddr_for_other_formats(self):
+        self.assertEqual(address_codec.mac_value("bc76.4e20.0001"),
+                         int(netaddr.EUI("bc76.4e20.0001")))
+
+    def test_invalid_macs_raise_netaddr_errors(self):
+        for address in ["BC:76:4E:20:00", "BC:76-4E:20:00:01", "junk"]:
+            self.assertRaises(netaddr.AddrFormatError,
+                              address_codec.mac_value, address)
@@ -0,0 +1,172 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import webob
+import webob.dec
+
+from melange import tests
+from melange.common import admission
+
+
+class SlowTestApp(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = 0
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        self.calls += 1
+        eventlet.sleep(self.delay)
+        return webob.Response(body="allocated")
+
+
+class TestAdmissionControlMiddleware(tests.BaseTest):
+
+    allocation_path = ("/ipam/tenants/%s/networks/1/interfaces/vif/"
+                       "ip_allocations")
+
+    def _allocate(self, app, tenant_id="tnt"):
+        request = webob.Request.blank(self.allocation_path % tenant_id,
+                                      method="POST")
+        return request.get_response(app)
+
+    def test_turns_away_tenant_over_its_rate(self):
+        dummy_app = SlowTestApp()
+        middleware = admission.AdmissionControlMiddleware(dummy_app,
+                                                          tenant_rate="0.5",
+                                                          tenant_burst="2")
+
+        responses = [self._allocate(middleware) for i in range(3)]
+        other_tenant_response = self._allocate(middleware, "other_tnt")
+
+        self.assertEqual([response.status_int for response in responses],
+                         [200, 200, 429])
+        self.assertEqual(responses[2].headers['Retry-After'], "2")
+        self.assertIn("Too many allocation requests", responses[2].body)
+        self.assertEqual(other_tenant_response.status_int, 200)
+        self.assertEqual(dummy_app.calls, 3)
+
+    def test_turns_away_tenant_over_its_concurrency(self):
+        dummy_app = SlowTestApp(delay=0.01)
+        middleware = admission.AdmissionControlMiddleware(
+            dummy_app, tenant_concurrency="2")
+
+        pool = eventlet.GreenPool()
+        responses = list(pool.imap(lambda i: self._allocate(middleware),
+                                   range(3)))
+
+        self.assertEqual(sorted(response.status_int
+                                for response in responses),
+                         [200, 200, 429])
+        self.assertEqual(middleware._tenant_in_flight, {})
+
+    def test_does_not_limit_other_requests(self):
+        dummy_app = SlowTestApp()
+        middleware = admission.AdmissionControlMiddleware(dummy_app,
+                                                          tenant_rate="0.5",
+                                                          tenant_burst="1")
+
+        responses = [webob.Request.blank("/ipam/tenants/tnt/ip_blocks",
+                                         method="POST").get_response(
+                                             middleware)
+                     for i in range(3)]
+
+        self.assertEqual([response.status_int for response in responses],
+                         [200] * 3)
+
+    def test_get_response_admits_requests_for_another_application(self):
+        sub_app = SlowTestApp()
+        middleware = admission.AdmissionControlMiddleware(SlowTestApp(),
+                                                          tenant_rate="0.5",
+                                                          tenant_burst="1")
+
+        responses = [middleware.get_response(
+            webob.Request.blank(self.allocation_path % "tnt", method="POST"),
+            sub_app) for i in range(2)]
+
+        self.assertEqual([response.status_int for response in responses],
+                         [200, 429])
+        self.assertEqual(sub_app.calls, 1)
+
+    def test_keeps_buckets_of_most_recent_tenants_only(self):
+        middleware = admission.AdmissionControlMiddleware(SlowTestApp(),
+                                                          max_tenants="4")
+
+        for i in range(10):
+            self._allocate(middleware, "tnt%s" % i)
+
+        self.assertTrue(len(middleware._buckets) <= 4)
+        self.assertIn("tnt9", middleware._buckets)
+
+    def test_turns_away_all_tenants_over_adapted_concurrency(self):
+        dummy_app = SlowTestApp(delay=0.01)
+        middleware = admission.AdmissionControlMiddleware(
+            dummy_app, min_concurrency="1", max_concurrency="2")
+
+        pool = eventlet.GreenPool()
+        responses = list(pool.imap(lambda tenant_id: self._allocate(
+            middleware, tenant_id), ["tnt1", "tnt2", "tnt3"]))
+
+        self.assertEqual(sorted(response.status_int
+                                for response in responses),
+                         [200, 200, 429])
+
+
+class TestTokenBucket(tests.BaseTest):
+
+    def test_take_refills_at_rate_up_to_burst(self):
+        bucket = admission.TokenBucket(rate=2, burst=2, now=0)
+
+        self.assertEqual([bucket.take(now=0) for i in range(2)], [0, 0])
+        self.assertEqual(bucket.take(now=0), 0.5)
+        self.assertEqual(bucket.take(now=0.5), 0)
+        self.assertEqual(bucket.take(now=100), 0)
+        self.assertEqual(bucket.tokens, 1)
+
+
+class TestAimdLimit(tests.BaseTest):
+
+    def test_increases_additively_while_latency_is_on_target(self):
+        limit = admission.AimdLimit(min_concurrency=1, max_concurrency=10,
+                                    target_latency=1)
+        limit.concurrency = 4
+
+        limit.observe(latency=0.5, now=0)
+
+        self.assertEqual(limit.concurrency, 4.25)
+
+    def test_decreases_multiplicatively_once_per_target_latency(self):
+        limit = admission.AimdLimit(min_concurrency=1, max_concurrency=10,
+                                    target_latency=1)
+
+        limit.observe(latency=2, now=0)
+        limit.observe(latency=2, now=0.5)
+        self.assertEqual(limit.concurrency, 9)
+
+        limit.observe(latency=2, now=1)
+        self.assertEqual(limit.concurrency, 8.1)
+
+    def test_does_not_go_below_min_concurrency(self):
+        limit = admission.AimdLimit(min_concurrency=5, max_concurrency=10,
+                                    target_latency=1)
+
+        for now in range(10):
+            limit.observe(latency=2, now=now)
+
+        self.assertEqual(limit.concurrency, 5)
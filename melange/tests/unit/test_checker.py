@@ -0,0 +1,209 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import netaddr
+
+from melange import tests
+from melange.db import db_api
+from melange.ipam import checker
+from melange.ipam import models
+from melange.ipv4.db_based_ip_generator import models as ipv4_models
+from melange.mac.db_based_mac_generator import models as mac_models
+from melange.tests.factories import models as factory_models
+from melange.tests.unit.ipv4.db_based_ip_generator import factories
+
+
+class TestChecker(tests.BaseTest):
+
+    def test_check_finds_free_addresses_that_are_allocated(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/24")
+        factory_models.IpAddressFactory(ip_block_id=block.id,
+                                        address="10.0.0.5")
+        factories.AllocatableIpFactory(ip_block_id=block.id,
+                                       address="10.0.0.5")
+        factories.AllocatableIpFactory(ip_block_id=block.id,
+                                       address="10.0.0.7")
+
+        inconsistencies = checker.Checker().check()
+
+        self.assertEqual(inconsistencies,
+                         [('ip_block', block.id,
+                           "free addresses 10.0.0.5 are allocated")])
+        self.assertEqual(ipv4_models.AllocatableIp.count(), 2)
+
+    def test_check_repairs_free_addresses_that_are_allocated(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/24")
+        factory_models.IpAddressFactory(ip_block_id=block.id,
+                                        address="10.0.0.5")
+        factories.AllocatableIpFactory(ip_block_id=block.id,
+                                       address="10.0.0.5")
+        factories.AllocatableIpFactory(ip_block_id=block.id,
+                                       address="10.0.0.7")
+
+        checker.Checker(repair=True).check()
+
+        self.assertEqual([ip.address for ip
+                          in ipv4_models.AllocatableIp.find_all()],
+                         ["10.0.0.7"])
+
+    def test_check_repairs_counters_past_the_end_of_the_block(self):
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.20")),
+            is_full=True)
+        self._allocate_all_addresses(block)
+
+        inconsistencies = checker.Checker(repair=True).check()
+
+        self.assertEqual([inconsistency.problem
+                          for inconsistency in inconsistencies],
+                         ["allocatable ip counter is past the end of the "
+                          "block"])
+        self.assertEqual(models.IpBlock.find(block.id).allocatable_ip_counter,
+                         int(netaddr.IPAddress("10.0.0.8")))
+
+    def test_check_repairs_full_flags_of_blocks_with_free_addresses(self):
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.8")),
+            is_full=True)
+        factories.AllocatableIpFactory(ip_block_id=block.id,
+                                       address="10.0.0.3")
+
+        inconsistencies = checker.Checker(repair=True).check()
+
+        self.assertEqual([inconsistency.problem
+                          for inconsistency in inconsistencies],
+                         ["block is marked full but has free addresses"])
+        self.assertFalse(models.IpBlock.find(block.id).is_full)
+
+    def test_check_leaves_exhausted_full_blocks_alone(self):
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.8")),
+            is_full=True)
+        self._allocate_all_addresses(block)
+
+        self.assertEqual(checker.Checker().check(), [])
+
+    def test_check_repairs_free_addresses_lost_by_exhausted_blocks(self):
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/29",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.8")),
+            is_full=True)
+        self._allocate_all_addresses(block)
+        models.IpAddress.find_all(ip_block_id=block.id,
+                                  address="10.0.0.3").delete()
+        models.IpAddress.find_all(ip_block_id=block.id,
+                                  address="10.0.0.5").delete()
+
+        inconsistencies = checker.Checker(repair=True).check()
+
+        self.assertEqual([inconsistency.problem
+                          for inconsistency in inconsistencies],
+                         ["2 free addresses are missing from the "
+                          "allocatable list",
+                          "block is marked full but has free addresses"])
+        self.assertEqual(sorted(ip.address for ip
+                                in ipv4_models.AllocatableIp.find_all()),
+                         ["10.0.0.3", "10.0.0.5"])
+        self.assertFalse(models.IpBlock.find(block.id).is_full)
+
+    def test_check_repairs_mac_range_counters_past_the_end(self):
+        first = int(netaddr.EUI("BC:76:4E:20:00:00"))
+        mac_range = factory_models.MacAddressRangeFactory(
+            cidr="BC:76:4E:20:0:0/40", next_address=first + 300,
+            is_full=True)
+
+        inconsistencies = checker.Checker(repair=True).check()
+
+        self.assertEqual([inconsistency.problem
+                          for inconsistency in inconsistencies],
+                         ["next address is past the end of the range"])
+        self.assertEqual(
+            models.MacAddressRange.find(mac_range.id).next_address,
+            first + 256)
+
+    def test_check_repairs_full_flags_of_mac_ranges_with_room(self):
+        mac_range = factory_models.MacAddressRangeFactory(
+            cidr="BC:76:4E:20:0:0/40", is_full=True)
+
+        inconsistencies = checker.Checker(repair=True).check()
+
+        self.assertEqual([(inconsistency.resource_type,
+                           inconsistency.problem)
+                          for inconsistency in inconsistencies],
+                         [('mac_address_range',
+                           "range is marked full but has free addresses")])
+        self.assertFalse(models.MacAddressRange.find(mac_range.id).is_full)
+
+    def test_check_finds_full_mac_ranges_with_allocatable_macs(self):
+        first = int(netaddr.EUI("BC:76:4E:20:00:00"))
+        mac_range = factory_models.MacAddressRangeFactory(
+            cidr="BC:76:4E:20:0:0/40", next_address=first + 256,
+            is_full=True)
+        mac_models.AllocatableMac.create(
+            mac_address_range_id=mac_range.id, address=first + 3)
+
+        inconsistencies = checker.Checker().check()
+
+        self.assertEqual([inconsistency.problem
+                          for inconsistency in inconsistencies],
+                         ["range is marked full but has free addresses"])
+
+    def test_check_repairs_mac_addresses_of_deleted_interfaces(self):
+        mac_range = factory_models.MacAddressRangeFactory()
+        interface = factory_models.InterfaceFactory()
+        mac_address = mac_range.allocate_mac(interface_id=interface.id)
+        models.Interface.find_all(id=interface.id).delete()
+
+        inconsistencies = checker.Checker(repair=True).check()
+
+        self.assertEqual([(inconsistency.resource_type,
+                           inconsistency.resource_id)
+                          for inconsistency in inconsistencies],
+                         [('mac_address', mac_address.id)])
+        self.assertIsNone(models.MacAddress.get(mac_address.id))
+
+    def test_check_repairs_nat_relationships_of_deleted_addresses(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/24")
+        local_ip = factory_models.IpAddressFactory(ip_block_id=block.id)
+        global_ip = factory_models.IpAddressFactory(ip_block_id=block.id)
+        global_ip.add_inside_locals([local_ip])
+        models.IpAddress.find_all(id=local_ip.id).delete()
+
+        inconsistencies = checker.Checker(repair=True).check()
+
+        self.assertEqual([inconsistency.resource_type
+                          for inconsistency in inconsistencies], ['ip_nat'])
+        self.assertEqual(db_api.find_natted_ips().count(), 0)
+
+    def _allocate_all_addresses(self, block):
+        for address in netaddr.IPNetwork(block.cidr)[:-1]:
+            factory_models.IpAddressFactory(ip_block_id=block.id,
+                                            address=str(address))
+
+    def test_report_lists_inconsistencies_with_a_count(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/24",
+                                                     is_full=True)
+        ipam_checker = checker.Checker()
+        ipam_checker.check()
+
+        self.assertEqual(ipam_checker.report(),
+                         ["ip_block %s: block is marked full but has free "
+                          "addresses" % block.id,
+                          "1 inconsistencies found"])
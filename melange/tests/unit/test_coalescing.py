@@ -0,0 +1,153 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import webob
+import webob.dec
+import webob.exc
+
+from melange import tests
+from melange.common import coalescing
+
+
+class CountingTestApp(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = []
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        self.calls.append((req.method, req.path_info))
+        eventlet.sleep(self.delay)
+        return webob.Response(body="response %s" % len(self.calls))
+
+
+class TestCoalescingMiddleware(tests.BaseTest):
+
+    def _get(self, app, path, method="GET", **headers):
+        request = webob.Request.blank(path, method=method, headers=headers)
+        return request.get_response(app)
+
+    def _write(self, app, path):
+        return webob.Request.blank(path, method="PUT").get_response(app)
+
+    def test_concurrent_identical_gets_are_run_once(self):
+        dummy_app = CountingTestApp(delay=0.01)
+        middleware = coalescing.CoalescingMiddleware(dummy_app)
+
+        pool = eventlet.GreenPool()
+        responses = list(pool.imap(lambda i: self._get(middleware,
+                                                       "/ipam/networks/1"),
+                                   range(5)))
+
+        self.assertEqual(len(dummy_app.calls), 1)
+        self.assertEqual([response.body for response in responses],
+                         ["response 1"] * 5)
+
+    def test_gets_for_different_tenants_are_not_coalesced(self):
+        dummy_app = CountingTestApp(delay=0.01)
+        middleware = coalescing.CoalescingMiddleware(dummy_app)
+
+        pool = eventlet.GreenPool()
+        list(pool.imap(lambda tenant: self._get(middleware,
+                                                "/ipam/networks/1",
+                                                X_TENANT=tenant),
+                       ["tnt1", "tnt2"]))
+
+        self.assertEqual(len(dummy_app.calls), 2)
+
+    def test_concurrent_head_and_get_are_not_coalesced(self):
+        dummy_app = CountingTestApp(delay=0.01)
+        middleware = coalescing.CoalescingMiddleware(dummy_app)
+
+        pool = eventlet.GreenPool()
+        list(pool.imap(lambda method: self._get(middleware,
+                                                "/ipam/networks/1",
+                                                method=method),
+                       ["HEAD", "GET"]))
+
+        self.assertEqual(sorted(dummy_app.calls),
+                         [("GET", "/ipam/networks/1"),
+                          ("HEAD", "/ipam/networks/1")])
+
+    def test_sequential_gets_are_not_cached_without_ttl(self):
+        dummy_app = CountingTestApp()
+        middleware = coalescing.CoalescingMiddleware(dummy_app)
+
+        self._get(middleware, "/ipam/networks/1")
+        response = self._get(middleware, "/ipam/networks/1")
+
+        self.assertEqual(response.body, "response 2")
+
+    def test_gets_are_cached_for_ttl(self):
+        dummy_app = CountingTestApp()
+        middleware = coalescing.CoalescingMiddleware(dummy_app,
+                                                     cache_ttl="0.05")
+
+        self._get(middleware, "/ipam/networks/1")
+        cached_response = self._get(middleware, "/ipam/networks/1")
+        eventlet.sleep(0.06)
+        expired_response = self._get(middleware, "/ipam/networks/1")
+
+        self.assertEqual(cached_response.body, "response 1")
+        self.assertEqual(expired_response.body, "response 2")
+
+    def test_write_invalidates_cached_responses_of_same_scope(self):
+        dummy_app = CountingTestApp()
+        middleware = coalescing.CoalescingMiddleware(dummy_app, cache_ttl="5")
+        self._get(middleware, "/ipam/tenants/t/networks/1/interfaces/i1/"
+                  "ip_allocations")
+        self._get(middleware, "/ipam/tenants/t/networks/2/interfaces/i2/"
+                  "ip_allocations")
+
+        self._write(middleware, "/ipam/tenants/t/networks/1/interfaces/i1/"
+                    "ip_allocations")
+
+        self.assertEqual(self._get(middleware, "/ipam/tenants/t/networks/1/"
+                                   "interfaces/i1/ip_allocations").body,
+                         "response 4")
+        self.assertEqual(self._get(middleware, "/ipam/tenants/t/networks/2/"
+                                   "interfaces/i2/ip_allocations").body,
+                         "response 2")
+
+    def test_device_write_invalidates_network_responses(self):
+        dummy_app = CountingTestApp()
+        middleware = coalescing.CoalescingMiddleware(dummy_app, cache_ttl="5")
+        self._get(middleware, "/ipam/tenants/t/networks/1/interfaces/i1/"
+                  "ip_allocations")
+        self._get(middleware, "/ipam/instances/d2/interfaces")
+
+        self._write(middleware, "/ipam/instances/d1/interfaces")
+
+        self.assertEqual(self._get(middleware, "/ipam/tenants/t/networks/1/"
+                                   "interfaces/i1/ip_allocations").body,
+                         "response 4")
+        self.assertEqual(self._get(middleware,
+                                   "/ipam/instances/d2/interfaces").body,
+                         "response 2")
+
+    def test_failed_responses_are_not_cached(self):
+        @webob.dec.wsgify
+        def not_found_app(req):
+            return webob.exc.HTTPNotFound()
+        middleware = coalescing.CoalescingMiddleware(not_found_app,
+                                                     cache_ttl="5")
+
+        self._get(middleware, "/ipam/networks/1")
+
+        self.assertEqual(middleware._cache, {})
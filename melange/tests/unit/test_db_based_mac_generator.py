@@ -54,3 +54,15 @@ class TestDbBasedMacGenerator(tests.BaseTest):
         allocatable_mac = mac_models.AllocatableMac.get_by(
             mac_address_range_id=rng.id)
         self.assertEqual(mac.address, allocatable_mac.address)
+
+    def test_next_macs_reuses_allocatable_macs_then_moves_counter_once(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        first, second = rng.allocate_mac(), rng.allocate_mac()
+        first.delete()
+
+        addresses = generator.DbBasedMacGenerator(rng).next_macs(3)
+
+        self.assertEqual(addresses, [first.address, second.address + 1,
+                                     second.address + 2])
+        self.assertEqual(models.MacAddressRange.get(rng.id).next_address,
+                         second.address + 3)
@@ -0,0 +1,112 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import StringIO
+
+from melange import tests
+from melange.common import exception
+from melange.db import db_api
+from melange.ipam import exporter
+from melange.ipam import importer
+from melange.ipam import models
+from melange.tests.factories import models as factory_models
+
+
+class TestExporter(tests.BaseTest):
+
+    def test_dump_round_trips_through_the_importer(self):
+        parent = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        child = factory_models.IpBlockFactory(cidr="10.0.0.0/26",
+                                              parent_id=parent.id)
+        public = factory_models.PublicIpBlockFactory(cidr="20.0.0.0/24")
+        factory_models.IpRouteFactory(source_block_id=child.id)
+        interface = factory_models.InterfaceFactory()
+        local_ip = child.allocate_ip(interface)
+        global_ip = public.allocate_ip(interface)
+        global_ip.add_inside_locals([local_ip])
+        db_api.save_allowed_ip(interface.id, global_ip.id)
+        released_ip = child.allocate_ip(interface)
+        released_ip.deallocate()
+        expected_child = models.IpBlock.find(child.id)
+
+        records = self._dump()
+        db_api.clean_db()
+        importer.Importer().load(importer.read_records(records))
+
+        imported_child = models.IpBlock.find(child.id)
+        self.assertEqual(imported_child.parent_id, parent.id)
+        self.assertEqual(imported_child.allocatable_ip_counter,
+                         expected_child.allocatable_ip_counter)
+        self.assertEqual(imported_child.created_at, expected_child.created_at)
+        self.assertEqual(len(imported_child.ip_routes()), 1)
+        imported_local_ip = models.IpAddress.find(local_ip.id)
+        self.assertEqual(imported_local_ip.interface_id, interface.id)
+        self.assertEqual([ip.id for ip in imported_local_ip.inside_globals()],
+                         [global_ip.id])
+        self.assertEqual(set(ip.id for ip in interface.ips_allowed()),
+                         set([local_ip.id, global_ip.id]))
+        imported_released_ip = models.IpAddress.find(released_ip.id)
+        self.assertTrue(imported_released_ip.marked_for_deallocation)
+        self.assertIsNotNone(imported_released_ip.deallocated_at)
+
+    def test_dump_writes_blocks_after_their_parent(self):
+        parent = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        child = factory_models.IpBlockFactory(cidr="10.0.0.0/26",
+                                              parent_id=parent.id)
+        grandchild = factory_models.IpBlockFactory(cidr="10.0.0.0/28",
+                                                   parent_id=child.id)
+        exporter_ = exporter.Exporter(StringIO.StringIO())
+
+        blocks = exporter_._parents_first(iter([
+            dict(id=grandchild.id, parent_id=child.id),
+            dict(id=child.id, parent_id=parent.id),
+            dict(id=parent.id)]))
+
+        self.assertEqual([block['id'] for block in blocks],
+                         [parent.id, child.id, grandchild.id])
+
+    def test_dump_leaves_out_empty_columns(self):
+        factory_models.IpBlockFactory(cidr="10.0.0.0/24", gateway="10.0.0.1",
+                                      network_name=None)
+
+        records = [json.loads(line) for line in self._dump()]
+
+        block = [record for record in records
+                 if record['resource_type'] == "ip_block"][0]
+        self.assertNotIn('network_name', block)
+        self.assertEqual(block['gateway'], "10.0.0.1")
+
+    def test_report_counts_exported_records(self):
+        factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        exporter_ = exporter.Exporter(StringIO.StringIO())
+
+        exporter_.dump()
+
+        report = exporter_.report()
+        self.assertIn("ip_block: 1 records", report[0])
+        self.assertIn("exported 1 records", report[-1])
+
+    def test_rejects_unknown_formats(self):
+        self.assertRaises(exception.InvalidParamError,
+                          exporter.Exporter, StringIO.StringIO(), "xml")
+
+    def _dump(self):
+        stream = StringIO.StringIO()
+        exporter.Exporter(stream).dump()
+        stream.seek(0)
+        return stream
@@ -0,0 +1,110 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import netaddr
+
+from melange import tests
+from melange.ipam import models
+from melange.mac.extent_based_mac_generator import generator
+from melange.mac.extent_based_mac_generator import models as mac_models
+from melange.tests.factories import models as factory_models
+
+
+def _mac(address):
+    return int(netaddr.EUI(address))
+
+
+class TestExtentBasedMacGenerator(tests.BaseTest):
+
+    def _extents(self, rng):
+        return sorted((extent.first_address, extent.last_address) for extent
+                      in mac_models.FreeMacExtent.find_all(
+                          mac_address_range_id=rng.id))
+
+    def test_next_mac_moves_next_address_field(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:40:0:0/27")
+
+        address = generator.ExtentBasedMacGenerator(rng).next_mac()
+
+        self.assertEqual(address, _mac("BC:76:4E:40:00:00"))
+        updated_rng = models.MacAddressRange.get(rng.id)
+        self.assertEqual(updated_rng.next_address, _mac("BC:76:4E:40:00:01"))
+
+    def test_next_macs_claims_consecutive_addresses_at_once(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:40:0:0/40")
+        mac_generator = generator.ExtentBasedMacGenerator(rng)
+
+        addresses = mac_generator.next_macs(3)
+
+        first = _mac("BC:76:4E:40:00:00")
+        self.assertEqual(addresses, [first, first + 1, first + 2])
+        self.assertEqual(mac_generator.next_mac(), first + 3)
+
+    def test_next_macs_returns_the_addresses_left_in_range(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:40:0:0/47")
+        mac_generator = generator.ExtentBasedMacGenerator(rng)
+
+        self.assertEqual(len(mac_generator.next_macs(5)), 2)
+        self.assertTrue(mac_generator.is_full())
+        self.assertRaises(models.NoMoreMacAddressesError,
+                          mac_generator.next_mac)
+
+    def test_removed_macs_are_coalesced_into_one_extent(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:40:0:0/40")
+        mac_generator = generator.ExtentBasedMacGenerator(rng)
+        first, second, third, fourth = mac_generator.next_macs(4)
+
+        mac_generator.mac_removed(first)
+        mac_generator.mac_removed(third)
+        mac_generator.mac_removed(fourth)
+        mac_generator.mac_removed(second)
+
+        self.assertEqual(self._extents(rng), [(first, fourth)])
+
+    def test_next_macs_reuses_removed_macs_first(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:40:0:0/40")
+        mac_generator = generator.ExtentBasedMacGenerator(rng)
+        first, second, third = mac_generator.next_macs(3)
+        mac_generator.mac_removed(first)
+        mac_generator.mac_removed(second)
+
+        addresses = mac_generator.next_macs(3)
+
+        self.assertEqual(addresses, [first, second, third + 1])
+        self.assertEqual(self._extents(rng), [])
+
+    def test_claim_takes_nothing_from_an_extent_changed_concurrently(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:40:0:0/40")
+        mac_generator = generator.ExtentBasedMacGenerator(rng)
+        first, second = mac_generator.next_macs(2)
+        mac_generator.mac_removed(first)
+        stale_extent = mac_models.FreeMacExtent.lowest(rng.id)
+        mac_generator.mac_removed(second)
+
+        self.assertEqual(stale_extent.claim(1), [])
+        self.assertEqual(self._extents(rng), [(first, second)])
+
+    def test_range_with_removed_macs_is_not_full(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:40:0:0/48")
+        mac_generator = generator.ExtentBasedMacGenerator(rng)
+        address = mac_generator.next_mac()
+        self.assertTrue(mac_generator.is_full())
+
+        mac_generator.mac_removed(address)
+
+        self.assertFalse(mac_generator.is_full())
+        self.assertEqual(mac_generator.next_mac(), address)
@@ -0,0 +1,288 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import json
+import StringIO
+
+import netaddr
+
+from melange import tests
+from melange.ipam import importer
+from melange.ipam import models
+from melange.tests.factories import models as factory_models
+
+
+def numbered(*records):
+    return list(enumerate(records, 1))
+
+
+def block(id, cidr, **values):
+    record = dict(resource_type="ip_block", id=id, cidr=cidr,
+                  tenant_id="RAX", network_id="net1", type="private")
+    record.update(values)
+    return record
+
+
+def ip(address, ip_block_id, **values):
+    record = dict(resource_type="ip_address", address=address,
+                  ip_block_id=ip_block_id, used_by_tenant_id="RAX")
+    record.update(values)
+    return record
+
+
+class TestImporter(tests.BaseTest):
+
+    def setUp(self):
+        super(TestImporter, self).setUp()
+        self.importer = importer.Importer(chunk_size=2)
+
+    def test_load_imports_records_of_every_type(self):
+        self.importer.load(numbered(
+            dict(resource_type="policy", id="p1", name="policy",
+                 tenant_id="RAX"),
+            dict(resource_type="ip_range", policy_id="p1", offset=0,
+                 length=2),
+            dict(resource_type="ip_octet", policy_id="p1", octet=255),
+            block("b1", "10.0.0.0/24", policy_id="p1"),
+            dict(resource_type="mac_address_range", id="r1",
+                 cidr="BC:76:4E:20:00:00/40"),
+            dict(resource_type="interface", id="i1",
+                 virtual_interface_id="vif1", device_id="dev1",
+                 tenant_id="RAX"),
+            dict(resource_type="mac_address", address="BC:76:4E:20:00:05",
+                 mac_address_range_id="r1", interface_id="i1"),
+            ip("10.0.0.5", "b1", interface_id="i1", used_by_tenant_id=None)))
+
+        ip_address = models.IpAddress.find_by(ip_block_id="b1")
+        self.assertEqual(ip_address.address, "10.0.0.5")
+        self.assertEqual(ip_address.interface_id, "i1")
+        self.assertEqual(ip_address.used_by_tenant_id, "RAX")
+        self.assertEqual(models.Interface.find("i1").virtual_interface_id,
+                         "vif1")
+        mac_address = models.MacAddress.find_by(interface_id="i1")
+        self.assertEqual(mac_address.eui_format, "BC-76-4E-20-00-05")
+        policy = models.Policy.find("p1")
+        self.assertEqual(len(policy.unusable_ip_ranges), 1)
+        self.assertEqual(len(policy.unusable_ip_octets), 1)
+        self.assertEqual(models.IpBlock.find("b1").policy_id, "p1")
+        self.assertEqual(self.importer.counts['ip_address'], 1)
+
+    def test_load_moves_counters_past_highest_imported_address(self):
+        self.importer.load(numbered(
+            block("b1", "10.0.0.0/24"),
+            dict(resource_type="mac_address_range", id="r1",
+                 cidr="BC:76:4E:20:00:00/40"),
+            ip("10.0.0.9", "b1"),
+            ip("10.0.0.3", "b1"),
+            ip("10.0.0.4", "b1"),
+            dict(resource_type="mac_address", address="BC:76:4E:20:00:07",
+                 mac_address_range_id="r1")))
+
+        ip_block = models.IpBlock.find("b1")
+        self.assertEqual(ip_block.allocatable_ip_counter,
+                         int(netaddr.IPAddress("10.0.0.10")))
+        interface = factory_models.InterfaceFactory(tenant_id="RAX")
+        self.assertEqual(ip_block.allocate_ip(interface).address,
+                         "10.0.0.10")
+        mac_range = models.MacAddressRange.find("r1")
+        self.assertEqual(mac_range.next_address,
+                         int(netaddr.EUI("BC:76:4E:20:00:08")))
+
+    def test_load_keeps_counters_already_beyond_imported_addresses(self):
+        ip_block = factory_models.IpBlockFactory(
+            cidr="10.0.0.0/24",
+            allocatable_ip_counter=int(netaddr.IPAddress("10.0.0.50")))
+
+        self.importer.load(numbered(ip("10.0.0.9", ip_block.id)))
+
+        ip_block = models.IpBlock.find(ip_block.id)
+        self.assertEqual(ip_block.allocatable_ip_counter,
+                         int(netaddr.IPAddress("10.0.0.50")))
+
+    def test_load_imports_nat_relationships_and_timestamps(self):
+        self.importer.load(numbered(
+            block("b1", "10.0.0.0/24",
+                  created_at="2011-10-04T05:06:07+02:00"),
+            ip("10.0.0.5", "b1", id="ip1"),
+            ip("10.0.0.6", "b1", id="ip2"),
+            dict(resource_type="ip_nat", inside_local_address_id="ip1",
+                 inside_global_address_id="ip2")))
+
+        local_ip = models.IpAddress.find("ip1")
+        self.assertEqual([ip.id for ip in local_ip.inside_globals()],
+                         ["ip2"])
+        self.assertEqual(models.IpBlock.find("b1").created_at,
+                         datetime.datetime(2011, 10, 4, 3, 6, 7))
+
+    def test_load_rejects_nat_relationships_of_unknown_addresses(self):
+        errors = self._load_errors(dict(resource_type="ip_nat",
+                                        inside_local_address_id="ip1",
+                                        inside_global_address_id="ip2"))
+
+        self.assertEqual(errors, ["line 1: ip address ip1 not found"])
+
+    def test_load_normalizes_cidrs_and_addresses(self):
+        self.importer.load(numbered(block("b1", "fe::1/64"),
+                                    ip("fe::5", "b1")))
+
+        self.assertEqual(models.IpBlock.find("b1").cidr, "fe::/64")
+        self.assertEqual(models.IpAddress.find_by(ip_block_id="b1").address,
+                         "00fe:0000:0000:0000:0000:0000:0000:0005")
+
+    def test_load_records_changes_of_imported_records(self):
+        self.importer.load(numbered(
+            block("b1", "10.0.0.0/24"),
+            dict(resource_type="interface", id="i1",
+                 virtual_interface_id="vif1", device_id="dev1",
+                 tenant_id="RAX"),
+            ip("10.0.0.5", "b1", id="ip1", interface_id="i1")))
+
+        changes = models.Change.find_all().all()
+        self.assertEqual(sorted((change.event, change.resource_type,
+                                 change.resource_id) for change in changes),
+                         [("allocate", "ip_address", "ip1"),
+                          ("create", "interface", "i1"),
+                          ("create", "ip_block", "b1")])
+        payload = json.loads(models.Change.find_by(resource_id="ip1").payload)
+        self.assertEqual(payload['interface_id'], "vif1")
+        self.assertEqual(payload['used_by_device_id'], "dev1")
+
+    def test_load_rejects_overlapping_blocks_in_a_network(self):
+        errors = self._load_errors(block("b1", "10.0.0.0/16"),
+                                   block("b2", "10.1.0.0/24"),
+                                   block("b3", "10.0.5.0/24"))
+
+        self.assertEqual(errors,
+                         ["cidr 10.0.5.0/24 overlaps with block 10.0.0.0/16"])
+        self.assertEqual(models.IpBlock.count(), 0)
+
+    def test_load_rejects_blocks_overlapping_existing_public_blocks(self):
+        factory_models.PublicIpBlockFactory(cidr="20.0.0.0/24",
+                                            network_id="other_net")
+
+        errors = self._load_errors(block("b1", "20.0.0.128/25",
+                                         type="public"))
+
+        self.assertEqual(errors,
+                         ["cidr 20.0.0.128/25 overlaps with block "
+                          "20.0.0.0/24"])
+
+    def test_load_allows_overlapping_private_blocks_of_other_networks(self):
+        factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/24",
+                                             network_id="other_net")
+
+        self.importer.load(numbered(
+            block("b1", "10.0.0.0/24"),
+            block("b2", "10.0.0.0/26", parent_id="b1"),
+            block("b3", "10.0.0.64/26", parent_id="b1")))
+
+        self.assertEqual(models.IpBlock.count(), 4)
+
+    def test_load_rejects_subnets_outside_their_parent(self):
+        errors = self._load_errors(block("b1", "10.0.0.0/24"),
+                                   block("b2", "10.0.1.0/26", parent_id="b1"))
+
+        self.assertEqual(errors,
+                         ["line 2: cidr should be within parent block's "
+                          "cidr"])
+
+    def test_load_rejects_addresses_outside_their_block(self):
+        errors = self._load_errors(block("b1", "10.0.0.0/24"),
+                                   ip("10.0.1.5", "b1"))
+
+        self.assertEqual(errors,
+                         ["line 2: Address does not belong to IpBlock"])
+
+    def test_load_rejects_references_to_unknown_records(self):
+        errors = self._load_errors(ip("10.0.0.5", "missing"),
+                                   ip("10.0.0.6", "missing"))
+
+        self.assertEqual(errors, ["line 1: ip block missing not found",
+                                  "line 2: ip block missing not found"])
+
+    def test_load_rejects_unknown_resource_types(self):
+        errors = self._load_errors(dict(resource_type="network", id="n1"))
+
+        self.assertEqual(errors, ["line 1: unknown resource_type network"])
+
+    def test_load_rejects_unknown_fields(self):
+        errors = self._load_errors(dict(resource_type="policy",
+                                        name="policy", tenant_id="RAX",
+                                        colour="blue"))
+
+        self.assertEqual(errors, ["line 1: unknown fields colour"])
+
+    def test_load_keeps_chunks_imported_before_an_invalid_one(self):
+        errors = self._load_errors(block("b1", "10.0.0.0/24"),
+                                   ip("10.0.0.1", "b1"),
+                                   ip("10.0.0.2", "b1"),
+                                   ip("10.0.0.3", "b1"),
+                                   ip("10.0.0.1", "b1"))
+
+        self.assertIn("lines 4-5", errors[0])
+        self.assertEqual(models.IpAddress.count(ip_block_id="b1"), 2)
+        self.assertEqual(models.IpBlock.find("b1").allocatable_ip_counter,
+                         int(netaddr.IPAddress("10.0.0.3")))
+
+    def test_report_counts_imported_records(self):
+        self.importer.load(numbered(block("b1", "10.0.0.0/24"),
+                                    block("b2", "10.0.1.0/24")))
+
+        report = self.importer.report()
+
+        self.assertIn("ip_block: 2 records", report[0])
+        self.assertIn("imported 2 records", report[-1])
+
+    def _load_errors(self, *records):
+        try:
+            self.importer.load(numbered(*records))
+        except importer.InvalidRecordsError as error:
+            return error.errors
+        self.fail("Expected the import to stop at invalid records")
+
+
+class TestReadRecords(tests.BaseTest):
+
+    def test_reads_json_lines_skipping_blank_ones(self):
+        stream = StringIO.StringIO('{"resource_type": "policy"}\n'
+                                   '\n'
+                                   '{"resource_type": "interface"}\n')
+
+        self.assertEqual(list(importer.read_records(stream)),
+                         [(1, {"resource_type": "policy"}),
+                          (3, {"resource_type": "interface"})])
+
+    def test_reads_csv_leaving_out_empty_cells(self):
+        stream = StringIO.StringIO("resource_type,id,name,cidr\n"
+                                   "policy,p1,policy,\n"
+                                   "ip_block,b1,,10.0.0.0/24\n")
+
+        self.assertEqual(list(importer.read_records(stream, "csv")),
+                         [(2, {"resource_type": "policy", "id": "p1",
+                               "name": "policy"}),
+                          (3, {"resource_type": "ip_block", "id": "b1",
+                               "cidr": "10.0.0.0/24"})])
+
+    def test_reports_line_of_malformed_json(self):
+        stream = StringIO.StringIO('{"resource_type": "policy"}\n{"id": \n')
+
+        records = importer.read_records(stream)
+        next(records)
+
+        self.assertRaisesExcMessage(importer.InvalidRecordsError, "line 2",
+                                    next, records)
@@ -0,0 +1,44 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from melange import tests
+from melange.common import intervals
+
+
+class TestIntervals(tests.BaseTest):
+
+    def test_union_coalesces_overlapping_and_adjacent_intervals(self):
+        union = intervals.union([(1, 1), (2, 2), (5, 5)],
+                                [(3, 3), (9, 12)],
+                                [(10, 15)])
+
+        self.assertEqual(list(union), [(1, 3), (5, 5), (9, 15)])
+
+    def test_complement_yields_gaps_between_first_and_last(self):
+        complement = intervals.complement([(0, 0), (3, 4), (7, 9)], 0, 8)
+
+        self.assertEqual(list(complement), [(1, 2), (5, 6)])
+
+    def test_complement_of_nothing_is_everything(self):
+        self.assertEqual(list(intervals.complement([], 5, 9)), [(5, 9)])
+        self.assertEqual(list(intervals.complement([(0, 20)], 5, 9)), [])
+        self.assertEqual(list(intervals.complement([], 9, 5)), [])
+
+    def test_periodic_yields_values_with_residue(self):
+        periodic = intervals.periodic(10, 600, 256, 255)
+
+        self.assertEqual(list(periodic), [(255, 255), (511, 511)])
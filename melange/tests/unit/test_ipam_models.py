@@ -16,13 +16,16 @@
 #    under the License.
 
 import datetime
+import eventlet
 import mox
 import netaddr
 
+from melange import ipv4
 from melange import tests
 from melange.common import exception
 from melange.common import notifier
 from melange.common import utils
+from melange.db import db_api
 from melange.db import db_query
 from melange.ipam import models
 from melange.tests import unit
@@ -132,6 +135,58 @@ class TestQuery(tests.BaseTest):
         self.assertEqual(len(paginated_blocks), 2)
         self.assertEqual(paginated_blocks, [blocks[2], blocks[3]])
 
+    def test_rows_selects_only_given_columns(self):
+        block = factory_models.IpBlockFactory()
+        route = factory_models.IpRouteFactory(source_block_id=block.id)
+        noise_route = factory_models.IpRouteFactory()
+
+        rows = db_query.find_all(models.IpRoute,
+                                 source_block_id=block.id).rows(
+                                     ['id', 'destination'])
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].keys(), ['id', 'destination'])
+        self.assertEqual(tuple(rows[0]), (route.id, route.destination))
+
+    def test_rows_includes_joined_columns(self):
+        interface = factory_models.InterfaceFactory(device_id="dev1")
+        ip = factory_models.IpAddressFactory(interface_id=interface.id)
+
+        rows = db_query.find_all(models.IpAddress, id=ip.id).rows(
+            ['id'], {'interface': ('Interface', ['device_id'])})
+
+        self.assertEqual(rows[0]['id'], ip.id)
+        self.assertEqual(rows[0]['interface_device_id'], "dev1")
+
+    def test_paginated_rows_with_given_marker(self):
+        blocks = models.sort([factory_models.IpBlockFactory()
+                              for i in range(4)])
+
+        rows, next_marker = db_query.find_all(models.IpBlock).paginated_rows(
+            ['id', 'cidr'], limit=2, marker=blocks[0].id)
+
+        self.assertEqual([row['id'] for row in rows],
+                         [blocks[1].id, blocks[2].id])
+        self.assertEqual(next_marker, blocks[2].id)
+
+    def test_version_changes_when_rows_are_saved_or_deleted(self):
+        block1 = factory_models.IpBlockFactory(network_id="1")
+        block2 = factory_models.IpBlockFactory(network_id="1")
+        noise_block = factory_models.IpBlockFactory(network_id="999")
+        query = db_query.find_all(models.IpBlock, network_id="1")
+
+        created_version = query.version()
+        block1.update(gateway="10.0.0.2")
+        updated_version = query.version()
+        block2.delete()
+        deleted_version = query.version()
+
+        self.assertEqual(created_version[0], 2)
+        self.assertNotEqual(updated_version, created_version)
+        self.assertEqual(deleted_version[0], 1)
+        noise_block.update(gateway="10.0.0.2")
+        self.assertEqual(query.version(), deleted_version)
+
     def test_update(self):
         block1 = factory_models.IpBlockFactory(network_id="1")
         block2 = factory_models.IpBlockFactory(network_id="1")
@@ -145,6 +200,16 @@ class TestQuery(tests.BaseTest):
         noise_network = models.IpBlock.find(noise_block.id).network_id
         self.assertNotEqual(noise_network, "2")
 
+    def test_update_changes_the_version_of_the_rows(self):
+        factory_models.IpBlockFactory(network_id="1")
+        query = db_query.find_all(models.IpBlock, network_id="1")
+        version = query.version()
+
+        with unit.StubTime(time=utils.utcnow() + datetime.timedelta(1)):
+            query.update(gateway="10.0.0.2")
+
+        self.assertNotEqual(query.version(), version)
+
     def test_delete(self):
         block1 = factory_models.IpBlockFactory(network_id="1")
         block2 = factory_models.IpBlockFactory(network_id="1")
@@ -512,6 +577,81 @@ class TestIpBlock(tests.BaseTest):
         self.assertEqual(block.percent_used, 0.78125)
         self.assertEqual(block.ips_used, 4)
 
+    def test_version_changes_whenever_ips_used_may_have(self):
+        policy = factory_models.PolicyFactory(name="blah")
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/24",
+                                                     policy_id=policy.id)
+        noise_block = factory_models.PrivateIpBlockFactory(
+            cidr="10.1.0.0/24")
+        versions = [block.version()]
+
+        ip = _allocate_ip(block)
+        versions.append(block.version())
+        ip.delete()
+        versions.append(block.version())
+        factory_models.IpRangeFactory(policy_id=policy.id, offset=1,
+                                      length=1)
+        versions.append(block.version())
+        factory_models.IpOctetFactory(policy_id=policy.id, octet=0)
+        versions.append(block.version())
+
+        for previous, current in zip(versions, versions[1:]):
+            self.assertNotEqual(previous, current)
+        _allocate_ip(noise_block)
+        self.assertEqual(block.version(), versions[-1])
+
+    def test_free_ranges_leave_out_allocated_and_reserved_addresses(self):
+        policy = factory_models.PolicyFactory(name="blah")
+        factory_models.IpRangeFactory(policy_id=policy.id, offset=8,
+                                      length=4)
+        factory_models.IpOctetFactory(policy_id=policy.id, octet=20)
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/27",
+                                                     gateway="10.0.0.1",
+                                                     policy_id=policy.id)
+        for address in ["10.0.0.2", "10.0.0.3", "10.0.0.5"]:
+            factory_models.IpAddressFactory(ip_block_id=block.id,
+                                            address=address)
+
+        self.assertEqual(_address_ranges(block.free_ranges()),
+                         [("10.0.0.0", "10.0.0.0"),
+                          ("10.0.0.4", "10.0.0.4"),
+                          ("10.0.0.6", "10.0.0.7"),
+                          ("10.0.0.12", "10.0.0.19"),
+                          ("10.0.0.21", "10.0.0.30")])
+
+    def test_free_ranges_of_subnetted_block_are_empty(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/24",
+                                                     gateway=None)
+        block.subnet("10.0.0.64/26")
+
+        self.assertEqual(_address_ranges(block.free_ranges()), [])
+
+    def test_free_ranges_start_past_given_address(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29",
+                                                     gateway=None)
+        factory_models.IpAddressFactory(ip_block_id=block.id,
+                                        address="10.0.0.4")
+
+        self.assertEqual(_address_ranges(block.free_ranges("10.0.0.1")),
+                         [("10.0.0.2", "10.0.0.3"),
+                          ("10.0.0.5", "10.0.0.6")])
+
+    def test_free_ranges_of_huge_blocks_are_not_enumerated(self):
+        policy = factory_models.PolicyFactory(name="blah")
+        factory_models.IpOctetFactory(policy_id=policy.id, octet=0)
+        block = factory_models.IpV6IpBlockFactory(cidr="fe::/64",
+                                                  gateway="fe::1",
+                                                  policy_id=policy.id)
+
+        free_ranges = block.free_ranges()
+
+        self.assertEqual(next(free_ranges),
+                         (int(netaddr.IPAddress("fe::2")),
+                          int(netaddr.IPAddress("fe::ffff"))))
+        self.assertEqual(next(free_ranges),
+                         (int(netaddr.IPAddress("fe::1:1")),
+                          int(netaddr.IPAddress("fe::1:ffff"))))
+
     def test_find_ip_for_nonexistent_address(self):
         block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.1/8")
 
@@ -726,9 +866,97 @@ class TestIpBlock(tests.BaseTest):
                                         ip_block.allocate_ip,
                                         interface=interface)
 
+    def test_concurrent_allocations_are_served_in_one_batch(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        interfaces = [factory_models.InterfaceFactory() for i in range(3)]
+
+        self.mock.StubOutWithMock(models.IpAddress, 'create')
+        self.mock.ReplayAll()
+        pool = eventlet.GreenPool()
+        ips = list(pool.imap(ip_block.allocate_ip, interfaces))
+
+        self.assertEqual([ip.address for ip in ips],
+                         ["10.0.0.0", "10.0.0.1", "10.0.0.2"])
+        self.assertEqual([ip.interface_id for ip in ips],
+                         [interface.id for interface in interfaces])
+        self.assertEqual(len(models.IpAddress.find_all(
+            ip_block_id=ip_block.id).all()), 3)
+        reloaded_block = models.IpBlock.find(ip_block.id)
+        self.assertEqual(str(netaddr.IPAddress(
+            reloaded_block.allocatable_ip_counter)), "10.0.0.3")
+
+    def test_concurrent_allocations_fail_beyond_block_capacity(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/30")
+        interfaces = [factory_models.InterfaceFactory() for i in range(4)]
+
+        def allocate(interface):
+            try:
+                return ip_block.allocate_ip(interface).address
+            except exception.NoMoreAddressesError:
+                return None
+
+        pool = eventlet.GreenPool()
+        addresses = list(pool.imap(allocate, interfaces))
+
+        self.assertEqual(addresses,
+                         ["10.0.0.0", "10.0.0.1", "10.0.0.2", None])
+
+    def test_concurrent_allocations_are_retried_one_at_a_time(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        interfaces = [factory_models.InterfaceFactory() for i in range(2)]
+
+        self.mock.StubOutWithMock(models.IpAddress, 'create_all')
+        models.IpAddress.create_all(mox.IgnoreArg()).AndRaise(
+            exception.DBConstraintError())
+        self.mock.ReplayAll()
+        pool = eventlet.GreenPool()
+        ips = list(pool.imap(ip_block.allocate_ip, interfaces))
+
+        self.assertEqual([ip.address for ip in ips],
+                         ["10.0.0.0", "10.0.0.1"])
+        reloaded_block = models.IpBlock.find(ip_block.id)
+        self.assertEqual(str(netaddr.IPAddress(
+            reloaded_block.allocatable_ip_counter)), "10.0.0.2")
+
+    def test_concurrent_allocations_fail_when_serving_them_fails(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        interfaces = [factory_models.InterfaceFactory() for i in range(2)]
+
+        self.mock.StubOutWithMock(models.IpAllocationQueue, '_allocate')
+        models.IpAllocationQueue._allocate(mox.IgnoreArg(),
+                                           mox.IgnoreArg()).AndRaise(
+            exception.MelangeError("serving failed"))
+        self.mock.ReplayAll()
+
+        def allocate(interface):
+            try:
+                return ip_block.allocate_ip(interface)
+            except exception.MelangeError as error:
+                return str(error)
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(allocate, interfaces))
+
+        self.assertEqual(results, ["serving failed", "serving failed"])
+
+    def test_allocate_available_ips_with_generator_of_one_ip_at_a_time(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        interfaces = [factory_models.InterfaceFactory() for i in range(2)]
+        plugin = self.mock.CreateMockAnything()
+        self.mock.StubOutWithMock(ipv4, 'plugin')
+        ipv4.plugin().AndReturn(plugin)
+        plugin.get_generator(ip_block).AndReturn(
+            mock_generator.MockIpV4Generator(ip_block))
+        self.mock.ReplayAll()
+
+        ips = ip_block._allocate_available_ips(interfaces)
+
+        self.assertEqual([ip.address for ip in ips], ["10.0.0.4", "10.0.0.5"])
+
     def _mock_ip_creation(self):
         return models.IpAddress.create(address=mox.IgnoreArg(),
                                        interface_id=mox.IgnoreArg(),
+                                       interface=mox.IgnoreArg(),
                                        used_by_tenant_id=mox.IgnoreArg(),
                                        ip_block_id=mox.IgnoreArg())
 
@@ -776,6 +1004,110 @@ class TestIpBlock(tests.BaseTest):
 
         self.assertEqual(ip.address, "00ff:0000:0000:0000:0000:0000:0000:0002")
 
+    def test_ipv6_allocation_remembers_offset_past_taken_addresses(self):
+        block = factory_models.IpV6IpBlockFactory(cidr="fe::/64")
+        interface = factory_models.InterfaceFactory(tenant_id="1234")
+        models.MacAddress.create(interface_id=interface.id,
+                                 address="00:ff:12:89:67:34")
+        factory_models.IpAddressFactory(address="fe::7110:eda4:ff89:6734",
+                                        ip_block_id=block.id)
+        factory_models.IpAddressFactory(address="fe::7110:eda4:ff89:6735",
+                                        ip_block_id=block.id)
+
+        ip = block.allocate_ip(interface=interface)
+
+        self.assertEqual(ip.address, "00fe:0000:0000:0000:7110:eda4:ff89:6736")
+        self.assertEqual(models.TenantOffsetHint.offset(block.id, "1234"), 2)
+
+    def test_ipv6_allocation_starts_at_remembered_offset(self):
+        block = factory_models.IpV6IpBlockFactory(cidr="fe::/64")
+        interface = factory_models.InterfaceFactory(tenant_id="1234")
+        models.MacAddress.create(interface_id=interface.id,
+                                 address="00:ff:12:89:67:34")
+        factory_models.IpAddressFactory(address="fe::7110:eda4:ff89:6734",
+                                        ip_block_id=block.id)
+        models.TenantOffsetHint.remember(block.id, "1234", 5)
+        self.mock.StubOutWithMock(models.IpAddress, 'existing_addresses')
+        models.IpAddress.existing_addresses(
+            block.id, mox.Func(lambda candidates: candidates[0]
+                               == "fe::7110:eda4:ff89:6739")).AndReturn([])
+        self.mock.ReplayAll()
+
+        ip = block.allocate_ip(interface=interface)
+
+        self.assertEqual(ip.address, "00fe:0000:0000:0000:7110:eda4:ff89:6739")
+        self.assertEqual(models.TenantOffsetHint.offset(block.id, "1234"), 5)
+
+    def test_ipv6_allocation_tries_own_address_before_remembered_offset(self):
+        block = factory_models.IpV6IpBlockFactory(cidr="fe::/64")
+        interface = factory_models.InterfaceFactory(tenant_id="1234")
+        models.MacAddress.create(interface_id=interface.id,
+                                 address="00:ff:12:89:67:34")
+        models.TenantOffsetHint.remember(block.id, "1234", 5)
+
+        ip = block.allocate_ip(interface=interface)
+
+        self.assertEqual(ip.address, "00fe:0000:0000:0000:7110:eda4:ff89:6734")
+        self.assertEqual(models.TenantOffsetHint.offset(block.id, "1234"), 0)
+
+    def test_ipv6_allocation_without_collisions_remembers_no_offset(self):
+        block = factory_models.IpV6IpBlockFactory(cidr="fe::/64")
+        interface = factory_models.InterfaceFactory(tenant_id="1234")
+        models.MacAddress.create(interface_id=interface.id,
+                                 address="00:ff:12:89:67:34")
+
+        block.allocate_ip(interface=interface)
+
+        self.assertEqual(models.TenantOffsetHint.count(ip_block_id=block.id),
+                         0)
+
+    def test_optimistic_ipv6_allocation_skips_existence_lookup(self):
+        block = factory_models.IpV6IpBlockFactory(cidr="ff::/120")
+        interface = factory_models.InterfaceFactory()
+        mock_generator.MockIpV6Generator.ip_list = ["ff::0001", "ff::0002"]
+        self.mock.StubOutWithMock(models.IpBlock, 'does_address_exists')
+        self.mock.ReplayAll()
+
+        with unit.StubConfig(ipv6_generator=self.mock_generator_name,
+                             ipv6_allocation_mode="optimistic"):
+            ip = block.allocate_ip(interface=interface)
+
+        self.assertEqual(ip.address, "00ff:0000:0000:0000:0000:0000:0000:0001")
+
+    def test_optimistic_ipv6_allocation_retries_on_conflicting_insert(self):
+        block = factory_models.IpV6IpBlockFactory(cidr="ff::/120")
+        interface = factory_models.InterfaceFactory()
+        mock_generator.MockIpV6Generator.ip_list = ["ff::0001", "ff::0002",
+                                                    "ff::0003"]
+        factory_models.IpAddressFactory(address="ff::0001",
+                                        ip_block_id=block.id)
+        factory_models.IpAddressFactory(address="ff::0002",
+                                        ip_block_id=block.id)
+
+        with unit.StubConfig(ipv6_generator=self.mock_generator_name,
+                             ipv6_allocation_mode="optimistic",
+                             ip_allocation_retries=3):
+            ip = block.allocate_ip(interface=interface)
+
+        self.assertEqual(ip.address, "00ff:0000:0000:0000:0000:0000:0000:0003")
+
+    def test_optimistic_ipv6_allocation_gives_up_after_max_conflicts(self):
+        block = factory_models.IpV6IpBlockFactory(cidr="ff::/120")
+        interface = factory_models.InterfaceFactory()
+        mock_generator.MockIpV6Generator.ip_list = ["ff::0001", "ff::0002",
+                                                    "ff::0003"]
+        factory_models.IpAddressFactory(address="ff::0001",
+                                        ip_block_id=block.id)
+        factory_models.IpAddressFactory(address="ff::0002",
+                                        ip_block_id=block.id)
+
+        with unit.StubConfig(ipv6_generator=self.mock_generator_name,
+                             ipv6_allocation_mode="optimistic",
+                             ip_allocation_retries=2):
+            self.assertRaises(models.ConcurrentAllocationError,
+                              block.allocate_ip,
+                              interface=interface)
+
     def test_allocate_ip_for_given_ipv6_address(self):
         block = factory_models.IpV6IpBlockFactory(cidr="ff::/120")
         interface = factory_models.InterfaceFactory()
@@ -1324,6 +1656,48 @@ class TestIpAddress(tests.BaseTest):
         self.assertEqual(data['created_at'], ip.created_at)
         self.assertEqual(data['updated_at'], ip.updated_at)
 
+    def test_data_with_fields_skips_interface_lookup(self):
+        ip = factory_models.IpAddressFactory()
+        self.mock.StubOutWithMock(models.Interface, "get")
+        self.mock.ReplayAll()
+
+        data = models.IpAddress.find(ip.id).data(fields=['id', 'address'])
+
+        self.assertEqual(data, dict(id=ip.id, address=ip.address))
+
+    def test_paginated_data_with_fields(self):
+        ip = factory_models.IpAddressFactory()
+
+        data, next_marker = models.IpAddress.paginated_data(
+            models.IpAddress.find_all(id=ip.id),
+            fields=['address', 'used_by_tenant'])
+
+        self.assertEqual(data, [dict(address=ip.address,
+                                     used_by_tenant=ip.interface.tenant_id)])
+
+    def test_row_data_is_same_as_data(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.1/8")
+        interface = factory_models.InterfaceFactory()
+        ip = factory_models.IpAddressFactory(ip_block_id=ip_block.id,
+                                             interface_id=interface.id)
+
+        data, next_marker = models.IpAddress.paginated_data(
+            models.IpAddress.find_all(ip_block_id=ip_block.id))
+
+        self.assertEqual(data, [ip.data()])
+        self.assertIsNone(next_marker)
+
+    def test_row_data_for_ip_without_interface(self):
+        ip = factory_models.IpAddressFactory()
+        ip.deallocate()
+
+        data, next_marker = models.IpAddress.paginated_data(
+            models.IpAddress.find_all(id=ip.id))
+
+        self.assertEqual(data[0]['address'], ip.address)
+        self.assertIsNone(data[0]['interface_id'])
+        self.assertIsNone(data[0]['used_by_device'])
+
     def test_deallocate(self):
         ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.1/8")
         ip_address = _allocate_ip(ip_block)
@@ -1498,6 +1872,14 @@ class TestIpRoute(tests.BaseTest):
         self.assertEqual(data["netmask"], ip_route.netmask)
         self.assertEqual(data["gateway"], ip_route.gateway)
 
+    def test_row_data_is_same_as_data(self):
+        ip_route = factory_models.IpRouteFactory()
+
+        data, next_marker = models.IpRoute.paginated_data(
+            models.IpRoute.find_all(id=ip_route.id))
+
+        self.assertEqual(data, [ip_route.data()])
+
 
 class TestMacAddressRange(tests.BaseTest):
 
@@ -1602,23 +1984,55 @@ class TestMacAddressRange(tests.BaseTest):
             cidr="BC:76:4E:20:0:0/48")
         allocatable_rng = factory_models.MacAddressRangeFactory(
             cidr="BC:76:4E:30:0:0/48")
+        already_full_rng.allocate_mac()
+
+        mac = models.MacAddressRange.allocate_next_free_mac()
 
-        self.mock.StubOutWithMock(models.MacAddressRange, "find_all")
-        models.MacAddressRange.find_all().AndReturn([already_full_rng,
-                                                     allocatable_rng])
+        self.assertEqual(mac.mac_address_range_id, allocatable_rng.id)
+        self.assertTrue(models.MacAddressRange.find(
+            already_full_rng.id).is_full)
 
-        self.mock.StubOutWithMock(already_full_rng, "allocate_mac")
-        already_full_rng.allocate_mac().AndRaise(
-            models.NoMoreMacAddressesError())
+    def test_allocate_next_free_mac_skips_ranges_flagged_full(self):
+        full_rng = factory_models.MacAddressRangeFactory(
+            cidr="BC:76:4E:20:0:0/40", is_full=True)
+        allocatable_rng = factory_models.MacAddressRangeFactory(
+            cidr="BC:76:4E:30:0:0/40")
+
+        mac = models.MacAddressRange.allocate_next_free_mac()
+
+        self.assertEqual(mac.mac_address_range_id, allocatable_rng.id)
+        self.assertEqual(models.MacAddress.count(
+            mac_address_range_id=full_rng.id), 0)
+
+    def test_deleting_mac_of_full_range_clears_full_flag(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/48")
+        mac = models.MacAddressRange.allocate_next_free_mac()
+        self.assertRaises(models.NoMoreMacAddressesError,
+                          models.MacAddressRange.allocate_next_free_mac)
 
-        self.mock.StubOutWithMock(allocatable_rng, "allocate_mac")
-        expected_mac = models.MacAddress()
-        allocatable_rng.allocate_mac().AndReturn(expected_mac)
+        models.MacAddress.find(mac.id).delete()
 
+        self.assertFalse(models.MacAddressRange.find(rng.id).is_full)
+        reallocated_mac = models.MacAddressRange.allocate_next_free_mac()
+        self.assertEqual(reallocated_mac.address, mac.address)
+
+    def test_range_bounds_are_parsed_once_per_cidr(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        rng.first_address()
+        self.mock.StubOutWithMock(netaddr, "EUI")
         self.mock.ReplayAll()
 
-        actual_mac = models.MacAddressRange.allocate_next_free_mac()
-        self.assertEqual(expected_mac, actual_mac)
+        self.assertEqual(rng.first_address(), 0xbc764e200000)
+        self.assertEqual(rng.last_address(), 0xbc764e2000ff)
+        self.assertEqual(rng.length(), 2 ** 8)
+
+    def test_delete_forgets_range_bounds(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        rng.first_address()
+
+        rng.delete()
+
+        self.assertNotIn(rng.cidr, models.MacAddressRange._bounds)
 
     def test_allocate_mac_retries_on_mac_creation_constraint_failure(self):
         rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/24")
@@ -1678,6 +2092,72 @@ class TestMacAddressRange(tests.BaseTest):
     def test_mac_allocation_disabled_when_no_ranges_exist(self):
         self.assertFalse(models.MacAddressRange.mac_allocation_enabled())
 
+    def test_allocate_macs_reserves_consecutive_addresses_at_once(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        interfaces = [factory_models.InterfaceFactory() for i in range(3)]
+
+        macs = models.MacAddressRange.allocate_macs(
+            [interface.id for interface in interfaces])
+
+        first = int(netaddr.EUI("BC:76:4E:20:00:00"))
+        self.assertEqual([mac.address for mac in macs],
+                         [first, first + 1, first + 2])
+        self.assertEqual([mac.interface_id for mac in macs],
+                         [interface.id for interface in interfaces])
+        self.assertEqual(models.MacAddressRange.find(rng.id).next_address,
+                         first + 3)
+
+    def test_allocate_macs_continues_in_next_range_when_range_runs_out(self):
+        small_rng = factory_models.MacAddressRangeFactory(
+            cidr="BC:76:4E:20:0:0/47")
+        next_rng = factory_models.MacAddressRangeFactory(
+            cidr="BC:76:4E:30:0:0/40")
+        interfaces = [factory_models.InterfaceFactory() for i in range(3)]
+
+        macs = models.MacAddressRange.allocate_macs(
+            [interface.id for interface in interfaces])
+
+        self.assertEqual([mac.mac_address_range_id for mac in macs],
+                         [small_rng.id, small_rng.id, next_rng.id])
+        self.assertTrue(models.MacAddressRange.find(small_rng.id).is_full)
+
+    def test_allocate_macs_raises_error_when_no_more_free_macs(self):
+        factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/48")
+        interfaces = [factory_models.InterfaceFactory() for i in range(2)]
+
+        self.assertRaises(models.NoMoreMacAddressesError,
+                          models.MacAddressRange.allocate_macs,
+                          [interface.id for interface in interfaces])
+
+    def test_allocate_macs_falls_back_to_one_at_a_time_on_conflict(self):
+        factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        models.MacAddress.create(address="BC:76:4E:20:00:01")
+        interfaces = [factory_models.InterfaceFactory() for i in range(2)]
+
+        macs = models.MacAddressRange.allocate_macs(
+            [interface.id for interface in interfaces])
+
+        first = int(netaddr.EUI("BC:76:4E:20:00:00"))
+        self.assertEqual([mac.interface_id for mac in macs],
+                         [interface.id for interface in interfaces])
+        self.assertEqual([mac.address for mac in macs],
+                         [first, first + 2])
+
+    def test_non_atomic_batch_rolls_back_conflicting_mac_reservation(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        models.MacAddress.create(address="BC:76:4E:20:00:01")
+        interfaces = [factory_models.InterfaceFactory() for i in range(2)]
+
+        with db_api.unit_of_work(atomic=False):
+            macs = models.MacAddressRange.allocate_macs(
+                [interface.id for interface in interfaces])
+
+        first = int(netaddr.EUI("BC:76:4E:20:00:00"))
+        self.assertEqual([mac.address for mac in macs],
+                         [first, first + 2])
+        self.assertEqual(models.MacAddressRange.find(rng.id).next_address,
+                         first + 3)
+
     def test_deallocated_macs_are_allocated_again(self):
         rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
         mac = rng.allocate_mac()
@@ -1907,6 +2387,44 @@ class TestPolicy(tests.BaseTest):
                         is not None)
 
 
+class TestBlockGeometry(tests.BaseTest):
+
+    def test_matches_netaddr_network(self):
+        for cidr in ["10.0.0.0/29", "192.168.1.0/24", "10.0.0.1/32",
+                     "fe::/64", "fe::/120"]:
+            network = netaddr.IPNetwork(cidr)
+            geometry = models.BlockGeometry.of(cidr)
+
+            self.assertEqual(geometry.version, network.version)
+            self.assertEqual(geometry.prefixlen, network.prefixlen)
+            self.assertEqual(geometry.first, network.first)
+            self.assertEqual(geometry.last, network.last)
+            self.assertEqual(geometry.size, network.size)
+            self.assertEqual(geometry.broadcast, str(network.broadcast))
+
+    def test_is_shared_between_blocks_with_the_same_cidr(self):
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        same_block = models.IpBlock.find(block.id)
+
+        self.assertTrue(block.geometry() is same_block.geometry())
+
+    def test_contains_only_addresses_of_the_same_version(self):
+        geometry = models.BlockGeometry.of("0.0.0.0/0")
+
+        self.assertTrue(geometry.contains("10.0.0.1"))
+        self.assertFalse(geometry.contains("::a00:1"))
+
+    def test_includes_nested_blocks(self):
+        geometry = models.BlockGeometry.of("10.0.0.0/24")
+
+        self.assertTrue(geometry.includes(
+            models.BlockGeometry.of("10.0.0.8/29")))
+        self.assertFalse(geometry.includes(
+            models.BlockGeometry.of("10.0.0.0/23")))
+        self.assertFalse(geometry.includes(
+            models.BlockGeometry.of("::/120")))
+
+
 class TestIpRange(tests.BaseTest):
 
     def test_create_ip_range(self):
@@ -1974,6 +2492,21 @@ class TestIpRange(tests.BaseTest):
         self.assertFalse(ip_range1.contains("10.0.0.0/29", "10.0.0.7"))
         self.assertTrue(ip_range2.contains("10.0.0.0/29", "10.0.0.7"))
 
+    def test_range_contains_same_addresses_as_netaddr_slice(self):
+        network = netaddr.IPNetwork("10.0.0.0/29")
+        for offset in range(-10, 10):
+            for length in range(0, 10):
+                ip_range = models.IpRange(offset=offset, length=length)
+                end_index = offset + length
+                if offset < 0 and end_index >= 0:
+                    end_index = None
+                expected = set(network[offset:end_index])
+
+                for address in network:
+                    self.assertEqual(
+                        ip_range.contains("10.0.0.0/29", str(address)),
+                        address in expected)
+
 
 class TestIpOctet(tests.BaseTest):
 
@@ -2014,6 +2547,26 @@ class TestNetwork(tests.BaseTest):
         self.assertEqual(network.id, "1")
         self.assertEqual(network.ip_blocks, [ip_block1])
 
+    def test_free_ranges_of_all_blocks_in_address_order(self):
+        ipv6_block = factory_models.IpV6IpBlockFactory(cidr="fe::/126",
+                                                       network_id="1",
+                                                       gateway=None)
+        later_block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.1.0/30", network_id="1", gateway=None)
+        block = factory_models.PrivateIpBlockFactory(
+            cidr="10.0.0.0/30", network_id="1", gateway=None)
+        network = models.Network.find_by(id="1")
+
+        free_ranges = [(ip_block, first, last) for ip_block, first, last
+                       in network.free_ranges(after="10.0.0.0")]
+
+        self.assertEqual([(ip_block.id, str(netaddr.IPAddress(first)),
+                           str(netaddr.IPAddress(last)))
+                          for ip_block, first, last in free_ranges],
+                         [(block.id, "10.0.0.1", "10.0.0.2"),
+                          (later_block.id, "10.0.1.0", "10.0.1.2"),
+                          (ipv6_block.id, "fe::", "fe::2")])
+
     def test_find_when_no_ip_blocks_for_given_network_exist(self):
         noise_ip_block = factory_models.PublicIpBlockFactory(network_id="9999")
 
@@ -2228,6 +2781,31 @@ class TestNetwork(tests.BaseTest):
 
 class TestInterface(tests.BaseTest):
 
+    def test_configuration_version_changes_with_ips_blocks_and_routes(self):
+        interface = factory_models.InterfaceFactory()
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        versions = [interface.configuration_version()]
+
+        ip = block.allocate_ip(interface)
+        versions.append(interface.configuration_version())
+        block.update(dns1="10.0.0.53")
+        versions.append(interface.configuration_version())
+        factory_models.IpRouteFactory(source_block_id=block.id)
+        versions.append(interface.configuration_version())
+        ip.deallocate()
+        versions.append(interface.configuration_version())
+
+        for previous, current in zip(versions, versions[1:]):
+            self.assertNotEqual(previous, current)
+
+    def test_configuration_version_ignores_other_interfaces(self):
+        interface = factory_models.InterfaceFactory()
+        version = interface.configuration_version()
+
+        _allocate_ip(factory_models.IpBlockFactory())
+
+        self.assertEqual(interface.configuration_version(), version)
+
     def test_find_or_configure_finds_existing_interface(self):
         existing_interface = factory_models.InterfaceFactory(
             vif_id_on_device="11234",
@@ -2296,6 +2874,28 @@ class TestInterface(tests.BaseTest):
                          str(netaddr.EUI("ab:bc:cd:01:12:23")))
         self.assertEqual(mac.address, int(netaddr.EUI("ab:bc:cd:01:12:23")))
 
+    def test_create_all_and_configure_allocates_macs_together(self):
+        factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        self.mock.StubOutWithMock(models.MacAddressRange,
+                                  "allocate_next_free_mac")
+        self.mock.ReplayAll()
+
+        interfaces = models.Interface.create_all_and_configure(
+            [dict(virtual_interface_id="iface_1"),
+             dict(virtual_interface_id="iface_2",
+                  mac_address="ab:bc:cd:01:12:23"),
+             dict(virtual_interface_id="iface_3")],
+            device_id="instance",
+            tenant_id="tenant")
+
+        self.assertEqual([interface.mac_address_eui_format
+                          for interface in interfaces],
+                         ["BC-76-4E-20-00-00",
+                          "AB-BC-CD-01-12-23",
+                          "BC-76-4E-20-00-01"])
+        self.assertEqual([interface.device_id for interface in interfaces],
+                         ["instance"] * 3)
+
     def test_find_or_configure_cant_allocate_mac_if_allocation_disabled(self):
         self.assertFalse(models.MacAddressRange.mac_allocation_enabled())
 
@@ -2604,6 +3204,71 @@ class TestAllowedIp(tests.BaseTest):
                                     ip)
 
 
+class TestChange(tests.BaseTest):
+
+    def _changes(self, **conditions):
+        return models.sort(models.Change.find_all(**conditions).all())
+
+    def test_allocating_an_ip_records_an_allocate_change(self):
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        interface = factory_models.InterfaceFactory(tenant_id="tnt",
+                                                    vif_id_on_device="vif",
+                                                    device_id="instance")
+
+        ip = block.allocate_ip(interface)
+
+        change = models.Change.get_by(resource_type="ip_address")
+        self.assertEqual(change.event, "allocate")
+        self.assertEqual(change.resource_id, ip.id)
+        self.assertEqual(change.tenant_id, "tnt")
+        self.assertEqual(change.data()['data'],
+                         dict(address=ip.address,
+                              ip_block_id=block.id,
+                              used_by_tenant_id="tnt",
+                              marked_for_deallocation=False,
+                              interface_id="vif",
+                              used_by_device_id="instance"))
+
+    def test_deallocating_an_ip_records_a_deallocate_change(self):
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        ip = _allocate_ip(block)
+
+        ip.deallocate()
+
+        changes = self._changes(resource_type="ip_address")
+        self.assertEqual([change.event for change in changes],
+                         ["allocate", "deallocate"])
+        self.assertTrue(changes[1].data()['data']['marked_for_deallocation'])
+        self.assertIsNone(changes[1].data()['data']['interface_id'])
+
+    def test_block_create_update_and_delete_are_recorded_in_order(self):
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24",
+                                              tenant_id="tnt")
+        block.update(gateway="10.0.0.2")
+        block.delete()
+
+        changes = self._changes(resource_type="ip_block",
+                                resource_id=block.id)
+        self.assertEqual([change.event for change in changes],
+                         ["create", "update", "delete"])
+        self.assertEqual(changes[1].data()['data']['gateway'], "10.0.0.2")
+        self.assertEqual([change.tenant_id for change in changes],
+                         ["tnt"] * 3)
+
+    def test_data_includes_payload_only_when_requested(self):
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        change = models.Change.get_by(resource_id=block.id)
+
+        self.assertEqual(change.data(fields=['id', 'event']),
+                         dict(id=change.id, event="create"))
+        self.assertEqual(change.data()['data']['cidr'], "10.0.0.0/24")
+
+
+def _address_ranges(free_ranges):
+    return [(str(netaddr.IPAddress(first)), str(netaddr.IPAddress(last)))
+            for first, last in free_ranges]
+
+
 def _allocate_ip(block, interface=None, **kwargs):
     interface = interface or factory_models.InterfaceFactory()
     return block.allocate_ip(interface=interface, **kwargs)
@@ -17,14 +17,21 @@
 import string
 import unittest
 
+import datetime
+import eventlet
+import logging
+import msgpack
 import netaddr
 import routes
+import time
 import webob.exc
 
+from melange import db
 from melange import ipv6
 from melange import tests
 from melange.common import config
 from melange.common import exception
+from melange.common import notifier
 from melange.common import utils
 from melange.common import wsgi
 from melange.ipam import models
@@ -35,6 +42,9 @@ from melange.tests.factories import models as factory_models
 from melange.tests.unit import mock_generator
 
 
+LOG = logging.getLogger('melange.tests.unit.test_ipam_service')
+
+
 class ControllerTestBase(tests.BaseTest):
 
     def setUp(self):
@@ -58,6 +68,56 @@ class DummyApp(wsgi.Router):
         super(DummyApp, self).__init__(mapper)
 
 
+class TestAPIV10Routing(tests.BaseTest):
+
+    def setUp(self):
+        super(TestAPIV10Routing, self).setUp()
+        self.mapper = service.APIV10().map
+        self.mapper.create_regs()
+        self.requests = [(method, self._url_for(route, format))
+                         for route in self.mapper.matchlist
+                         for format in ["", ".json", ".xml"]
+                         for method in ["GET", "POST", "PUT", "DELETE"]]
+
+    def _url_for(self, route, format):
+        values = {'address': "fe80::1", 'format': format[1:]}
+        parts = []
+        for part in route.routelist:
+            if not isinstance(part, dict):
+                parts.append(part)
+            elif part['type'] == ".":
+                parts.append(format)
+            else:
+                parts.append(values.get(part['name'], part['name'] + "_1"))
+        return "".join(parts)
+
+    def _route_all(self, match):
+        return [match(self.mapper, url, {'REQUEST_METHOD': method})[:2]
+                for method, url in self.requests]
+
+    def test_compiled_routes_match_like_a_full_scan(self):
+        compiled_matches = self._route_all(wsgi.CompiledMapper._match)
+        full_scan_matches = self._route_all(routes.Mapper._match)
+
+        self.assertEqual(compiled_matches, full_scan_matches)
+        self.assertTrue(any(route is not None
+                            for match, route in compiled_matches))
+
+    def test_benchmark_against_full_scan(self):
+        timings = {}
+        for mapper_class in (routes.Mapper, wsgi.CompiledMapper):
+            start = time.time()
+            for i in range(5):
+                self._route_all(mapper_class._match)
+            timings[mapper_class.__name__] = ((time.time() - start) * 1e6 /
+                                              (5 * len(self.requests)))
+
+        LOG.info("Routed %d requests over %d routes, microseconds per "
+                 "request: %s" % (len(self.requests),
+                                  len(self.mapper.matchlist),
+                                  timings))
+
+
 class TestBaseControllerExceptionMapping(unittest.TestCase):
 
     class StubController(service.BaseController):
@@ -128,8 +188,9 @@ class TestShowAction(tests.BaseTest, AbstractTestAction):
 
     def test_show(self):
         self.mock_model_cls.find_by(id="some_id").AndReturn(self.mock_model)
+        self.mock_model.version().AndReturn(("some_id", None))
         res = {'a': 'b'}
-        self.mock_model.data().AndReturn(res)
+        self.mock_model.data(fields=None).AndReturn(res)
 
         self.mock.ReplayAll()
 
@@ -138,6 +199,21 @@ class TestShowAction(tests.BaseTest, AbstractTestAction):
         self.assertEqual(response.status_int, 200)
         self.assertEqual(res, response.json['model'])
 
+    def test_show_is_not_rendered_when_etag_matches(self):
+        self.mock_model_cls.find_by(id="some_id").AndReturn(self.mock_model)
+        self.mock_model.version().AndReturn(("some_id", None))
+        self.mock_model.data(fields=None).AndReturn({'a': 'b'})
+        self.mock_model_cls.find_by(id="some_id").AndReturn(self.mock_model)
+        self.mock_model.version().AndReturn(("some_id", None))
+        self.mock.ReplayAll()
+
+        etag = self.app.get("/resources/some_id").etag
+        response = self.app.get("/resources/some_id",
+                                headers={'If-None-Match': '"%s"' % etag})
+
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, "")
+
 
 class TestIpBlockController(ControllerTestBase):
 
@@ -225,6 +301,62 @@ class TestIpBlockController(ControllerTestBase):
 
         self.assertEqual(response.json, dict(ip_block=_data(updated_block)))
 
+    def test_index_answers_not_modified_for_matching_etag(self):
+        factory_models.IpBlockFactory(tenant_id="tenant_id")
+
+        with unit.StubTime(time=_settled_time()):
+            etag = self.app.get(self.ip_block_path).etag
+            response = self.app.get(self.ip_block_path,
+                                    headers={'If-None-Match': '"%s"' % etag})
+
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.etag, etag)
+
+    def test_index_etag_changes_when_a_block_is_updated(self):
+        block = factory_models.IpBlockFactory(tenant_id="tenant_id")
+        with unit.StubTime(time=_settled_time()):
+            etag = self.app.get(self.ip_block_path).etag
+
+        block.update(gateway="10.0.0.2")
+        with unit.StubTime(time=_settled_time()):
+            response = self.app.get(self.ip_block_path,
+                                    headers={'If-None-Match': '"%s"' % etag})
+
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.etag, etag)
+        self.assertEqual(response.json['ip_blocks'][0]['gateway'],
+                         "10.0.0.2")
+
+    def test_index_etag_changes_when_an_ip_is_allocated(self):
+        block = factory_models.IpBlockFactory(tenant_id="tenant_id",
+                                              cidr="10.0.0.0/24")
+        with unit.StubTime(time=_settled_time()):
+            etag = self.app.get(self.ip_block_path).etag
+
+        _allocate_ip(block)
+        with unit.StubTime(time=_settled_time()):
+            response = self.app.get(self.ip_block_path,
+                                    headers={'If-None-Match': '"%s"' % etag})
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['ip_blocks'][0]['ips_used'], 1)
+
+    def test_index_is_not_tagged_right_after_a_write(self):
+        factory_models.IpBlockFactory(tenant_id="tenant_id")
+
+        response = self.app.get(self.ip_block_path)
+
+        self.assertIsNone(response.etag)
+
+    def test_index_etag_differs_per_content_type(self):
+        factory_models.IpBlockFactory(tenant_id="tenant_id")
+
+        with unit.StubTime(time=_settled_time()):
+            json_etag = self.app.get("%s.json" % self.ip_block_path).etag
+            xml_etag = self.app.get("%s.xml" % self.ip_block_path).etag
+
+        self.assertNotEqual(json_etag, xml_etag)
+
     def test_delete(self):
         block = factory_models.IpBlockFactory()
         response = self.app.delete("%s/%s" % (self.ip_block_path, block.id))
@@ -248,6 +380,70 @@ class TestIpBlockController(ControllerTestBase):
         self.assertEqual(len(response_blocks), 3)
         self.assertItemsEqual(response_blocks, _data(blocks))
 
+    def test_index_with_fields(self):
+        block = factory_models.IpBlockFactory(cidr="192.1.1.0/30")
+
+        response = self.app.get("%s" % self.ip_block_path,
+                                {'fields': "id, cidr"})
+
+        self.assertEqual(response.status, "200 OK")
+        self.assertEqual(response.json['ip_blocks'],
+                         [dict(id=block.id, cidr="192.1.1.0/30")])
+
+    def test_show_with_fields(self):
+        block = factory_models.IpBlockFactory()
+
+        response = self.app.get("%s/%s" % (self.ip_block_path, block.id),
+                                {'fields': "id,ips_used"})
+
+        self.assertEqual(response.json['ip_block'],
+                         dict(id=block.id, ips_used=0))
+
+    def test_index_with_pagination_for_msgpack_content_type(self):
+        blocks = models.sort([
+            factory_models.IpBlockFactory(cidr="10.1.1.0/28"),
+            factory_models.IpBlockFactory(cidr="10.2.1.0/28"),
+        ])
+
+        response = self.app.get("%s.msgpack?limit=1" % self.ip_block_path)
+
+        data = msgpack.unpackb(response.body, raw=False)
+        self.assertEqual(response.content_type, "application/x-msgpack")
+        self.assertEqual(data['ip_blocks'][0]['id'], blocks[0].id)
+        self.assertEqual(data['ip_blocks'][0]['cidr'], blocks[0].cidr)
+        self.assertTrue("marker=%s" % blocks[0].id
+                        in data['ip_blocks_links'][0]['href'])
+
+    def test_create_with_msgpack_body(self):
+        req_body = {'ip_block': {'network_id': "3",
+                                 'cidr': "10.1.1.0/24",
+                                 'type': "public",
+                                 },
+                    }
+
+        response = self.app.post(
+            "/ipam/tenants/111/ip_blocks",
+            msgpack.packb(req_body),
+            headers={'Content-Type': "application/vnd.openstack.melange"
+                                     "+msgpack",
+                     'Accept': "application/vnd.openstack.melange+msgpack"})
+
+        saved_block = models.IpBlock.find_by(network_id="3")
+        data = msgpack.unpackb(response.body, raw=False)
+        self.assertEqual(response.status, "201 Created")
+        self.assertEqual(response.content_type,
+                         "application/vnd.openstack.melange+msgpack")
+        self.assertEqual(saved_block.cidr, "10.1.1.0/24")
+        self.assertEqual(data['ip_block']['id'], saved_block.id)
+
+    def test_show_fault_for_msgpack_content_type(self):
+        response = self.app.get("%s/bad_id.msgpack" % self.ip_block_path,
+                                status="*")
+
+        data = msgpack.unpackb(response.body, raw=False)
+        self.assertEqual(response.status_int, 404)
+        self.assertEqual(data['NotFound']['code'], 404)
+
     def test_index_is_able_to_filter_by_type(self):
         factory_models.PublicIpBlockFactory(cidr="72.1.1.1/30", network_id="1")
         private_factory = factory_models.PrivateIpBlockFactory
@@ -390,6 +586,66 @@ class TestIpBlockController(ControllerTestBase):
         self.assertErrorResponse(response, webob.exc.HTTPNotFound,
                                  "IpBlock Not Found")
 
+    def test_free_ranges(self):
+        ip_block = factory_models.PrivateIpBlockFactory(tenant_id="123",
+                                                        cidr="10.0.0.0/28",
+                                                        gateway="10.0.0.1")
+        factory_models.IpAddressFactory(ip_block_id=ip_block.id,
+                                        address="10.0.0.5")
+
+        response = self.app.get("/ipam/tenants/123/ip_blocks/%s/free_ranges"
+                                % ip_block.id)
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['free_ranges'],
+                         [{'ip_block_id': ip_block.id,
+                           'first_address': "10.0.0.0",
+                           'last_address': "10.0.0.0",
+                           'size': 1},
+                          {'ip_block_id': ip_block.id,
+                           'first_address': "10.0.0.2",
+                           'last_address': "10.0.0.4",
+                           'size': 3},
+                          {'ip_block_id': ip_block.id,
+                           'first_address': "10.0.0.6",
+                           'last_address': "10.0.0.14",
+                           'size': 9}])
+
+    def test_free_ranges_are_paginated_by_last_address(self):
+        ip_block = factory_models.PrivateIpBlockFactory(tenant_id="123",
+                                                        cidr="10.0.0.0/28",
+                                                        gateway="10.0.0.1")
+
+        response = self.app.get("/ipam/tenants/123/ip_blocks/%s/free_ranges"
+                                "?limit=1&marker=10.0.0.0" % ip_block.id)
+
+        free_ranges = response.json['free_ranges']
+        self.assertEqual([(free_range['first_address'],
+                           free_range['last_address'])
+                          for free_range in free_ranges],
+                         [("10.0.0.2", "10.0.0.14")])
+        self.assertNotIn('free_ranges_links', response.json)
+
+    def test_free_ranges_link_to_the_next_page(self):
+        ip_block = factory_models.PrivateIpBlockFactory(tenant_id="123",
+                                                        cidr="10.0.0.0/28",
+                                                        gateway="10.0.0.1")
+
+        response = self.app.get("/ipam/tenants/123/ip_blocks/%s/free_ranges"
+                                "?limit=1" % ip_block.id)
+
+        self.assertTrue("marker=10.0.0.0"
+                        in response.json['free_ranges_links'][0]['href'])
+
+    def test_free_ranges_fails_for_invalid_marker(self):
+        ip_block = factory_models.PrivateIpBlockFactory(tenant_id="123")
+
+        response = self.app.get("/ipam/tenants/123/ip_blocks/%s/free_ranges"
+                                "?marker=blah" % ip_block.id, status="*")
+
+        self.assertErrorResponse(response, webob.exc.HTTPBadRequest,
+                                 "Invalid value blah for marker")
+
 
 class TestSubnetController(ControllerTestBase):
 
@@ -606,6 +862,17 @@ class TestIpAddressController(ControllerTestBase):
         self.assertEqual(response.status, "200 OK")
         self.assertEqual(response.json, dict(ip_address=_data(ip)))
 
+    def test_index_with_fields(self):
+        block = factory_models.IpBlockFactory()
+        ip = _allocate_ip(block)
+
+        response = self.app.get(self._address_path(block),
+                                {'fields': "address,used_by_device"})
+
+        self.assertEqual(response.json["ip_addresses"],
+                         [dict(address=ip.address,
+                               used_by_device=ip.used_by_device_id)])
+
     def test_show_fails_for_nonexistent_address(self):
         block = factory_models.IpBlockFactory(cidr="10.1.1.0/28")
 
@@ -939,6 +1206,31 @@ class TestAllocatedIpAddressController(ControllerTestBase):
         self.assertEqual(response.json['ip_addresses'],
                          _data(allocated_ips[2:6]))
 
+    def test_index_streams_allocated_ips_as_paginated_set(self):
+        ip_block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        ips = models.sort(_allocate_ips((ip_block, 5))[0])
+
+        with unit.StubConfig(stream_collections="True"):
+            response = self.app.get("/ipam/allocated_ip_addresses.json?"
+                                    "limit=2&marker=%s" % ips[0].id)
+
+        next_link = response.json['ip_addresses_links'][0]['href']
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['ip_addresses'], _data(ips[1:3]))
+        self.assertTrue("marker=%s" % ips[2].id in next_link)
+
+    def test_index_streamed_for_xml_content_type(self):
+        ip_block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        ips = models.sort(_allocate_ips((ip_block, 3))[0])
+
+        with unit.StubConfig(stream_collections="True"):
+            response = self.app.get("/ipam/allocated_ip_addresses.xml?"
+                                    "limit=2")
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(response.xml), 3)
+        self.assertEqual(len(response.xml.findall("link")), 1)
+
     def test_index_returns_allocated_ips_for_tenant(self):
         block1 = factory_models.IpBlockFactory(cidr="10.0.0.0/24",
                                                tenant_id="1")
@@ -1955,6 +2247,24 @@ class TestNetworksController(ControllerTestBase):
         self.assertErrorResponse(response, webob.exc.HTTPNotFound,
                                  "Network 1 not found")
 
+    def test_free_ranges_of_all_blocks_in_network(self):
+        factory = factory_models.PrivateIpBlockFactory
+        block1 = factory(tenant_id="tnt_id", network_id="1",
+                         cidr="10.0.0.0/30", gateway=None)
+        block2 = factory(tenant_id="tnt_id", network_id="1",
+                         cidr="10.0.1.0/30", gateway=None)
+        factory(tenant_id="tnt_id", network_id="22", cidr="10.0.2.0/30")
+
+        response = self.app.get("/ipam/tenants/tnt_id/networks/1/free_ranges")
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual([(free_range['ip_block_id'],
+                           free_range['first_address'],
+                           free_range['last_address'])
+                          for free_range in response.json['free_ranges']],
+                         [(block1.id, "10.0.0.0", "10.0.0.2"),
+                          (block2.id, "10.0.1.0", "10.0.1.2")])
+
 
 class TestInterfaceIpAllocationsController(ControllerTestBase):
 
@@ -2289,6 +2599,26 @@ class TestInterfacesController(ControllerTestBase):
         self.assertEqual(iface_data['ip_addresses'],
                          views.IpConfigurationView(*iface.ip_addresses).data())
 
+    def test_show_answers_not_modified_until_configuration_changes(self):
+        iface = factory_models.InterfaceFactory(tenant_id="tnt_id",
+                                                vif_id_on_device="vif_id")
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        block.allocate_ip(iface)
+        path = "/ipam/tenants/tnt_id/interfaces/vif_id"
+        with unit.StubTime(time=_settled_time()):
+            etag = self.app.get(path).etag
+            unchanged_response = self.app.get(
+                path, headers={'If-None-Match': '"%s"' % etag})
+        factory_models.IpRouteFactory(source_block_id=block.id)
+        with unit.StubTime(time=_settled_time()):
+            changed_response = self.app.get(
+                path, headers={'If-None-Match': '"%s"' % etag})
+
+        self.assertEqual(unchanged_response.status_int, 304)
+        self.assertEqual(changed_response.status_int, 200)
+        self.assertEqual(len(changed_response.json['interface']
+                             ['ip_addresses'][0]['ip_block']['ip_routes']), 1)
+
     def test_interface_create_and_then_allocate_ips(self):
         ip_block = factory_models.PrivateIpBlockFactory(
             tenant_id="RAX",
@@ -2352,6 +2682,23 @@ class TestInstanceInterfacesController(ControllerTestBase):
             self.assertEqual('tnt', iface.tenant_id)
             self.assertEqual(network_id, iface.plugged_in_network_id())
 
+    def test_update_all_allocates_macs_of_all_interfaces_together(self):
+        factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        put_data = {'instance': {
+            'tenant_id': "tnt",
+            'interfaces': [{'virtual_interface_id': "vif_1"},
+                           {'virtual_interface_id': "vif_2"}]}}
+        self.mock.StubOutWithMock(models.MacAddressRange,
+                                  "allocate_next_free_mac")
+        self.mock.ReplayAll()
+
+        response = self.app.put_json("/ipam/instances/instance_id/interfaces",
+                                     put_data)
+
+        self.assertEqual([iface['mac_address'] for iface
+                          in response.json['instance']['interfaces']],
+                         ["BC:76:4E:20:00:00", "BC:76:4E:20:00:01"])
+
     def test_update_deletes_existing_interface(self):
         provider_block = factory_models.IpBlockFactory(tenant_id="RAX",
                                                        network_id="net_id")
@@ -2672,6 +3019,224 @@ class TestMacAddressRangesController(ControllerTestBase):
                                  "MacAddressRange Not Found")
 
 
+class TestChangesController(ControllerTestBase):
+
+    def setUp(self):
+        super(TestChangesController, self).setUp()
+        self.no_commit_lag = unit.StubConfig(change_feed_commit_lag="0")
+        self.no_commit_lag.__enter__()
+
+    def tearDown(self):
+        self.no_commit_lag.__exit__(None, None, None)
+        super(TestChangesController, self).tearDown()
+
+    def _changes_since(self, since, **conditions):
+        changes = models.Change.find_all(**conditions).all()
+        return models.sort([change for change in changes
+                            if change.id > since])
+
+    def test_index_lists_changes_in_order(self):
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        ip = _allocate_ip(block)
+        ip.deallocate()
+
+        response = self.app.get("/ipam/changes?resource_type=ip_address")
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual([change['event']
+                          for change in response.json['changes']],
+                         ["allocate", "deallocate"])
+        self.assertEqual(response.json['changes'][0]['data']['address'],
+                         ip.address)
+
+    def test_index_returns_changes_since_given_id(self):
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24")
+        first_ip = _allocate_ip(block)
+        since = models.Change.get_by(resource_id=first_ip.id).id
+        second_ip = _allocate_ip(block)
+
+        response = self.app.get("/ipam/changes?since=%s" % since)
+
+        self.assertEqual(response.json['changes'],
+                         _data(self._changes_since(since)))
+        self.assertEqual(response.json['changes'][-1]['resource_id'],
+                         second_ip.id)
+
+    def test_index_links_to_next_page_with_since(self):
+        for i in range(3):
+            factory_models.IpBlockFactory(cidr="10.%s.0.0/24" % i)
+        changes = self._changes_since(0)
+
+        response = self.app.get("/ipam/changes?limit=2")
+
+        next_link = response.json['changes_links'][0]['href']
+        self.assertEqual(response.json['changes'], _data(changes[:2]))
+        self.assertTrue("since=%s" % changes[1].id in next_link)
+
+    def test_index_scoped_by_tenant(self):
+        factory_models.IpBlockFactory(cidr="10.0.0.0/24", tenant_id="tnt1")
+        factory_models.IpBlockFactory(cidr="20.0.0.0/24", tenant_id="tnt2")
+
+        response = self.app.get("/ipam/tenants/tnt1/changes")
+
+        self.assertEqual(response.json['changes'],
+                         _data(self._changes_since(0, tenant_id="tnt1")))
+
+    def test_index_waits_for_changes_when_none_are_available(self):
+        self.mock.StubOutWithMock(eventlet, "sleep")
+        eventlet.sleep(0.01).WithSideEffects(
+            lambda seconds: factory_models.IpBlockFactory(tenant_id="tnt"))
+        self.mock.ReplayAll()
+
+        with unit.StubConfig(change_feed_poll_interval="0.01"):
+            response = self.app.get("/ipam/tenants/tnt/changes?wait=5")
+
+        self.assertEqual([change['event']
+                          for change in response.json['changes']],
+                         ["create"])
+
+    def test_index_returns_empty_page_when_wait_elapses(self):
+        with unit.StubConfig(change_feed_max_wait="0"):
+            response = self.app.get("/ipam/tenants/tnt/changes?wait=5")
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['changes'], [])
+
+    def test_index_lists_recent_changes_without_missing_ids(self):
+        factory_models.IpBlockFactory(tenant_id="tnt")
+
+        with unit.StubConfig(change_feed_commit_lag="60"):
+            response = self.app.get("/ipam/tenants/tnt/changes")
+
+        self.assertEqual([change['event']
+                          for change in response.json['changes']],
+                         ["create"])
+
+    def test_index_holds_back_changes_past_an_uncommitted_id(self):
+        for i in range(3):
+            factory_models.IpBlockFactory(tenant_id="tnt")
+        first, uncommitted, last = models.sort(
+            models.Change.find_all(tenant_id="tnt"))
+        models.Change.find_all(id=uncommitted.id).delete()
+
+        with unit.StubConfig(change_feed_commit_lag="60"):
+            held_back_response = self.app.get("/ipam/tenants/tnt/changes")
+            db.db_api.save(uncommitted)
+            committed_response = self.app.get(
+                "/ipam/tenants/tnt/changes?since=%s" % first.id)
+
+        self.assertEqual([change['id']
+                          for change in held_back_response.json['changes']],
+                         [first.id])
+        self.assertEqual([change['id']
+                          for change in committed_response.json['changes']],
+                         [uncommitted.id, last.id])
+
+    def test_index_takes_long_missing_ids_for_rolled_back_changes(self):
+        for i in range(2):
+            factory_models.IpBlockFactory(tenant_id="tnt")
+        rolled_back, last = models.sort(
+            models.Change.find_all(tenant_id="tnt"))
+        models.Change.find_all(id=rolled_back.id).delete()
+        later = utils.utcnow() + datetime.timedelta(seconds=61)
+
+        with unit.StubConfig(change_feed_commit_lag="60"):
+            with unit.StubTime(time=later):
+                response = self.app.get("/ipam/tenants/tnt/changes")
+
+        self.assertEqual([change['id']
+                          for change in response.json['changes']],
+                         [last.id])
+
+    def test_index_raises_bad_request_for_invalid_since(self):
+        response = self.app.get("/ipam/changes?since=abc", status="*")
+
+        self.assertErrorResponse(response,
+                                 webob.exc.HTTPBadRequest,
+                                 "Invalid value abc for since")
+
+
+class TestBatchController(ControllerTestBase):
+
+    def _create_block(self, cidr):
+        return {'method': "POST",
+                'path': "/ipam/tenants/tnt/ip_blocks",
+                'body': {'ip_block': {'cidr': cidr,
+                                      'network_id': "net1",
+                                      'type': "private"}}}
+
+    def test_create_runs_sub_requests_in_order(self):
+        response = self.appv1_0.post_json("/batch", {'batch': {
+            'requests': [self._create_block("10.0.0.0/24"),
+                         {'method': "GET",
+                          'path': "/ipam/tenants/tnt/ip_blocks"}]}})
+
+        block = models.IpBlock.get_by(cidr="10.0.0.0/24", tenant_id="tnt")
+        responses = response.json['batch']['responses']
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual([sub['status'] for sub in responses], [201, 200])
+        self.assertEqual(responses[0]['body'], dict(ip_block=_data(block)))
+        self.assertEqual(responses[1]['body']['ip_blocks'], _data([block]))
+
+    def test_create_keeps_earlier_changes_when_not_atomic(self):
+        response = self.appv1_0.post_json("/batch", {'batch': {
+            'requests': [self._create_block("10.0.0.0/24"),
+                         self._create_block("10...")]}})
+
+        responses = response.json['batch']['responses']
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual([sub['status'] for sub in responses], [201, 400])
+        self.assertEqual(models.IpBlock.count(tenant_id="tnt"), 1)
+
+    def test_atomic_batch_rolls_back_when_a_sub_request_fails(self):
+        response = self.appv1_0.post_json("/batch", {'batch': {
+            'atomic': True,
+            'requests': [self._create_block("10.0.0.0/24"),
+                         self._create_block("10..."),
+                         self._create_block("20.0.0.0/24")]}},
+            status="*")
+
+        responses = response.json['batch']['responses']
+        self.assertEqual(response.status_int, 400)
+        self.assertEqual([sub['status'] for sub in responses], [201, 400])
+        self.assertEqual(models.IpBlock.count(tenant_id="tnt"), 0)
+
+    def test_atomic_batch_sends_no_notifications_when_rolled_back(self):
+        self.mock.StubOutWithMock(notifier.NoopNotifier, "notify")
+        self.mock.ReplayAll()
+
+        response = self.appv1_0.post_json("/batch", {'batch': {
+            'atomic': True,
+            'requests': [self._create_block("10.0.0.0/24"),
+                         self._create_block("10...")]}},
+            status="*")
+
+        self.assertEqual([sub['status']
+                          for sub in response.json['batch']['responses']],
+                         [201, 400])
+
+    def test_atomic_batch_commits_all_sub_requests(self):
+        response = self.appv1_0.post_json("/batch", {'batch': {
+            'atomic': True,
+            'requests': [self._create_block("10.0.0.0/24"),
+                         self._create_block("20.0.0.0/24")]}})
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(models.IpBlock.count(tenant_id="tnt"), 2)
+
+    def test_create_raises_bad_request_for_too_many_sub_requests(self):
+        with unit.StubConfig(batch_max_requests="1"):
+            response = self.appv1_0.post_json("/batch", {'batch': {
+                'requests': [self._create_block("10.0.0.0/24"),
+                             self._create_block("20.0.0.0/24")]}},
+                status="*")
+
+        self.assertErrorResponse(response,
+                                 webob.exc.HTTPBadRequest,
+                                 "Batch of 2 requests exceeds the limit of 1")
+        self.assertEqual(models.IpBlock.count(tenant_id="tnt"), 0)
+
+
 class TestInterfaceAllowedIpsController(ControllerTestBase):
 
     def test_index(self):
@@ -2873,3 +3438,8 @@ def _allocate_ip(block, interface=None, **kwargs):
     if interface is None:
         interface = factory_models.InterfaceFactory()
     return block.allocate_ip(interface=interface, **kwargs)
+
+
+def _settled_time():
+    """A time late enough for responses to be tagged with an ETag."""
+    return utils.utcnow() + datetime.timedelta(minutes=1)
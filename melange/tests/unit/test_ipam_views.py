@@ -65,6 +65,42 @@ class TestIpConfigurationView(tests.BaseTest):
 
         self.assertItemsEqual(expected_ip_config_routes, ip1_config_routes)
 
+    def test_data_returns_only_selected_fields(self):
+        block = factory_models.IpBlockFactory()
+        factory_models.IpRouteFactory(source_block_id=block.id)
+        ip = factory_models.IpAddressFactory(ip_block_id=block.id)
+
+        data = views.IpConfigurationView(
+            ip, fields=['address', 'ip_block.cidr']).data()
+
+        self.assertEqual(data, [{'address': ip.address,
+                                 'ip_block': {'cidr': block.cidr}}])
+
+    def test_data_returns_selected_route_fields(self):
+        block = factory_models.IpBlockFactory()
+        route = factory_models.IpRouteFactory(source_block_id=block.id)
+        ip = factory_models.IpAddressFactory(ip_block_id=block.id)
+
+        data = views.IpConfigurationView(
+            ip, fields=['id', 'ip_block.ip_routes.destination']).data()
+
+        self.assertEqual(data, [{'id': ip.id,
+                                 'ip_block': {'ip_routes': [
+                                     {'destination': route.destination}]}}])
+
+
+class TestInterfaceConfigurationView(tests.BaseTest):
+
+    def test_data_returns_only_selected_fields(self):
+        interface = factory_models.InterfaceFactory(vif_id_on_device="123")
+        ip = factory_models.IpAddressFactory(interface_id=interface.id)
+
+        data = views.InterfaceConfigurationView(
+            interface, fields=['id', 'ip_addresses.address']).data()
+
+        self.assertEqual(data, {'id': "123",
+                                'ip_addresses': [{'address': ip.address}]})
+
 
 def _ip_data(ip, block):
     return {
@@ -131,6 +131,45 @@ class TestQueueNotifier(tests.BaseTest, NotifierTestBase):
             self.notifier.error("test_event", "test_message")
 
 
+class TestDeferredNotifications(tests.BaseTest):
+
+    def setUp(self):
+        super(TestDeferredNotifications, self).setUp()
+        self.sent = []
+        self.notifier = notifier.NoopNotifier()
+        self.notifier.notify = lambda level, msg: self.sent.append(
+            msg['event_type'])
+
+    def test_sends_notifications_when_block_exits(self):
+        with notifier.deferred():
+            self.notifier.info("test_event", "test_message")
+            self.assertEqual(self.sent, [])
+
+        self.assertEqual(self.sent, ["test_event"])
+
+    def test_drops_discarded_notifications(self):
+        with notifier.deferred() as notifications:
+            self.notifier.info("test_event", "test_message")
+            notifications.discard()
+
+        self.assertEqual(self.sent, [])
+
+    def test_drops_notifications_when_block_raises(self):
+        try:
+            with notifier.deferred():
+                self.notifier.info("test_event", "test_message")
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(self.sent, [])
+
+    def test_sends_notifications_at_once_when_not_enabled(self):
+        with notifier.deferred(enabled=False):
+            self.notifier.info("test_event", "test_message")
+            self.assertEqual(self.sent, ["test_event"])
+
+
 class TestModelNotification(tests.BaseTest):
 
     class TestModel(models.ModelBase):
@@ -14,9 +14,13 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import json
+
 from melange.common.pagination import AppUrl
 from melange.common.pagination import AtomLink
 from melange.common.pagination import PaginatedDataView
+from melange.common.pagination import StreamedDataView
+from melange.common.wsgi import JSONDictSerializer
 from melange.common.utils import find
 from melange.tests import BaseTest
 
@@ -62,6 +66,44 @@ class TestPaginatedDataView(BaseTest):
         self.assertIsNone(data_for_xml)
 
 
+class TestStreamedDataView(BaseTest):
+
+    def test_json_chunks_of_a_page_with_next_link(self):
+        elements = iter([("r1", {'id': "r1"}), ("r2", {'id': "r2"}),
+                         ("r3", {'id': "r3"})])
+        current_page_url = "http://abc.com/resources?limit=2"
+        expected_href = "http://abc.com/resources?limit=2&marker=r2"
+
+        view = StreamedDataView('ip_blocks', elements, current_page_url,
+                                limit=2)
+        data = json.loads("".join(view.json_chunks(JSONDictSerializer())))
+
+        self.assertEqual(data['ip_blocks'], [{'id': "r1"}, {'id': "r2"}])
+        self.assertUrlEqual(data['ip_blocks_links'][0]['href'],
+                            expected_href)
+
+    def test_json_chunks_of_last_page(self):
+        elements = iter([("r1", {'id': "r1"})])
+
+        view = StreamedDataView('ip_blocks', elements,
+                                "http://abc.com/resources", limit=2)
+        data = json.loads("".join(view.json_chunks(JSONDictSerializer())))
+
+        self.assertEqual(data, {'ip_blocks': [{'id': "r1"}]})
+
+    def test_data_for_json_is_same_as_paginated_view(self):
+        elements = iter([("r1", {'id': "r1"}), ("r2", {'id': "r2"})])
+        current_page_url = "http://abc.com/resources?limit=1"
+
+        data = StreamedDataView('ip_blocks', elements, current_page_url,
+                                limit=1).data_for_json()
+
+        expected_data = PaginatedDataView('ip_blocks', [{'id': "r1"}],
+                                          current_page_url,
+                                          "r1").data_for_json()
+        self.assertEqual(data, expected_data)
+
+
 class TestAppUrl(BaseTest):
 
     def test_change_query_params_of_url(self):
@@ -14,6 +14,11 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import logging
+import random
+import time
+
+from netaddr import EUI
 from netaddr import IPAddress
 from netaddr import IPNetwork
 
@@ -21,6 +26,17 @@ from melange.ipv6 import rfc2462_generator
 from melange.tests import BaseTest
 
 
+LOG = logging.getLogger('melange.tests.unit.test_rfc2462_ipv6_generator')
+
+
+def netaddr_derived_ip(cidr, mac_address):
+    mac64 = EUI(mac_address).eui64().words
+    int_addr = int(''.join(['%02x' % i for i in mac64]), 16)
+    variable_segment = IPAddress(int_addr) ^ IPAddress("::0200:0:0:0")
+    network = IPNetwork(cidr)
+    return str(variable_segment & network.hostmask | network.cidr.ip)
+
+
 class TestRFC2462IpV6Generator(BaseTest):
 
     def test_next_ip_generates_last_4_segments_for_slash_64_block(self):
@@ -53,3 +69,41 @@ class TestRFC2462IpV6Generator(BaseTest):
 
         self.assertEqual(ip, "fe::ff:12ff:fe89:6734")
         self.assertIn(IPAddress(ip), IPNetwork("fe::/72"))
+
+    def test_next_ips_returns_consecutive_addresses(self):
+        generator = rfc2462_generator.RFC2462IpV6Generator(
+            cidr="fe::/64",
+            mac_address="12:ff:12:89:67:34")
+
+        ips = generator.next_ips(2)
+
+        self.assertEqual(ips, ["fe::10ff:12ff:fe89:6734",
+                               "fe::10ff:12ff:fe89:6735"])
+        self.assertEqual(generator.next_ip(), "fe::10ff:12ff:fe89:6736")
+
+    def test_next_ip_matches_netaddr_derivation(self):
+        for i in range(50):
+            cidr = "fe::/%d" % random.choice([48, 64, 72, 96, 120])
+            mac_address = str(EUI(random.getrandbits(48)))
+            generator = rfc2462_generator.RFC2462IpV6Generator(
+                cidr, mac_address=mac_address)
+
+            self.assertEqual(generator.next_ip(),
+                             netaddr_derived_ip(cidr, mac_address))
+
+    def test_benchmark_against_netaddr_derivation(self):
+        generator = rfc2462_generator.RFC2462IpV6Generator(
+            cidr="fe::/64",
+            mac_address="12:ff:12:89:67:34")
+
+        start = time.time()
+        for i in range(1000):
+            netaddr_derived_ip("fe::/64", "12:ff:12:89:67:34")
+        netaddr_timing = (time.time() - start) * 1e3
+        start = time.time()
+        generator.next_ips(1000)
+        generator_timing = (time.time() - start) * 1e3
+
+        LOG.info("Generated 1000 addresses, microseconds per address: "
+                 "netaddr %.1f, generator %.1f"
+                 % (netaddr_timing, generator_timing))
@@ -116,6 +116,34 @@ class TestCachedProperty(tests.BaseTest):
         self.assertTrue(isinstance(Foo.bar, utils.cached_property))
 
 
+class TestLRUCache(tests.BaseTest):
+
+    def test_computes_value_of_a_key_once(self):
+        computed = []
+        cache = utils.LRUCache(max_size=4)
+
+        def compute(key):
+            computed.append(key)
+            return key * 2
+
+        self.assertEqual(cache.get(3, compute), 6)
+        self.assertEqual(cache.get(3, compute), 6)
+        self.assertEqual(computed, [3])
+
+    def test_drops_least_recently_used_keys_when_full(self):
+        cache = utils.LRUCache(max_size=4)
+        for key in range(4):
+            cache.get(key, str)
+        cache.get(0, str)
+
+        cache.get(4, str)
+
+        self.assertEqual(len(cache), 4)
+        self.assertIn(0, cache)
+        self.assertNotIn(1, cache)
+        self.assertIn(4, cache)
+
+
 class TestFind(tests.BaseTest):
 
     def test_find_returns_first_item_matching_predicate(self):
@@ -133,6 +161,33 @@ class TestFind(tests.BaseTest):
         self.assertEqual(item, None)
 
 
+class TestChunks(tests.BaseTest):
+
+    def test_chunks_splits_items_in_lists_of_size(self):
+        chunks = utils.chunks(iter([1, 2, 3, 4, 5]), 2)
+
+        self.assertEqual(list(chunks), [[1, 2], [3, 4], [5]])
+
+
+class TestRequested(tests.BaseTest):
+
+    def test_all_names_are_requested_when_fields_is_none(self):
+        self.assertTrue(utils.requested(None, 'id'))
+
+    def test_name_is_requested_when_listed_or_nested(self):
+        fields = ['id', 'ip_block.cidr']
+
+        self.assertTrue(utils.requested(fields, 'id'))
+        self.assertTrue(utils.requested(fields, 'ip_block'))
+        self.assertTrue(utils.requested(fields, 'address', 'ip_block'))
+
+    def test_name_is_not_requested_when_only_a_prefix_matches(self):
+        fields = ['ip_blocks', 'ip.cidr']
+
+        self.assertFalse(utils.requested(fields, 'ip_block'))
+        self.assertFalse(utils.requested([], 'id'))
+
+
 class TestMethodInspector(tests.BaseTest):
 
     def test_method_without_optional_args(self):
@@ -15,15 +15,27 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import json
+import logging
+import msgpack
 import routes
+import time
 import webob
 import webob.exc
 import webtest
 
+from melange.common import pagination
+from melange.common import utils
 from melange.common import wsgi
+from melange.openstack.common import exception as openstack_exception
+from melange.openstack.common import wsgi as openstack_wsgi
 from melange import tests
 
 
+LOG = logging.getLogger('melange.tests.unit.test_wsgi')
+
+
 class StubApp(object):
 
     def __init__(self):
@@ -152,6 +164,23 @@ class RequestTest(tests.BaseTest):
         result = request.best_match_content_type()
         self.assertEqual(result, "application/json")
 
+    def test_content_type_msgpack_from_accept_header(self):
+        request = wsgi.Request.blank('/tests/123')
+        request.headers["Accept"] = \
+            "application/vnd.openstack.melange+msgpack;version=1.0"
+        result = request.best_match_content_type()
+        self.assertEqual(result, "application/vnd.openstack.melange+msgpack")
+
+        request = wsgi.Request.blank('/tests/123')
+        request.headers["Accept"] = "application/x-msgpack"
+        result = request.best_match_content_type()
+        self.assertEqual(result, "application/x-msgpack")
+
+    def test_content_type_msgpack_from_query_extension(self):
+        request = wsgi.Request.blank('/tests/123.msgpack')
+        result = request.best_match_content_type()
+        self.assertEqual(result, "application/x-msgpack")
+
     def test_content_type_accept_and_query_extension(self):
         request = wsgi.Request.blank('/tests/123.xml')
         request.headers["Accept"] = "application/json"
@@ -283,6 +312,19 @@ class TestFault(tests.BaseTest):
                               message="The resource could not be found.",
                               detail="some error"))
 
+    def test_fault_gives_back_msgpack(self):
+        app = webtest.TestApp(wsgi.Fault(
+            webob.exc.HTTPBadRequest("some error")))
+        response = app.get("/x.msgpack", status="*")
+        self.assertEqual(response.content_type, "application/x-msgpack")
+        body = msgpack.unpackb(response.body, raw=False)
+        self.assertEqual(body['BadRequest'],
+                         dict(code=400,
+                              message="The server could not comply with "
+                                      "the request since it is either "
+                                      "malformed or otherwise incorrect.",
+                              detail="some error"))
+
     def test_fault_gives_back_xml(self):
         app = webtest.TestApp(wsgi.Fault(
             webob.exc.HTTPBadRequest("some error")))
@@ -318,3 +360,225 @@ class TestResult(tests.BaseTest):
     def test_data_returns_xml_specific_input_data(self):
         self.assertEqual(wsgi.Result(self.TestData()).data("application/xml"),
                          {'foos': [{'foo': "bar"}, {'foo2': "bar2"}]})
+
+    def test_streamable_only_for_json_chunks(self):
+        streamed_data = pagination.StreamedDataView('foos', iter([]), "/foos")
+
+        self.assertTrue(wsgi.Result(streamed_data).streamable(
+            "application/json"))
+        self.assertFalse(wsgi.Result(streamed_data).streamable(
+            "application/xml"))
+        self.assertFalse(wsgi.Result(self.TestData()).streamable(
+            "application/json"))
+
+
+class TestMelangeResponseSerializer(tests.BaseTest):
+
+    def test_serialize_streams_chunks_without_content_length(self):
+        elements = iter([("1", {'id': "1"}), ("2", {'id': "2"})])
+        result = wsgi.Result(
+            pagination.StreamedDataView('foos', elements, "/foos"))
+
+        response = wsgi.MelangeResponseSerializer().serialize(
+            result, "application/json")
+
+        self.assertIsNone(response.content_length)
+        self.assertEqual(json.loads(response.body),
+                         {'foos': [{'id': "1"}, {'id': "2"}]})
+
+
+class DomXMLDictSerializer(openstack_wsgi.XMLDictSerializer):
+    """Minidom based serializer, the reference for identical output."""
+
+    def _to_xml_node(self, doc, metadata, nodename, data):
+        if hasattr(data, "to_xml"):
+            return data.to_xml()
+        return super(DomXMLDictSerializer, self)._to_xml_node(doc,
+                                                              metadata,
+                                                              nodename,
+                                                              data)
+
+
+class TestMelangeXMLDictSerializer(tests.BaseTest):
+
+    def _assert_same_as_dom_xml(self, data, metadata=None, xmlns=None):
+        expected_xml = DomXMLDictSerializer(metadata, xmlns).serialize(data)
+        actual_xml = wsgi.MelangeXMLDictSerializer(metadata,
+                                                   xmlns).serialize(data)
+
+        self.assertEqual(actual_xml, expected_xml)
+
+    def test_serializes_nested_data(self):
+        self._assert_same_as_dom_xml({'ip_blocks': [
+            {'id': "1", 'cidr': "10.0.0.0/24", 'gateway': None,
+             'network_name': "", 'created_at': datetime.datetime.now(),
+             'ip_routes': [{'id': "2", 'destination': "20.0.0.0"}]},
+            {},
+        ]})
+
+    def test_escapes_text_and_attributes(self):
+        self._assert_same_as_dom_xml(
+            {'policy': {'name': u'a<b> & "c"', 'description': "d&e"}},
+            metadata={'attributes': {'policy': ['name']}})
+
+    def test_serializes_atom_links(self):
+        self._assert_same_as_dom_xml({'ip_blocks': [
+            {'id': "1"},
+            pagination.AtomLink("next", "http://abc.com/?marker=1&limit=2"),
+        ]})
+
+    def test_serializes_collections_and_xmlns(self):
+        metadata = {
+            'xmlns': "urn:melange",
+            'plurals': {'servers': "server"},
+            'list_collections': {'ids': {'item_name': "id",
+                                         'item_key': "value"}},
+            'dict_collections': {'meta': {'item_name': "meta",
+                                          'item_key': "key"}},
+        }
+
+        self._assert_same_as_dom_xml({'servers': [{'ids': [1, 2],
+                                                   'meta': {'k': "v"}},
+                                                  {'ids': [], 'meta': {}}]},
+                                     metadata=metadata,
+                                     xmlns="urn:root")
+
+    def test_serializes_faults(self):
+        metadata = {'attributes': {'BadRequest': 'code'}}
+        self._assert_same_as_dom_xml({'BadRequest': {'code': 400,
+                                                     'message': "bad",
+                                                     'detail': "<error>"}},
+                                     metadata=metadata)
+
+    def test_chunks_are_written_incrementally(self):
+        data = {'ip_blocks': [{'id': str(i)} for i in range(3)]}
+
+        chunks = list(wsgi.MelangeXMLDictSerializer().chunks(data))
+
+        self.assertTrue(len(chunks) > 3)
+        self.assertEqual("".join(chunks),
+                         DomXMLDictSerializer().serialize(data))
+
+    def test_benchmark_against_dom_serializer(self):
+        ip_addresses = [{'id': utils.generate_uuid(),
+                         'address': "10.0.%d.%d" % (i / 256, i % 256),
+                         'version': 4,
+                         'used_by_tenant': "tenant",
+                         'created_at': datetime.datetime.now(),
+                         } for i in range(2000)]
+        link = pagination.AtomLink("next", "http://abc.com/?marker=1")
+        data = {'ip_addresses': ip_addresses + [link]}
+
+        timings = {}
+        outputs = {}
+        for serializer in (DomXMLDictSerializer(),
+                           wsgi.MelangeXMLDictSerializer()):
+            name = serializer.__class__.__name__
+            start = time.time()
+            outputs[name] = serializer.serialize(data)
+            timings[name] = time.time() - start
+
+        LOG.info("Serialized %d ip addresses to xml in seconds: %s"
+                 % (len(ip_addresses), timings))
+        self.assertEqual(outputs['MelangeXMLDictSerializer'],
+                         outputs['DomXMLDictSerializer'])
+
+
+class TestCompiledMapper(tests.BaseTest):
+
+    def setUp(self):
+        super(TestCompiledMapper, self).setUp()
+        self.mapper = wsgi.CompiledMapper()
+        self.mapper.connect("/ipam/tenants/{tenant_id}/ip_blocks"
+                            "{.format:(json|xml)?}",
+                            controller="blocks", action="index",
+                            conditions=dict(method=['GET']))
+        self.mapper.connect("/ipam/tenants/{tenant_id}/ip_blocks/{id}"
+                            "{.format:(json|xml)?}",
+                            controller="blocks", action="show",
+                            conditions=dict(method=['GET']))
+        self.mapper.connect("/ipam/tenants/{tenant_id}/{resource}",
+                            controller="any", action="index")
+        self.mapper.connect("/ipam/allowed_ips/{address:.+?}",
+                            controller="allowed_ips", action="show")
+        self.mapper.create_regs()
+
+    def _match(self, url, method="GET"):
+        return self.mapper.routematch(url, {'REQUEST_METHOD': method})
+
+    def _compiled_match(self, url, method="GET"):
+        return self.mapper._match(url, {'REQUEST_METHOD': method})[:2]
+
+    def _full_scan_match(self, url, method="GET"):
+        return routes.Mapper._match(self.mapper, url,
+                                    {'REQUEST_METHOD': method})[:2]
+
+    def test_matches_like_a_full_scan(self):
+        for url in ["/ipam/tenants/t1/ip_blocks",
+                    "/ipam/tenants/t1/ip_blocks.xml",
+                    "/ipam/tenants/t1/ip_blocks/b1.json",
+                    "/ipam/tenants/ip_blocks/ip_blocks",
+                    "/ipam/tenants/t1/policies",
+                    "/ipam/allowed_ips/fe80::1/64",
+                    "/ipam/unknown"]:
+            for method in ["GET", "POST"]:
+                self.assertEqual(self._compiled_match(url, method),
+                                 self._full_scan_match(url, method))
+
+    def test_first_fitting_route_wins(self):
+        match, route = self._match("/ipam/tenants/t1/ip_blocks")
+
+        self.assertEqual(match['action'], "index")
+        self.assertEqual(match['controller'], "blocks")
+
+    def test_caches_fitting_routes_per_method_and_shape(self):
+        self._match("/ipam/tenants/t1/ip_blocks/b1")
+        self._match("/ipam/tenants/t2/ip_blocks/b2")
+        self._match("/ipam/tenants/t2/ip_blocks/b2", method="POST")
+
+        self.assertEqual(len(self.mapper._fitting_routes), 2)
+
+    def test_connecting_a_route_resets_cache(self):
+        self._match("/ipam/tenants/t1/ip_blocks")
+
+        self.mapper.connect("/ipam/networks", controller="networks")
+
+        self.assertEqual(self.mapper._fitting_routes, {})
+        self.assertEqual(self._match("/ipam/networks")[0]['controller'],
+                         "networks")
+
+
+class TestMsgpackDictSerializer(tests.BaseTest):
+
+    def test_serializes_datetimes_like_json(self):
+        now = datetime.datetime(2012, 1, 2, 3, 4, 5, 678)
+        data = {'ip_block': {'id': "1", 'created_at': now}}
+
+        serialized = wsgi.MsgpackDictSerializer().serialize(data)
+
+        self.assertEqual(msgpack.unpackb(serialized, raw=False),
+                         json.loads(wsgi.JSONDictSerializer().serialize(data)))
+
+    def test_strings_round_trip_as_text(self):
+        data = {'ip_block': {'id': "1", 'cidr': u"10.0.0.0/8"}}
+
+        serialized = wsgi.MsgpackDictSerializer().serialize(data)
+
+        ip_block = msgpack.unpackb(serialized, raw=False)['ip_block']
+        self.assertEqual(ip_block, {'id': u"1", 'cidr': u"10.0.0.0/8"})
+        self.assertTrue(all(isinstance(value, unicode)
+                            for value in ip_block.values()))
+
+
+class TestMsgpackDeserializer(tests.BaseTest):
+
+    def test_deserializes_body(self):
+        datastring = msgpack.packb({'ip_block': {'cidr': u"10.0.0.0/8"}})
+
+        self.assertEqual(wsgi.MsgpackDeserializer().deserialize(datastring),
+                         {'body': {'ip_block': {'cidr': u"10.0.0.0/8"}}})
+
+    def test_raises_malformed_request_body_for_invalid_msgpack(self):
+        self.assertRaises(openstack_exception.MalformedRequestBody,
+                          wsgi.MsgpackDeserializer().deserialize,
+                          "\x92\x01")